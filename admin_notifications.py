@@ -0,0 +1,53 @@
+"""
+Fanout of notifications to admins
+Sends one Bot API call to every admin concurrently, or a single call to the
+admin group chat when ADMIN_GROUP_ID is set. Handlers use notify_admins to
+run the fanout in the background so the user gets their reply without
+waiting on admin round trips. Each delivery is counted per admin chat.
+"""
+import asyncio
+import logging
+
+from config import ADMIN_IDS, ADMIN_GROUP_ID
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DELIVERIES = metrics.Counter("vpnbot_admin_notifications_total",
+                             "Notifications sent to admin chats", ["chat", "result"])
+
+def admin_chats():
+    """Chats that admin notifications go to"""
+    return [ADMIN_GROUP_ID] if ADMIN_GROUP_ID else list(ADMIN_IDS)
+
+async def _send(bot, chat_id, method, kwargs):
+    try:
+        await getattr(bot, method)(chat_id=chat_id, **kwargs)
+    except Exception as e:
+        DELIVERIES.inc(str(chat_id), "failed")
+        logger.error(f"Error notifying admin {chat_id} ({method}): {e}")
+        return False
+    DELIVERIES.inc(str(chat_id), "sent")
+    return True
+
+async def send_to_admins(bot, method, **kwargs):
+    """Call a Bot API send method for every admin chat at the same time
+
+    Args:
+        bot: telegram.Bot
+        method (str): Bot method name, e.g. 'send_message' or 'send_photo'
+        **kwargs: Arguments for the method except chat_id
+
+    Returns:
+        int: Number of chats the notification reached
+    """
+    results = await asyncio.gather(*(_send(bot, chat_id, method, kwargs) for chat_id in admin_chats()))
+    return sum(results)
+
+def notify_admins(application, method, **kwargs):
+    """Send a notification to admins in the background, see send_to_admins
+
+    Returns:
+        asyncio.Task: The running fanout
+    """
+    return application.create_task(send_to_admins(application.bot, method, **kwargs), name="notify_admins")
@@ -0,0 +1,276 @@
+"""
+Database microbenchmarks
+Generates a synthetic database at one or more scales and times each public
+function in database.py and db_utils.py. Results are written as JSON lines,
+one record per (scale, function), so runs can be diffed across commits.
+
+Usage:
+    python bench_db.py --scale 10000 --scale 100000 --output bench.jsonl
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import config
+
+logger = logging.getLogger(__name__)
+
+PLAN_GBS = [1, 5, 10, 30, 40, 50]
+TICKET_STATUSES = ['open', 'answered', 'closed', 'closed']
+
+def _timestamp(now, max_days_ago):
+    return (now - timedelta(seconds=random.randint(0, max_days_ago * 86400))).strftime('%Y-%m-%d %H:%M:%S')
+
+def generate_database(path, scale):
+    """Fill a fresh database with `scale` users and proportional related rows
+
+    Returns:
+        dict: Sample keys used to build benchmark arguments
+    """
+    import database
+
+    database.init_db()
+    now = datetime.now()
+    random.seed(scale)
+
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+
+    user_ids = list(range(1, scale + 1))
+    cursor.executemany(
+        "INSERT INTO users (user_id, username, first_name, last_name, join_date) VALUES (?, ?, ?, ?, ?)",
+        ((uid, f"user{uid}", f"First{uid}", f"Last{uid}", _timestamp(now, 730)) for uid in user_ids)
+    )
+
+    configs = []
+    for uid in user_ids:
+        for _ in range(random.choice([0, 1, 1, 2, 3])):
+            configs.append((uid, f"u{uid}_{uuid.uuid4().hex[:8]}@vpn", str(uuid.uuid4()),
+                            random.choice(PLAN_GBS), _timestamp(now, 730), random.random() < 0.6))
+    cursor.executemany(
+        "INSERT INTO configs (user_id, email, client_id, total_gb, created_at, is_active) VALUES (?, ?, ?, ?, ?, ?)",
+        configs
+    )
+
+    payments = []
+    for _ in range(scale):
+        status = random.choices(['approved', 'rejected', 'pending'], weights=[80, 15, 5])[0]
+        submitted = _timestamp(now, 730)
+        payments.append((random.choice(user_ids), str(random.choice(PLAN_GBS)), f"file_{uuid.uuid4().hex}",
+                         status, submitted, submitted if status == 'approved' else None))
+    cursor.executemany(
+        "INSERT INTO payments (user_id, plan, receipt_file_id, status, submitted_at, approved_at) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        payments
+    )
+
+    ticket_count = max(1, scale // 5)
+    cursor.executemany(
+        "INSERT INTO tickets (user_id, subject, status, created_at) VALUES (?, ?, ?, ?)",
+        ((random.choice(user_ids), f"مشکل اتصال شماره {i}", random.choice(TICKET_STATUSES), _timestamp(now, 365))
+         for i in range(ticket_count))
+    )
+    cursor.executemany(
+        "INSERT INTO ticket_messages (ticket_id, sender_id, message, is_admin, created_at) VALUES (?, ?, ?, ?, ?)",
+        ((random.randint(1, ticket_count), random.choice(user_ids), f"متن پیام نمونه {i} " * 5,
+          random.random() < 0.4, _timestamp(now, 365)) for i in range(ticket_count * 5))
+    )
+
+    conn.commit()
+
+    cursor.execute("SELECT user_id, email, client_id, config_id FROM configs ORDER BY RANDOM() LIMIT 200")
+    sample_configs = cursor.fetchall()
+    cursor.execute("SELECT ticket_id, user_id FROM tickets ORDER BY RANDOM() LIMIT 200")
+    sample_tickets = cursor.fetchall()
+    cursor.execute("SELECT payment_id FROM payments WHERE status = 'pending' LIMIT 200")
+    sample_payments = [row[0] for row in cursor.fetchall()]
+    conn.close()
+    sub_id = database.get_or_create_sub_id(sample_configs[0][0])
+
+    return {
+        'user_ids': user_ids,
+        'configs': sample_configs,
+        'tickets': sample_tickets,
+        'pending_payments': sample_payments or [0],
+        'sub_id': sub_id,
+    }
+
+def build_benchmarks(samples):
+    """Map benchmark names to zero-argument callables"""
+    import database
+    import db_utils
+
+    counter = iter(range(10 ** 9))
+
+    def user():
+        return random.choice(samples['user_ids'])
+
+    def config_row():
+        return random.choice(samples['configs'])
+
+    def ticket():
+        return random.choice(samples['tickets'])
+
+    def new_email():
+        return f"bench_{next(counter)}_{uuid.uuid4().hex[:6]}@vpn"
+
+    return {
+        # database.py - reads
+        'get_user_configs': lambda: database.get_user_configs(user()),
+        'get_client_id_by_email': lambda: database.get_client_id_by_email(*config_row()[1::-1]),
+        'check_trial_usage': lambda: database.check_trial_usage(user(), random.choice([1, 5])),
+        'get_all_users': lambda: database.get_all_users(),
+        'get_payment_info': lambda: database.get_payment_info(random.choice(samples['pending_payments'])),
+        'get_pending_payments': lambda: database.get_pending_payments(),
+        'get_all_configs_with_users': lambda: database.get_all_configs_with_users(),
+        'get_dashboard_stats': lambda: database.get_dashboard_stats(),
+        'get_users_page': lambda: database.get_users_page(after=user()),
+        'get_users_page_search': lambda: database.get_users_page(random.choice([str(user())[:2], f"user{user()}"[:6]])),
+        'get_user_overview': lambda: database.get_user_overview(user()),
+        'search_tickets': lambda: database.search_tickets(random.choice(["اتصال", "مشکل", f"{random.randint(1, 999)}"])),
+        'get_user_tickets': lambda: database.get_user_tickets(ticket()[1]),
+        'get_user_tickets_list': lambda: database.get_user_tickets_list(ticket()[1]),
+        'get_formatted_user_tickets': lambda: database.get_formatted_user_tickets(ticket()[1]),
+        'get_all_tickets': lambda: database.get_all_tickets(),
+        'get_ticket_view': lambda: database.get_ticket_view(ticket()[0]),
+        'get_ticket_view_owner': lambda: database.get_ticket_view(*ticket()),
+        'get_subscription_version': lambda: database.get_subscription_version(samples['sub_id']),
+        'get_subscription_configs': lambda: database.get_subscription_configs(user()),
+        'get_qr_file_id': lambda: database.get_qr_file_id(config_row()[2], "0" * 16),
+        'get_depleted_marks': lambda: database.get_depleted_marks(),
+        'get_stale_payments': lambda: database.get_stale_payments(),
+        'load_bot_state': lambda: database.load_bot_state(),
+        # database.py - writes
+        'get_or_create_user': lambda: database.get_or_create_user(user(), "bench", "Bench", None),
+        'save_new_config': lambda: database.save_new_config(user(), new_email(), str(uuid.uuid4()), 10),
+        'save_new_configs': lambda: database.save_new_configs(
+            [(user(), new_email(), str(uuid.uuid4()), 1) for _ in range(10)]),
+        'log_status_check': lambda: database.log_status_check(config_row()[3], 4.5, 12),
+        'save_payment_request': lambda: database.save_payment_request(user(), 10, f"file_{uuid.uuid4().hex}"),
+        'set_payment_extension': lambda: database.set_payment_extension(
+            random.choice(samples['pending_payments']), {'email': None}),
+        'claim_payment': lambda: (lambda payment_id: (database.claim_payment(payment_id),
+                                                      database.release_payment(payment_id)))(
+            random.choice(samples['pending_payments'])),
+        'get_pending_payment_ids': lambda: database.get_pending_payment_ids(),
+        'resolve_payment_type': lambda: database.resolve_payment_type(
+            random.choice(samples['pending_payments']), None),
+        'reclaim_stale_payment': lambda: database.reclaim_stale_payment(random.choice(samples['pending_payments'])),
+        'record_payment_provision': lambda: database.record_payment_provision(
+            random.choice(samples['pending_payments']), new_email(), str(uuid.uuid4())),
+        'release_payments': lambda: database.release_payments(samples['pending_payments'][:25]),
+        'finish_payment': lambda: database.finish_payment(
+            random.choice(samples['pending_payments']), 'approved', None),
+        'finish_payments': lambda: database.finish_payments(
+            [(payment_id, 'approved', None, None) for payment_id in samples['pending_payments'][:25]]),
+        'get_payment_outcome': lambda: database.get_payment_outcome(random.choice(samples['pending_payments'])),
+        'update_payment_status': lambda: database.update_payment_status(
+            random.choice(samples['pending_payments']), 'pending'),
+        'update_config_active_status': lambda: database.update_config_active_status(
+            *config_row()[1::-1], True),
+        'update_notification_sent': lambda: database.update_notification_sent(config_row()[3]),
+        'update_config_total_gb': lambda: database.update_config_total_gb(*config_row()[1::-1], 0),
+        'update_depleted_marks': lambda: database.update_depleted_marks(
+            [config_row()[2] for _ in range(50)], [config_row()[2] for _ in range(50)]),
+        'deactivate_configs': lambda: database.deactivate_configs([str(uuid.uuid4()) for _ in range(50)]),
+        'create_ticket': lambda: database.create_ticket(user(), "bench subject"),
+        'add_ticket_message': lambda: database.add_ticket_message(ticket()[0], user(), "bench message", False),
+        'update_ticket_status': lambda: database.update_ticket_status(ticket()[0], 'open'),
+        'record_ticket_reply': lambda: database.record_ticket_reply(ticket()[0], user(), "bench reply", True),
+        'record_ticket_reply_owner': lambda: (lambda t: database.record_ticket_reply(
+            t[0], t[1], "bench reply", False, owner_id=t[1]))(ticket()),
+        'close_ticket': lambda: database.close_ticket(*ticket()),
+        'get_or_create_sub_id': lambda: database.get_or_create_sub_id(user()),
+        'save_qr_file_id': lambda: database.save_qr_file_id(config_row()[2], "0" * 16, f"file_{uuid.uuid4().hex}"),
+        'delete_qr_file_id': lambda: database.delete_qr_file_id(config_row()[2]),
+        'rebuild_dashboard_stats': lambda: database.rebuild_dashboard_stats(),
+        'write_state_changes': lambda: database.write_state_changes(
+            [('user', user(), 'selected_plan', b'bench'), ('user', user(), 'replying_to', None)]),
+        'load_user_state': lambda: database.load_user_state(),
+        # db_utils.py
+        'get_all_db_configs': lambda: db_utils.get_all_db_configs(),
+        'delete_config_by_client_id': lambda: db_utils.delete_config_by_client_id(str(uuid.uuid4())),
+        'get_configs_for_reconciliation': lambda: db_utils.get_configs_for_reconciliation(),
+        'apply_config_repairs': lambda: db_utils.apply_config_repairs(
+            [(config_row()[3], True, 10) for _ in range(100)]),
+    }
+
+def run_benchmark(func, repeat, budget):
+    """Call func up to `repeat` times or until `budget` seconds have passed"""
+    timings = []
+    deadline = time.perf_counter() + budget
+    while len(timings) < repeat:
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+        if time.perf_counter() > deadline:
+            break
+    return timings
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark database.py and db_utils.py")
+    parser.add_argument("--scale", type=int, action="append",
+                        help="number of users to generate (repeatable, default 10000)")
+    parser.add_argument("--repeat", type=int, default=20, help="maximum calls per function")
+    parser.add_argument("--budget", type=float, default=2.0, help="maximum seconds per function")
+    parser.add_argument("--only", action="append", help="benchmark only these functions")
+    parser.add_argument("--output", help="append JSON lines to this file instead of stdout")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    commit = current_commit()
+    out = open(args.output, "a") if args.output else sys.stdout
+    try:
+        for scale in args.scale or [10000]:
+            workdir = tempfile.mkdtemp(prefix="vpnbot_bench_")
+            # database and db_utils read DB_FILE at import time, so set it first
+            config.DB_FILE = os.path.join(workdir, f"bench_{scale}.db")
+            for module in ("database", "db_utils"):
+                if module in sys.modules:
+                    sys.modules[module].DB_FILE = config.DB_FILE
+
+            start = time.perf_counter()
+            samples = generate_database(config.DB_FILE, scale)
+            print(f"Generated scale {scale} in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+            for name, func in build_benchmarks(samples).items():
+                if args.only and name not in args.only:
+                    continue
+                timings = run_benchmark(func, args.repeat, args.budget)
+                record = {
+                    "commit": commit,
+                    "scale": scale,
+                    "function": name,
+                    "runs": len(timings),
+                    "mean_ms": round(statistics.fmean(timings) * 1000, 3),
+                    "p50_ms": round(statistics.median(timings) * 1000, 3),
+                    "min_ms": round(min(timings) * 1000, 3),
+                    "max_ms": round(max(timings) * 1000, 3),
+                }
+                out.write(json.dumps(record) + "\n")
+                out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+if __name__ == '__main__':
+    main()
@@ -2,11 +2,14 @@
 VPN Telegram Bot
 A bot for managing VPN services through Telegram
 """
+import asyncio
 import logging
 import random
+import re
 import string
 import time
 import uuid
+import weakref
 from datetime import timedelta
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
@@ -19,27 +22,50 @@ from telegram.ext import (
     filters
 )
 from telegram import MenuButtonCommands
+from telegram.request import HTTPXRequest
 
 
 from client_management import show_all_clients, confirm_delete_client, delete_client_handler, cancel_delete_client
 # Import our modules
-from config import BOT_TOKEN, ADMIN_IDS, IPDOMAIN, PORT, HOST, SNI, DB_FILE, ALLOW_BUY, payment_msg
+from config import BOT_TOKEN, ADMIN_IDS, DB_FILE, ALLOW_BUY, payment_msg, METRICS_PORT, \
+    BULK_APPROVAL_WORKERS, SUBSCRIPTION_PORT, SUBSCRIPTION_HOST, SUBSCRIPTION_BASE_URL
 from database import (
     init_db, get_or_create_user, get_user_configs, save_new_config,
     update_config_active_status, get_client_id_by_email, check_trial_usage,
-    save_payment_request, get_all_users,
-    create_ticket, add_ticket_message, close_ticket, update_ticket_status, verify_ticket_access,
-    get_formatted_user_tickets, get_ticket_conversation, get_payment_info, update_payment_status,
-    get_pending_payments, update_config_total_gb, get_all_configs_with_users
+    save_new_configs, save_payment_request, get_all_users,
+    create_ticket, add_ticket_message, record_ticket_reply, close_ticket,
+    get_formatted_user_tickets, get_ticket_view, claim_payment, release_payment, reclaim_stale_payment,
+    record_payment_provision, get_stale_payments,
+    get_pending_payment_ids, resolve_payment_type, finish_payment, get_payment_outcome, get_pending_payments, update_config_total_gb,
+    get_all_configs_with_users, get_all_tickets, set_payment_extension, get_dashboard_stats, get_users_page, get_user_overview,
+    search_tickets, get_or_create_sub_id
 )
 from menus import (
     VPN_PLANS, get_main_menu_keyboard, get_free_trial_keyboard, get_vpn_plans_keyboard,
     get_back_to_main_button, get_configs_keyboard, get_config_status_keyboard,
     get_admin_approval_keyboard, get_support_keyboard, get_admin_menu_keyboard, get_vpn_extend_plans_keyboard,
-    get_buy_allow_keyboard, get_extend_all_client_day
+    get_buy_allow_keyboard, get_extend_all_client_day, get_bulk_gift_keyboard, BULK_GIFT_PRESETS,
+    get_cleanup_keyboard
 )
-from xui_api import get_client_status, create_client, extend_client
+from xui_api import get_client_status, create_client, create_clients, extend_client, get_online_clients
+from db_utils import get_all_db_configs
+from config_links import generate_vless_link
+from subscription_server import start_subscription_server
+from qr_codes import send_config_qr, QR_AVAILABLE
+from message_edits import safe_edit
 from notification_service import start_notification_service
+import metrics
+import profiler
+import reconciliation
+import client_cleanup
+from admin_notifications import notify_admins
+from persistence import SQLitePersistence, TrackedDict
+import conversation_state
+from conversation_state import (
+    set_state, get_state, clear_state,
+    AWAITING_RECEIPT, AWAITING_TICKET_SUBJECT, AWAITING_REPLY, AWAITING_BROADCAST, AWAITING_USER_SEARCH,
+    AWAITING_TICKET_SEARCH
+)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO,
@@ -50,14 +76,6 @@ def random_suffix(length=6):
     """Generate a random suffix for email addresses"""
     return ''.join(random.choices(string.ascii_lowercase + string.digits, k=length))
 
-def generate_vless_link(client_id, email):
-    """Generate a VLESS link for the client"""
-    return (
-        f"vless://{client_id}@{IPDOMAIN}:{PORT}"
-        f"?type=ws&path=%2F&host={HOST}&security=tls&fp=firefox&alpn=h3%2Ch2%2Chttp%2F1.1&sni={SNI}"
-        f"#{email}"
-    )
-
 # Command handlers
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle the /start command"""
@@ -83,6 +101,42 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=get_admin_menu_keyboard()
     )
 
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the /profile [seconds] command by profiling the running bot"""
+    user_id = update.effective_user.id
+    if user_id not in ADMIN_IDS:
+        await update.message.reply_text("شما اجازه دسترسی به این بخش را ندارید.")
+        return
+
+    seconds = 30
+    if context.args:
+        try:
+            seconds = int(context.args[0])
+        except ValueError:
+            await update.message.reply_text("لطفاً مدت زمان را به ثانیه وارد کنید، مثلا: /profile 30")
+            return
+    seconds = max(1, min(seconds, profiler.MAX_CAPTURE_SECONDS))
+
+    await update.message.reply_text(f"⏱️ پروفایل گیری به مدت {seconds} ثانیه شروع شد...")
+
+    try:
+        result = await profiler.capture(seconds)
+    except profiler.ProfilerBusyError:
+        await update.message.reply_text("⚠️ یک پروفایل گیری دیگر در حال اجراست.")
+        return
+    except Exception as e:
+        logger.error(f"Profile capture failed: {e}")
+        await update.message.reply_text(f"❌ خطا در پروفایل گیری: {e}")
+        return
+
+    await update.message.reply_text(result['summary'][-4000:])
+    timestamp = time.strftime('%Y%m%d_%H%M%S')
+    await update.message.reply_document(document=result['profile'], filename=f"bot_{timestamp}.prof",
+                                        caption="📊 فایل pstats (snakeviz / python -m pstats)")
+    await update.message.reply_document(document=result['stacks'].encode("utf-8"),
+                                        filename=f"bot_{timestamp}_stacks.txt",
+                                        caption="🧵 نمونه های ترد ها و تسک های asyncio")
+
 async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle the /broadcast command"""
     user_id = update.effective_user.id
@@ -123,11 +177,78 @@ async def support_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=get_support_keyboard()
     )
 
+# Pending payments listed at once; the 100-button keyboard limit caps this
+PENDING_LIST_LIMIT = 20
+# Extension target in receipt captions written by older versions
+LEGACY_EXTENSION_CAPTION = re.compile(r"تمدید برای: (\S+)")
+# Payments stuck in processing listed at once for an admin check
+STALE_PAYMENT_LIST_LIMIT = 5
+# Online clients listed at once in the admin view
+ONLINE_LIST_LIMIT = 50
+# Users listed per page in the admin user browser
+USER_PAGE_SIZE = 10
+# Tickets listed per page of admin ticket search results
+TICKET_SEARCH_PAGE_SIZE = 10
+# Telegram's limit on message text length, in UTF-16 code units
+MESSAGE_TEXT_LIMIT = 4096
+# Ticket messages loaded per ticket view, and characters shown per message and subject
+TICKET_MESSAGE_WINDOW = 10
+TICKET_MESSAGE_PREVIEW = 1000
+TICKET_SUBJECT_PREVIEW = 200
+
+# Callback data prefixes followed by an id, an email or a page number.
+# Used to keep the metrics route label bounded; longer prefixes first.
+CALLBACK_ROUTE_PREFIXES = (
+    "admin_confirm_delete_", "admin_cancel_delete_", "admin_delete_client_", "admin_clients_page_",
+    "admin_view_ticket_", "admin_extend_all_", "admin_buy_allow_", "admin_bulk_gift_",
+    "admin_pending_toggle_", "admin_payment_retry_", "admin_cleanup_confirm_", "admin_users_n_", "admin_users_p_", "admin_user_", "admin_ticket_search_page_",
+    "support_ticket_", "support_reply_", "support_close_", "view_receipt_",
+    "extend_gb_", "approve_", "reject_", "status_", "free_", "gb_",
+)
+
+def _callback_route(data):
+    """Map callback data to a bounded route name for metrics"""
+    for prefix in CALLBACK_ROUTE_PREFIXES:
+        if data.startswith(prefix):
+            return prefix + "*"
+    if data.replace("_", "").isalpha():
+        return data
+    return "other"
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that records Bot API latency and in-flight requests"""
+
+    async def do_request(self, url, *args, **kwargs):
+        method = url.rsplit("/", 1)[-1]
+        metrics.BOT_API_INFLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            return await super().do_request(url, *args, **kwargs)
+        finally:
+            metrics.BOT_API_INFLIGHT.dec()
+            metrics.BOT_API_DURATION.observe(time.perf_counter() - start, method)
+
 # Callback query handlers
 async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle all callback queries"""
+    """Handle all callback queries, recording latency per route"""
+    route = _callback_route(update.callback_query.data or "")
+    start = time.perf_counter()
+    try:
+        await dispatch_callback(update, context)
+    except Exception:
+        metrics.CALLBACK_ERRORS.inc(route)
+        raise
+    finally:
+        metrics.CALLBACK_DURATION.observe(time.perf_counter() - start, route)
+
+# Callbacks whose handlers answer the query themselves, e.g. with a toast
+SELF_ANSWERED_CALLBACKS = {"refresh_status"}
+
+async def dispatch_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Route a callback query to its handler"""
     query = update.callback_query
-    await query.answer()
+    if query.data not in SELF_ANSWERED_CALLBACKS:
+        await query.answer()
 
     data = query.data
     user_id = query.from_user.id
@@ -149,6 +270,8 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await refresh_config_status(query, context)
     elif data == "extend_config":
         await show_extend_options(query, context)
+    elif data == "config_qr":
+        await send_status_qr(query, context)
     elif data.startswith("extend_gb_"):
         await handle_extend_selection(query, data, user_id, context)
     elif data.startswith("status_"):
@@ -196,7 +319,11 @@ async def handle_check_status(query, user_id):
     await query.edit_message_text("لطفا سرویس مورد نظر را انتخاب کنید:", reply_markup=reply_markup)
 
 async def handle_show_status(query, email, user_id):
-    """Show the status of a specific configuration"""
+    """Show the status of a specific configuration
+
+    Returns:
+        bool: False if the message already showed this status and was left as is
+    """
     client_id = get_client_id_by_email(email, user_id)
 
     if not client_id:
@@ -213,18 +340,29 @@ async def handle_show_status(query, email, user_id):
 
     vless_link = generate_vless_link(client_id, email)
 
+    # Shared cached listing, so this is usually not a panel request
+    online = await asyncio.to_thread(get_online_clients)
+    online_line = ""
+    if online is not None:
+        online_line = "🟢 اتصال: آنلاین\n" if email in online else "⚪ اتصال: آفلاین\n"
+
     status_icon = "✅" if status['is_active'] else "❌"
     message = (
         f"{status_icon} وضعیت سرویس:\n"
         f"📧 نام: `{email}`\n"
         f"📊 حجم باقیمانده: {status['remaining_gb']} گیگابایت از {status['total_gb']} گیگابایت\n"
         f"⏳ زمان باقیمانده: {status['remaining_time_display']} (تا {status['expiry_date']})\n"
-        f"🔌 وضعیت: {'فعال' if status['is_active'] else 'غیرفعال'}\n\n"
+        f"🔌 وضعیت: {'فعال' if status['is_active'] else 'غیرفعال'}\n"
+        f"{online_line}\n"
         f"🔗 لینک کانفیگ:\n`{vless_link}`"
     )
+    if SUBSCRIPTION_BASE_URL:
+        sub_id = get_or_create_sub_id(user_id)
+        if sub_id:
+            message += f"\n\n🔄 لینک اشتراک (همه سرویس‌ها، با تغییر سرور به‌روز می‌شود):\n`{SUBSCRIPTION_BASE_URL}{sub_id}`"
 
-    reply_markup = get_config_status_keyboard()
-    await query.edit_message_text(message, parse_mode="Markdown", reply_markup=reply_markup)
+    reply_markup = get_config_status_keyboard(show_qr=QR_AVAILABLE)
+    return await safe_edit(query, message, reply_markup=reply_markup, parse_mode="Markdown")
 
 async def handle_buy_service(query, user_id):
     """Handle the buy service option"""
@@ -258,7 +396,7 @@ async def handle_plan_selection(query, plan_data, user_id, context: ContextTypes
         await query.edit_message_text("پلن نامعتبر است.", reply_markup=reply_markup)
         return
 
-    context.user_data['selected_plan'] = plan
+    set_state(context.user_data, AWAITING_RECEIPT, plan=plan)
     keyboard = get_back_to_main_button()
     reply_markup = InlineKeyboardMarkup(keyboard)
 
@@ -333,7 +471,8 @@ async def handle_free_trial(query, data, user_id, context: ContextTypes.DEFAULT_
 async def handle_receipt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle receipt photos sent by users"""
     keyboard = get_back_to_main_button()
-    if 'selected_plan' not in context.user_data:
+    receipt_state = get_state(context.user_data, AWAITING_RECEIPT)
+    if receipt_state is None:
         await update.message.reply_text("لطفاً ابتدا یک پلن انتخاب کنید.", reply_markup=InlineKeyboardMarkup(keyboard))
         return
 
@@ -342,33 +481,44 @@ async def handle_receipt(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     photo = update.message.photo[-1]
-    plan = context.user_data['selected_plan']
+    plan = receipt_state['plan']
     user_id = update.effective_user.id
 
     # Get additional info if this is an extension
     is_extension = plan.get('is_extension', False)
     extension_email = plan.get('email', None) if is_extension else None
+    extension = None
+    if is_extension:
+        extension = {
+            'email': extension_email,
+            'client_id': receipt_state.get('extension_client_id', ''),
+            'gb': plan['gb'],
+            'days': plan.get('days', 30)
+        }
 
-    # Save payment request
-    payment_id = save_payment_request(user_id, plan['gb'], photo.file_id)
-
-    # Notify admins
-    for admin_id in ADMIN_IDS:
-        try:
-            # Include extension info in the caption if applicable
-            extension_info = f"\nتمدید برای: {extension_email}" if is_extension else ""
-
-            await context.bot.send_photo(
-                chat_id=admin_id,
-                photo=photo.file_id,
-                caption=f"درخواست پرداخت جدید:\n"
-                        f"کاربر: {update.effective_user.full_name}\n"
-                        f"پلن: {plan['name']}{extension_info}\n"
-                        f"شناسه پرداخت: {payment_id}",
-                reply_markup=get_admin_approval_keyboard(payment_id)
-            )
-        except Exception as e:
-            logger.error(f"Error notifying admin {admin_id}: {e}")
+    # Save payment request, keeping the extension target with it and flagging resubmitted receipts
+    payment_id, duplicate = save_payment_request(
+        user_id, plan['gb'], photo.file_id, extension,
+        receipt_unique_id=photo.file_unique_id
+    )
+    if duplicate:
+        logger.warning(f"Payment {payment_id} from user {user_id} reuses the receipt of payment {duplicate[0]}")
+
+    # Include extension and duplicate info in the caption if applicable
+    extension_info = f"\nتمدید برای: {extension_email}" if is_extension else ""
+    duplicate_info = (f"\n⚠️ این فیش قبلاً با شناسه پرداخت {duplicate[0]} ({PAYMENT_STATUS_LABELS.get(duplicate[1], duplicate[1])}) ارسال شده است!"
+                      if duplicate else "")
+
+    # Notify admins in the background
+    notify_admins(
+        context.application, "send_photo",
+        photo=photo.file_id,
+        caption=f"درخواست پرداخت جدید:\n"
+                f"کاربر: {update.effective_user.full_name}\n"
+                f"پلن: {plan['name']}{extension_info}\n"
+                f"شناسه پرداخت: {payment_id}{duplicate_info}",
+        reply_markup=get_admin_approval_keyboard(payment_id)
+    )
 
     # Send confirmation message based on request type
     if is_extension:
@@ -380,23 +530,7 @@ async def handle_receipt(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await update.message.reply_text(message, reply_markup=InlineKeyboardMarkup(keyboard))
 
-    # Store extension details in the database or in a persistent context
-    if is_extension:
-        import json
-        if not hasattr(context.bot_data, 'extension_requests'):
-            context.bot_data['extension_requests'] = {}
-
-        # Store extension details with payment_id as key
-        context.bot_data['extension_requests'][str(payment_id)] = {
-            'email': extension_email,
-            'gb_amount': plan['gb'],
-            'client_id': context.user_data.get('extension_details', {}).get('client_id', '')
-        }
-
-    # Clean up user data
-    del context.user_data['selected_plan']
-    if 'extension_details' in context.user_data:
-        del context.user_data['extension_details']
+    clear_state(context.user_data)
 
 # Admin handling functions
 async def handle_admin_extend_all(query, context, data):
@@ -423,6 +557,85 @@ async def handle_admin_extend_all(query, context, data):
         await query.edit_message_text(f"{c} کلاینت افزایش داده شدند", reply_markup=key)
 
 
+async def handle_admin_bulk_gift(query, context, data):
+    """Pre-generate a batch of gift configs with a single panel request"""
+    if query.from_user.id not in ADMIN_IDS:
+        await query.answer("دسترسی رد شد.")
+        return
+    if data == "admin_bulk_gift":
+        await query.edit_message_text("تعداد و نوع کانفیگ های هدیه را انتخاب کنید:",
+                                      reply_markup=get_bulk_gift_keyboard())
+        return
+
+    count, gb_amount, days = (int(part) for part in data.replace("admin_bulk_gift_", "").split("_"))
+    if (count, gb_amount, days) not in BULK_GIFT_PRESETS:
+        await query.edit_message_text("گزینه نامعتبر.", reply_markup=get_bulk_gift_keyboard())
+        return
+
+    await query.edit_message_text(f"⏳ در حال ساخت {count} کانفیگ هدیه...")
+
+    total_bytes = gb_amount * 1024 ** 3
+    expiry_time = int(time.time() + days * 86400) * 1000
+    specs = [
+        {'email': f"gift_{random_suffix(8)}@gift_{gb_amount}_gb", 'total_gb': total_bytes, 'expiry_time_ms': expiry_time}
+        for _ in range(count)
+    ]
+
+    created, failed = await asyncio.to_thread(create_clients, specs)
+
+    # Gift configs are owned by the admin who generated them until handed out
+    admin_id = query.from_user.id
+    saved = save_new_configs([(admin_id, email, client_id, gb_amount) for email, client_id in created])
+    if saved != len(created):
+        logger.error(f"Bulk gift: {len(created)} clients created on panel but {saved} saved to database")
+
+    if created:
+        links = "\n\n".join(generate_vless_link(client_id, email) for email, client_id in created)
+        await context.bot.send_document(
+            chat_id=admin_id,
+            document=links.encode("utf-8"),
+            filename=f"gift_{gb_amount}gb_{days}d_{len(created)}.txt",
+            caption=f"🎁 {len(created)} کانفیگ هدیه {gb_amount}GB / {days} روزه"
+        )
+
+    message = f"✅ {len(created)} کانفیگ ساخته شد."
+    if failed:
+        message += f"\n❌ {len(failed)} کانفیگ ساخته نشد: {failed[0][1]}"
+    if saved != len(created):
+        message += (f"\n⚠️ {len(created) - saved} کانفیگ در پنل ساخته شد اما در دیتابیس ذخیره نشد؛ "
+                    f"لینک‌ها در فایل بالا هستند. همگام‌سازی پنل را بررسی کنید.")
+    key = InlineKeyboardMarkup([[InlineKeyboardButton("برگشت", callback_data="admin_menu")]])
+    await query.edit_message_text(message, reply_markup=key)
+
+
+async def handle_admin_reconcile(query, data):
+    """Show panel/database drift, and repair the database after confirmation"""
+    repair = data == "admin_reconcile_repair"
+    await query.edit_message_text("⏳ در حال مقایسه پنل و دیتابیس...")
+
+    report = await asyncio.to_thread(reconciliation.reconcile, repair)
+
+    keyboard = []
+    if not repair and reconciliation.has_repairs(report):
+        keyboard.append([InlineKeyboardButton("🛠 اصلاح دیتابیس", callback_data="admin_reconcile_repair")])
+    keyboard.append([InlineKeyboardButton("🔄 بررسی مجدد", callback_data="admin_reconcile")])
+    keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data="admin_menu")])
+    await query.edit_message_text(reconciliation.format_report(report), reply_markup=InlineKeyboardMarkup(keyboard))
+
+async def handle_admin_cleanup(query, data):
+    """Show which clients cleanup would remove, and remove them after confirmation"""
+    await query.edit_message_text("⏳ در حال بررسی کلاینت‌های منقضی...")
+
+    if data.startswith("admin_cleanup_confirm_"):
+        plan = await asyncio.to_thread(client_cleanup.run_cleanup, data[len("admin_cleanup_confirm_"):])
+    else:
+        plan = await asyncio.to_thread(client_cleanup.plan_cleanup)
+    if plan is None or 'removed' in plan:
+        reply_markup = get_cleanup_keyboard(0)
+    else:
+        reply_markup = get_cleanup_keyboard(client_cleanup.cleanup_count(plan), plan['plan_id'])
+    await query.edit_message_text(client_cleanup.format_plan(plan), reply_markup=reply_markup)
+
 async def handle_admin_callback(query, data, user_id, context: ContextTypes.DEFAULT_TYPE):
     """Handle admin panel callbacks"""
     if user_id not in ADMIN_IDS:
@@ -430,15 +643,55 @@ async def handle_admin_callback(query, data, user_id, context: ContextTypes.DEFA
         return
 
     if data == "admin_pending":
-        await show_pending_approvals(query)
+        await show_pending_approvals(query, context)
+    elif data.startswith("admin_pending_toggle_"):
+        await toggle_pending_selection(query, context, int(data.split("_")[3]))
+    elif data.startswith("admin_payment_retry_"):
+        await retry_stale_payment(query, int(data.split("_")[3]), context)
+    elif data.startswith("admin_bulk_approve"):
+        await handle_admin_bulk_approve(query, context, data)
     elif data == "admin_users":
-        await show_all_users(query)
+        context.user_data.pop('user_search', None)
+        await show_users_page(query, context)
+    elif data == "admin_users_back":
+        await show_users_page(query, context, **context.user_data.get('user_page', {}))
+    elif data.startswith("admin_users_n_"):
+        await show_users_page(query, context, after=int(data.split("_")[3]))
+    elif data.startswith("admin_users_p_"):
+        await show_users_page(query, context, before=int(data.split("_")[3]))
+    elif data == "admin_users_search":
+        set_state(context.user_data, AWAITING_USER_SEARCH)
+        await query.edit_message_text(
+            "🔍 یوزرنیم یا آیدی عددی کاربر (یا ابتدای آن) را وارد کنید:",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("❌ انصراف", callback_data="admin_users")]
+            ])
+        )
+    elif data.startswith("admin_user_"):
+        await show_user_details(query, int(data.split("_")[2]))
+    elif data == "admin_online":
+        await show_online_clients(query)
+    elif data == "admin_dashboard":
+        await show_dashboard(query)
     elif data == "admin_tickets":
         await show_all_tickets(query)
+    elif data.startswith("admin_ticket_search_page_"):
+        message, reply_markup = render_ticket_search(context.user_data.get('ticket_search', ''),
+                                                     int(data.split("_")[4]))
+        await query.edit_message_text(message, reply_markup=reply_markup)
+    elif data == "admin_ticket_search":
+        set_state(context.user_data, AWAITING_TICKET_SEARCH)
+        await query.edit_message_text(
+            "🔍 کلمات مورد نظر برای جستجو در تیکت‌ها را وارد کنید:\n"
+            "(برای جستجوی ابتدای کلمه از * استفاده کنید، مثلا اتص*)",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("❌ انصراف", callback_data="admin_tickets")]
+            ])
+        )
     elif data == "admin_manage_clients":
         await show_all_clients(query, context)
     elif data == "admin_broadcast":
-        context.user_data['awaiting_broadcast'] = True
+        set_state(context.user_data, AWAITING_BROADCAST)
         await query.edit_message_text(
             "لطفا پیام خود را برای ارسال به همه کاربران وارد کنید:",
             reply_markup=InlineKeyboardMarkup([
@@ -446,8 +699,8 @@ async def handle_admin_callback(query, data, user_id, context: ContextTypes.DEFA
             ])
         )
     elif data.startswith("admin_view_ticket_"):
-        ticket_id = int(data.split("_")[3])
-        await show_ticket_messages_admin(query, ticket_id)
+        parts = data.split("_")
+        await show_ticket_messages_admin(query, int(parts[3]), **parse_ticket_window(parts[4:]))
     elif data == "admin_menu":
         await show_admin_menu(query)
     # Client management callbacks
@@ -467,6 +720,12 @@ async def handle_admin_callback(query, data, user_id, context: ContextTypes.DEFA
         await show_buy_allow(query, data)
     elif data.startswith("admin_extend_all"):
         await handle_admin_extend_all(query, context , data)
+    elif data.startswith("admin_bulk_gift"):
+        await handle_admin_bulk_gift(query, context, data)
+    elif data.startswith("admin_reconcile"):
+        await handle_admin_reconcile(query, data)
+    elif data.startswith("admin_cleanup"):
+        await handle_admin_cleanup(query, data)
 
 async def show_admin_menu(query):
     """Show the admin menu"""
@@ -497,15 +756,13 @@ async def show_buy_allow(query , data):
             "فروش فعال " + status_icon + "\n\n",
             reply_markup=get_buy_allow_keyboard()
         )
-async def show_pending_approvals(query, context: ContextTypes.DEFAULT_TYPE = None):
-    """Show all pending payment approvals"""
-    # Use the database function instead of direct SQL queries
-    from database import get_pending_payments
-
+async def show_pending_approvals(query, context: ContextTypes.DEFAULT_TYPE):
+    """Show pending payment approvals with per-payment and bulk actions"""
     pending_payments = get_pending_payments()
+    stale_payments = get_stale_payments()
 
-
-    if not pending_payments:
+    if not pending_payments and not stale_payments:
+        context.user_data.pop('pending_selection', None)
         await query.edit_message_text(
             "هیچ درخواست در انتظار تأییدی وجود ندارد.",
             reply_markup=InlineKeyboardMarkup([
@@ -514,31 +771,37 @@ async def show_pending_approvals(query, context: ContextTypes.DEFAULT_TYPE = Non
         )
         return
 
-    # Store receipt file IDs in context.user_data if context is provided
-    if context and not hasattr(context.bot_data, 'receipt_file_ids'):
-        context.bot_data['receipt_file_ids'] = {}
+    # Drop selections of payments that were processed in the meantime
+    pending_ids = {payment[0] for payment in pending_payments}
+    selection = [payment_id for payment_id in context.user_data.get('pending_selection', [])
+                 if payment_id in pending_ids]
+    context.user_data['pending_selection'] = selection
 
-    message = "درخواست‌های در انتظار تأیید:\n\n"
+    message = f"درخواست‌های در انتظار تأیید ({len(pending_payments)}):\n\n"
     keyboard = []
 
-    for payment in pending_payments:
-        payment_id, user_id, plan, first_name, username, receipt_file_id = payment
+    # Only the oldest payments fit in one message; "approve all" covers the rest
+    for payment in pending_payments[:PENDING_LIST_LIMIT]:
+        payment_id, user_id, plan, first_name, username, receipt_file_id, duplicate_of, type_unknown = payment
         user_display = f"{first_name} (@{username})" if username else f"{first_name} (بدون یوزرنیم)"
 
-        # Store the file_id in context for later retrieval if context is provided
-        if context:
-            context.bot_data['receipt_file_ids'][str(payment_id)] = receipt_file_id
-
         message += (
             f"🆔 {payment_id}\n"
             f"👤 کاربر: {user_display}\n"
-            f"📝 پلن: {plan}\n\n"
+            f"📝 پلن: {plan}\n"
         )
+        if duplicate_of:
+            message += f"⚠️ فیش تکراری (پرداخت {duplicate_of})\n"
+        if type_unknown:
+            message += "❔ ثبت‌شده پیش از به‌روزرسانی؛ خرید یا تمدید بودن آن مشخص نیست (از پیام اصلی رسید تأیید شود)\n"
+        message += "\n"
 
-        # Add approval/rejection buttons
+        # Add approval/rejection buttons and the bulk selection toggle
         keyboard.append([
             InlineKeyboardButton(f"تأیید {payment_id}", callback_data=f"approve_{payment_id}"),
-            InlineKeyboardButton(f"رد {payment_id}", callback_data=f"reject_{payment_id}")
+            InlineKeyboardButton(f"رد {payment_id}", callback_data=f"reject_{payment_id}"),
+            InlineKeyboardButton(f"{'☑️' if payment_id in selection else '⬜'} {payment_id}",
+                                 callback_data=f"admin_pending_toggle_{payment_id}")
         ])
 
         # Add button to view receipt again with a simpler callback data
@@ -547,6 +810,26 @@ async def show_pending_approvals(query, context: ContextTypes.DEFAULT_TYPE = Non
                 InlineKeyboardButton(f"🧾 مشاهده رسید {payment_id}", callback_data=f"view_receipt_{payment_id}")
             ])
 
+    if len(pending_payments) > PENDING_LIST_LIMIT:
+        message += f"... و {len(pending_payments) - PENDING_LIST_LIMIT} درخواست دیگر\n"
+
+    # Approvals that never finished; retrying checks the panel before provisioning
+    if stale_payments:
+        message += f"\n⏳ پردازش ناتمام ({len(stale_payments)}) - قبل از تکرار، پنل بررسی می‌شود:\n"
+    for payment_id, user_id, plan, first_name, username, claimed_at in stale_payments[:STALE_PAYMENT_LIST_LIMIT]:
+        user_display = f"{first_name} (@{username})" if username else first_name
+        message += f"🆔 {payment_id} | {user_display} | پلن {plan} | از {claimed_at}\n"
+        keyboard.append([InlineKeyboardButton(f"🔁 بررسی و تکمیل {payment_id}",
+                                              callback_data=f"admin_payment_retry_{payment_id}")])
+
+    if selection:
+        keyboard.append([InlineKeyboardButton(f"✅ تأیید انتخاب‌شده‌ها ({len(selection)})",
+                                              callback_data="admin_bulk_approve_selected")])
+    # Resubmitted receipts are left out of approve-all
+    approvable = sum(1 for payment in pending_payments if not payment[6])
+    if approvable:
+        keyboard.append([InlineKeyboardButton(f"✅ تأیید همه ({approvable})",
+                                              callback_data="admin_bulk_approve_all")])
     keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data="admin_menu")])
 
     await query.edit_message_text(
@@ -554,77 +837,316 @@ async def show_pending_approvals(query, context: ContextTypes.DEFAULT_TYPE = Non
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
-async def show_all_users(query):
-    """Show all users"""
-    import sqlite3
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-
-    cursor.execute('''
-    SELECT u.user_id, u.first_name, u.username, COUNT(c.config_id), MAX(c.created_at)
-    FROM users u
-    LEFT JOIN configs c ON u.user_id = c.user_id
-    GROUP BY u.user_id
-    ORDER BY MAX(c.created_at) DESC NULLS LAST
-    LIMIT 50
-    ''')
-
-    users = cursor.fetchall()
-    conn.close()
-
-    if not users:
+async def toggle_pending_selection(query, context: ContextTypes.DEFAULT_TYPE, payment_id):
+    """Add or remove a payment from the admin's bulk approval selection"""
+    selection = context.user_data.setdefault('pending_selection', [])
+    if payment_id in selection:
+        selection.remove(payment_id)
+    else:
+        selection.append(payment_id)
+    await show_pending_approvals(query, context)
+
+async def handle_admin_bulk_approve(query, context: ContextTypes.DEFAULT_TYPE, data):
+    """Start a bulk approval of the selected or of all pending payments"""
+    if data == "admin_bulk_approve_all":
+        payment_ids, duplicates = get_pending_payment_ids()
+        skipped = f"\n⚠️ {duplicates} پرداخت با فیش تکراری کنار گذاشته می‌شود و باید تکی بررسی شود." if duplicates else ""
         await query.edit_message_text(
-            "هیچ کارب��ی یافت نشد.",
+            f"همه {len(payment_ids)} پرداخت در انتظار تأیید شوند؟{skipped}",
             reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 بازگشت", callback_data="admin_menu")]
+                [InlineKeyboardButton("✅ بله، تأیید همه", callback_data="admin_bulk_approve_confirm")],
+                [InlineKeyboardButton("🔙 بازگشت", callback_data="admin_pending")]
             ])
         )
         return
 
-    message = "👥 لیست کاربران:\n\n"
+    if data == "admin_bulk_approve_confirm":
+        payment_ids = None
+        description = "همه پرداخت‌های در انتظار"
+    else:
+        payment_ids = context.user_data.pop('pending_selection', [])
+        if not payment_ids:
+            await show_pending_approvals(query, context)
+            return
+        description = f"{len(payment_ids)} پرداخت انتخاب‌شده"
 
-    for user in users:
-        user_id, first_name, username, config_count, last_created = user
-        username_display = f"@{username}" if username else "بدون یوزرنیم"
-        last_config = last_created if last_created else "ندارد"
+    context.application.create_task(run_bulk_approval(context, query.from_user.id, payment_ids))
+    await query.edit_message_text(
+        f"⏳ تأیید {description} شروع شد.\nپس از پایان، گزارش برای شما ارسال می‌شود.",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data="admin_menu")]])
+    )
 
-        message += (
-            f"👤 {first_name} ({username_display})\n"
-            f"🆔 {user_id}\n"
-            f"🔢 تعداد کانفیگ: {config_count}\n"
-            f"📅 آخرین کانفیگ: {last_config}\n\n"
-        )
+async def run_bulk_approval(context: ContextTypes.DEFAULT_TYPE, admin_id, payment_ids=None):
+    """Provision pending payments on a bounded worker pool and report once when done
+
+    Each payment is claimed only when a worker picks it up and its outcome is
+    written as soon as it is provisioned, so no claim ages while queued and a
+    crash never leaves an already provisioned payment unrecorded.
+
+    Args:
+        context: Callback context, used to message users and the admin
+        admin_id (int): Admin who started the run; receives the summary
+        payment_ids (list, optional): Payments to approve; all pending payments
+            except resubmitted receipts if None
+    """
+    started = time.perf_counter()
+    duplicates = 0
+    if payment_ids is None:
+        payment_ids, duplicates = get_pending_payment_ids()
+    semaphore = asyncio.Semaphore(BULK_APPROVAL_WORKERS)
+    approved, rejected, failed, notify_failed, already_processed, type_unknown = [], [], [], [], [], []
+
+    async def approve(payment_id):
+        async with semaphore:
+            async with _payment_lock(payment_id):
+                payment_info = claim_payment(payment_id)
+                if not payment_info:
+                    outcome = get_payment_outcome(payment_id)
+                    if outcome and outcome[0] == 'pending' and outcome[3]:
+                        type_unknown.append(payment_id)
+                    else:
+                        already_processed.append(payment_id)
+                    return
+                try:
+                    outcome = await asyncio.to_thread(provision_payment, payment_id, payment_info)
+                except ExtensionConfigMissing:
+                    finish_payment(payment_id, 'rejected', "extension config not found", admin_id)
+                    rejected.append(payment_id)
+                    outcome = None
+                except Exception as e:
+                    logger.error(f"Bulk approval of payment {payment_id} failed: {e}")
+                    # Safe to retry: the next attempt checks the panel for what this one recorded
+                    release_payment(payment_id)
+                    failed.append((payment_id, str(e)))
+                    return
+                else:
+                    finish_payment(payment_id, 'approved', outcome['email'], admin_id)
+                    approved.append(payment_id)
 
-    # Add navigation
-    await query.edit_message_text(
-        message,
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("🔙 بازگشت", callback_data="admin_menu")]
-        ])
+        try:
+            if outcome is None:
+                await notify_extension_missing(context, payment_info[0])
+            else:
+                await notify_payment_approved(context, outcome)
+        except Exception as e:
+            logger.error(f"Error notifying user about approved payment {payment_id}: {e}")
+            notify_failed.append(payment_id)
+
+    await asyncio.gather(*(approve(payment_id) for payment_id in payment_ids))
+
+    elapsed = time.perf_counter() - started
+    logger.info(f"Bulk approval by {admin_id}: {len(approved)} approved, {len(rejected)} rejected, "
+                f"{len(failed)} failed in {elapsed:.1f}s")
+
+    summary = (f"📋 گزارش تأیید گروهی\n\n"
+               f"✅ تأیید شده: {len(approved)}\n"
+               f"❌ ناموفق (بازگشت به صف انتظار): {len(failed)}\n"
+               f"⏱ زمان: {elapsed:.1f} ثانیه")
+    if rejected:
+        summary += f"\n🚫 رد شده (کانفیگ تمدید یافت نشد): {len(rejected)}"
+    if already_processed:
+        summary += f"\n⏭ قبلاً پردازش شده: {len(already_processed)}"
+    if duplicates:
+        summary += f"\n⚠️ فیش تکراری (تأیید نشد، تکی بررسی شود): {duplicates}"
+    if type_unknown:
+        summary += (f"\n❔ نوع نامشخص (پیش از به‌روزرسانی؛ از پیام اصلی رسید تأیید شود): "
+                    f"{', '.join(map(str, type_unknown[:20]))}")
+    if notify_failed:
+        summary += f"\n⚠️ ارسال پیام به کاربر ناموفق: {', '.join(map(str, notify_failed[:20]))}"
+    for payment_id, error in failed[:10]:
+        summary += f"\n• {payment_id}: {error}"
+
+    await context.bot.send_message(
+        chat_id=admin_id,
+        text=summary,
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("📊 درخواست‌های در انتظار",
+                                                                 callback_data="admin_pending")]])
+    )
+
+async def show_dashboard(query):
+    """Show the admin overview from the precomputed aggregates"""
+    stats = get_dashboard_stats()
+    counters = stats['counters']
+
+    def count(name):
+        return int(counters.get(name, 0))
+
+    message = (
+        "📈 داشبورد\n\n"
+        f"👥 کاربران: {count('users')} (دارای کانفیگ فعال: {count('active_users')})\n"
+        f"🔌 کانفیگ‌های فعال: {count('active_configs')}\n"
+        f"📊 پرداخت‌های در انتظار: {count('payments_pending')}\n"
+        f"🎫 تیکت‌های باز: {count('tickets_open') + count('tickets_answered')} "
+        f"(منتظر پاسخ: {count('tickets_open')})\n"
+        f"📦 حجم فروخته‌شده: {counters.get('traffic_sold_gb', 0):g} گیگابایت\n\n"
+        "📅 پرداخت‌های تأییدشده در ۷ روز اخیر:\n"
+    )
+
+    days = {}
+    for day, plan, approvals, gb in stats['daily']:
+        days.setdefault(day, []).append(f"{plan}GB×{approvals}")
+    if days:
+        message += "\n".join(f"{day}: {', '.join(plans)}" for day, plans in days.items())
+    else:
+        message += "موردی وجود ندارد."
+
+    await query.edit_message_text(message, reply_markup=InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔄 به‌روزرسانی", callback_data="admin_dashboard")],
+        [InlineKeyboardButton("🔙 بازگشت", callback_data="admin_menu")]
+    ]))
+
+async def show_online_clients(query):
+    """Show the clients connected right now with the users they belong to"""
+    online = await asyncio.to_thread(get_online_clients)
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔄 به‌روزرسانی", callback_data="admin_online")],
+        [InlineKeyboardButton("🔙 بازگشت", callback_data="admin_menu")]
+    ])
+    if online is None:
+        await query.edit_message_text("❌ خطا در دریافت کاربران آنلاین از پنل.", reply_markup=keyboard)
+        return
+
+    # One query for all configs, then a dict lookup per connected client
+    configs = {config['email']: config for config in get_all_db_configs()}
+
+    lines = []
+    for email in sorted(online):
+        config = configs.get(email)
+        if config is None:
+            lines.append(f"• {email} (📱 فقط پنل)")
+            continue
+        username = f"@{config['username']}" if config['username'] else config['user_id']
+        lines.append(f"• {email} — {config['first_name'] or ''} ({username})")
+
+    message = f"🟢 کاربران آنلاین: {len(online)}\n\n"
+    message += "\n".join(lines[:ONLINE_LIST_LIMIT])
+    if len(lines) > ONLINE_LIST_LIMIT:
+        message += f"\n... و {len(lines) - ONLINE_LIST_LIMIT} مورد دیگر"
+    await query.edit_message_text(message, reply_markup=keyboard)
+
+def render_users_page(search=None, after=None, before=None):
+    """Build the text and keyboard of one page of the admin user browser
+
+    Returns:
+        tuple: (message text, InlineKeyboardMarkup)
+    """
+    users, has_more = get_users_page(search, after=after, before=before, limit=USER_PAGE_SIZE)
+
+    message = f"👥 نتایج جستجوی «{search}»:\n\n" if search else "👥 لیست کاربران:\n\n"
+    if not users:
+        message += "هیچ کاربری یافت نشد."
+
+    keyboard = []
+    for user_id, first_name, username, active_count in users:
+        username_display = f"@{username}" if username else "بدون یوزرنیم"
+        message += f"👤 {first_name} ({username_display})\n🆔 {user_id} — 🔢 کانفیگ فعال: {active_count}\n\n"
+        keyboard.append([InlineKeyboardButton(f"👤 {first_name or user_id}", callback_data=f"admin_user_{user_id}")])
+
+    # Moving backwards always has a next page, moving forwards has a previous one unless on the first page
+    has_previous = has_more if before is not None else after is not None
+    has_next = has_more if before is None else True
+    navigation_buttons = []
+    if users and has_previous:
+        navigation_buttons.append(InlineKeyboardButton("⬅️ قبلی", callback_data=f"admin_users_p_{users[0][0]}"))
+    if users and has_next:
+        navigation_buttons.append(InlineKeyboardButton("➡️ بعدی", callback_data=f"admin_users_n_{users[-1][0]}"))
+    if navigation_buttons:
+        keyboard.append(navigation_buttons)
+
+    keyboard.append([InlineKeyboardButton("🔍 جستجو", callback_data="admin_users_search")])
+    if search:
+        keyboard.append([InlineKeyboardButton("📋 همه کاربران", callback_data="admin_users")])
+    keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data="admin_menu")])
+    return message, InlineKeyboardMarkup(keyboard)
+
+async def show_users_page(query, context, after=None, before=None):
+    """Show one page of the admin user browser, keeping the current search"""
+    context.user_data['user_page'] = {'after': after, 'before': before}
+    message, reply_markup = render_users_page(context.user_data.get('user_search'), after, before)
+    await query.edit_message_text(message, reply_markup=reply_markup)
+
+PAYMENT_STATUS_LABELS = {
+    'pending': "⏳ در انتظار",
+    'processing': "🔄 در حال پردازش",
+    'approved': "✅ تایید شده",
+    'rejected': "❌ رد شده",
+}
+
+async def show_user_details(query, user_id):
+    """Show a user's configs and recent payments to an admin"""
+    overview = get_user_overview(user_id)
+    back_markup = InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔙 بازگشت به لیست", callback_data="admin_users_back")]
+    ])
+    if not overview:
+        await query.edit_message_text("کاربر یافت نشد.", reply_markup=back_markup)
+        return
+
+    _, username, first_name, last_name, join_date = overview['user']
+    username_display = f"@{username}" if username else "بدون یوزرنیم"
+    message = (
+        f"👤 {first_name or ''} {last_name or ''} ({username_display})\n"
+        f"🆔 {user_id}\n"
+        f"📅 عضویت: {join_date}\n\n"
+        "🔢 کانفیگ‌های اخیر:\n"
     )
+    for _, email, _, total_gb, is_active in overview['configs']:
+        status = "✅" if is_active else "❌"
+        message += f"{status} {email} — {total_gb} GB\n"
+    if not overview['configs']:
+        message += "ندارد\n"
+
+    message += "\n💳 پرداخت‌های اخیر:\n"
+    for payment_id, plan, status, submitted_at in overview['payments']:
+        message += f"#{payment_id} — {plan} GB — {PAYMENT_STATUS_LABELS.get(status, status)} — {submitted_at}\n"
+    if not overview['payments']:
+        message += "ندارد\n"
+
+    await query.edit_message_text(message, reply_markup=back_markup)
+
+def render_ticket_search(text, page=0):
+    """Build the text and keyboard of one page of ticket search results
+
+    Returns:
+        tuple: (message text, InlineKeyboardMarkup)
+    """
+    tickets, has_more = search_tickets(text, offset=page * TICKET_SEARCH_PAGE_SIZE, limit=TICKET_SEARCH_PAGE_SIZE)
+
+    message = f"🔍 نتایج جستجوی «{text}» (صفحه {page + 1}):\n\n"
+    if not tickets:
+        message += "هیچ تیکتی یافت نشد."
+
+    keyboard = []
+    for ticket_id, subject, status, first_name, username, snippet in tickets:
+        status_icon = "🟢" if status == 'open' else "🟡" if status == 'answered' else "🔴"
+        user_display = f"{first_name}" + (f" (@{username})" if username else "")
+        # Subjects are the user's first message and can be long
+        display_subject = subject if len(subject) <= 60 else subject[:57] + "..."
+        message += f"{status_icon} #{ticket_id}: {display_subject}\n👤 {user_display}\n"
+        if snippet:
+            message += f"💬 {snippet}\n"
+        message += "\n"
+
+        if len(subject) > 25:
+            subject = subject[:22] + "..."
+        keyboard.append([InlineKeyboardButton(f"{status_icon} #{ticket_id}: {subject}",
+                                              callback_data=f"admin_view_ticket_{ticket_id}")])
+
+    navigation_buttons = []
+    if page > 0:
+        navigation_buttons.append(InlineKeyboardButton("⬅️ قبلی", callback_data=f"admin_ticket_search_page_{page - 1}"))
+    if has_more:
+        navigation_buttons.append(InlineKeyboardButton("➡️ بعدی", callback_data=f"admin_ticket_search_page_{page + 1}"))
+    if navigation_buttons:
+        keyboard.append(navigation_buttons)
+
+    keyboard.append([InlineKeyboardButton("🔍 جستجوی جدید", callback_data="admin_ticket_search")])
+    keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data="admin_tickets")])
+    return message, InlineKeyboardMarkup(keyboard)
 
 async def show_all_tickets(query):
-    """Show all support tickets"""
-    import sqlite3
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-
-    cursor.execute('''
-    SELECT t.ticket_id, t.subject, t.status, u.first_name, u.username 
-    FROM tickets t
-    JOIN users u ON t.user_id = u.user_id
-    ORDER BY 
-        CASE 
-            WHEN t.status = 'open' THEN 1
-            WHEN t.status = 'answered' THEN 2
-            ELSE 3
-        END,
-        t.created_at DESC
-    LIMIT 50
-    ''')
-
-    tickets = cursor.fetchall()
-    conn.close()
+    """Show the support ticket queue"""
+    tickets = get_all_tickets()
 
     if not tickets:
         await query.edit_message_text(
@@ -638,7 +1160,7 @@ async def show_all_tickets(query):
     keyboard = []
 
     for ticket in tickets:
-        ticket_id, subject, status, first_name, username = ticket
+        ticket_id, subject, status, first_name, username, message_count, _, _ = ticket
 
         # Format subject to fit on button
         if len(subject) > 25:
@@ -652,11 +1174,12 @@ async def show_all_tickets(query):
 
         keyboard.append([
             InlineKeyboardButton(
-                f"{status_icon} #{ticket_id}: {subject}",
+                f"{status_icon} #{ticket_id}: {subject} ({message_count} 💬)",
                 callback_data=f"admin_view_ticket_{ticket_id}"
             )
         ])
 
+    keyboard.append([InlineKeyboardButton("🔍 جستجو در تیکت‌ها", callback_data="admin_ticket_search")])
     keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data="admin_menu")])
 
     await query.edit_message_text(
@@ -664,57 +1187,96 @@ async def show_all_tickets(query):
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
-async def show_ticket_messages_admin(query, ticket_id):
-    """Show messages in a ticket for admin"""
-    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-    import sqlite3
-
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-
-    # Get ticket info
-    cursor.execute('''
-    SELECT t.subject, t.status, t.user_id, u.first_name, u.username
-    FROM tickets t
-    JOIN users u ON t.user_id = u.user_id
-    WHERE t.ticket_id = ?
-    ''', (ticket_id,))
-
-    ticket_info = cursor.fetchone()
-
-    if not ticket_info:
+def _text_length(text):
+    """Length of text as Telegram counts it, in UTF-16 code units"""
+    return len(text.encode('utf-16-le')) // 2
+
+def render_ticket_conversation(header, messages, has_older, has_newer, own_label, keep_newest=True):
+    """Build the text of a ticket view from its header and a message window
+
+    The text stays within MESSAGE_TEXT_LIMIT: long messages are cut to
+    TICKET_MESSAGE_PREVIEW characters, and messages that still do not fit are
+    dropped from the far end of the window (the oldest, or the newest when
+    paging forwards). Dropped messages stay reachable through the navigation
+    buttons, and a window always renders to the same text.
+
+    Args:
+        header (str): Ticket header shown above the messages
+        messages (list): (message_id, message, is_admin, created_at) oldest first
+        has_older (bool): Whether messages older than the window exist
+        has_newer (bool): Whether messages newer than the window exist
+        own_label (str): Sender label for non-admin messages
+        keep_newest (bool): Drop older messages first when over the limit
+
+    Returns:
+        tuple: (text, shown messages, has_older, has_newer)
+    """
+    entries = []
+    for message_id, text, is_admin, created_at in messages:
+        if len(text) > TICKET_MESSAGE_PREVIEW:
+            text = text[:TICKET_MESSAGE_PREVIEW] + "…"
+        sender = "👤 پشتیبانی" if is_admin else own_label
+        entries.append((message_id, f"{sender} ({created_at}):\n{text}\n\n"))
+
+    budget = MESSAGE_TEXT_LIMIT - _text_length(header)
+    shown = []
+    for entry in (reversed(entries) if keep_newest else entries):
+        budget -= _text_length(entry[1])
+        if budget < 0:
+            if keep_newest:
+                has_older = True
+            else:
+                has_newer = True
+            break
+        shown.append(entry)
+    if keep_newest:
+        shown.reverse()
+
+    text = header + "".join(entry for _, entry in shown)
+    return text, [message_id for message_id, _ in shown], has_older, has_newer
+
+def get_ticket_navigation(prefix, ticket_id, shown_ids, has_older, has_newer):
+    """Older/newer buttons for a ticket message window, or None if there is nowhere to go"""
+    buttons = []
+    if shown_ids and has_older:
+        buttons.append(InlineKeyboardButton("⬅️ پیام‌های قدیمی‌تر", callback_data=f"{prefix}_{ticket_id}_o_{shown_ids[0]}"))
+    if shown_ids and has_newer:
+        buttons.append(InlineKeyboardButton("پیام‌های جدیدتر ➡️", callback_data=f"{prefix}_{ticket_id}_n_{shown_ids[-1]}"))
+    return buttons or None
+
+def parse_ticket_window(parts):
+    """Window cursor from the trailing parts of ticket view callback data, as keyword arguments"""
+    if len(parts) == 2 and parts[0] == "o":
+        return {'before': int(parts[1])}
+    if len(parts) == 2 and parts[0] == "n":
+        return {'after': int(parts[1])}
+    return {}
+
+def _ticket_header(ticket_id, subject, status, user_line=""):
+    if len(subject) > TICKET_SUBJECT_PREVIEW:
+        subject = subject[:TICKET_SUBJECT_PREVIEW] + "…"
+    header = f"📋 تیکت #{ticket_id}\n\n📝 موضوع: {subject}\n{user_line}📊 وضعیت: {status}\n\n"
+    return header + "📨 پیام ها:\n\n"
+
+async def show_ticket_messages_admin(query, ticket_id, before=None, after=None):
+    """Show a window of a ticket's messages to an admin"""
+    ticket = get_ticket_view(ticket_id, before=before, after=after, limit=TICKET_MESSAGE_WINDOW)
+
+    if not ticket:
         await query.edit_message_text(
             "تیکت یافت نشد.",
             reply_markup=InlineKeyboardMarkup([
                 [InlineKeyboardButton("🔙 بازگشت", callback_data="admin_tickets")]
             ])
         )
-        conn.close()
         return
 
-    subject, status, user_id, first_name, username = ticket_info
-
-    # Get messages
-    cursor.execute('''
-    SELECT message, is_admin, created_at, sender_id
-    FROM ticket_messages 
-    WHERE ticket_id = ?
-    ORDER BY created_at
-    ''', (ticket_id,))
-
-    messages = cursor.fetchall()
-    conn.close()
-
-    message_text = f"📋 تیکت #{ticket_id}\n\n"
-    message_text += f"📝 موضوع: {subject}\n"
-    message_text += f"👤 کاربر: {first_name}" + (f" (@{username})" if username else "") + f"\n"
-    message_text += f"📊 وضعیت: {status}\n\n"
-    message_text += "📨 پیام ها:\n\n"
-
-    for msg in messages:
-        text, is_admin, timestamp, sender_id = msg
-        sender = "👤 پشتیبانی" if is_admin else f"👤 کاربر"
-        message_text += f"{sender} ({timestamp}):\n{text}\n\n"
+    status = ticket['status']
+    user_line = f"👤 کاربر: {ticket['first_name']}" + (f" (@{ticket['username']})" if ticket['username'] else "") + "\n"
+    message_text, shown_ids, has_older, has_newer = render_ticket_conversation(
+        _ticket_header(ticket_id, ticket['subject'], status, user_line), ticket['messages'],
+        ticket['has_older'], ticket['has_newer'], "👤 کاربر", keep_newest=after is None
+    )
 
     keyboard = [
         [InlineKeyboardButton("✏️ پاسخ به تیکت", callback_data=f"support_reply_{ticket_id}")],
@@ -724,6 +1286,9 @@ async def show_ticket_messages_admin(query, ticket_id):
 
     if status != "closed":
         keyboard.insert(1, [InlineKeyboardButton("🔒 بستن تیکت", callback_data=f"support_close_{ticket_id}")])
+    navigation = get_ticket_navigation("admin_view_ticket", ticket_id, shown_ids, has_older, has_newer)
+    if navigation:
+        keyboard.insert(0, navigation)
 
     await query.edit_message_text(
         message_text,
@@ -756,8 +1321,8 @@ async def handle_support_message(update: Update, context: ContextTypes.DEFAULT_T
     message_text = update.message.text
 
     # Check if admin is sending a broadcast message
-    if user_id in ADMIN_IDS and context.user_data.get('awaiting_broadcast'):
-        del context.user_data['awaiting_broadcast']
+    if user_id in ADMIN_IDS and get_state(context.user_data, AWAITING_BROADCAST) is not None:
+        clear_state(context.user_data)
 
         # Send broadcast message to all users
         success, failed = await send_broadcast_message(message_text, context)
@@ -769,16 +1334,33 @@ async def handle_support_message(update: Update, context: ContextTypes.DEFAULT_T
         )
         return
 
+    # Admin searching the user browser
+    if user_id in ADMIN_IDS and get_state(context.user_data, AWAITING_USER_SEARCH) is not None:
+        clear_state(context.user_data)
+        context.user_data['user_search'] = message_text.strip()
+        context.user_data['user_page'] = {}
+        message, reply_markup = render_users_page(context.user_data['user_search'])
+        await update.message.reply_text(message, reply_markup=reply_markup)
+        return
+
+    # Admin searching tickets
+    if user_id in ADMIN_IDS and get_state(context.user_data, AWAITING_TICKET_SEARCH) is not None:
+        clear_state(context.user_data)
+        context.user_data['ticket_search'] = message_text.strip()
+        message, reply_markup = render_ticket_search(context.user_data['ticket_search'])
+        await update.message.reply_text(message, reply_markup=reply_markup)
+        return
+
     # Creating a new ticket
-    if 'creating_ticket' in context.user_data:
+    reply_state = get_state(context.user_data, AWAITING_REPLY)
+    if get_state(context.user_data, AWAITING_TICKET_SUBJECT) is not None:
         # Create new ticket
         ticket_id = create_ticket(user_id, message_text)
 
         # Add first message as the ticket subject
         add_ticket_message(ticket_id, user_id, message_text, False)
 
-        # Clear the creating_ticket flag
-        del context.user_data['creating_ticket']
+        clear_state(context.user_data)
 
         # Notify user
         await update.message.reply_text(
@@ -789,45 +1371,31 @@ async def handle_support_message(update: Update, context: ContextTypes.DEFAULT_T
             ])
         )
 
-        # Notify admins
-        for admin_id in ADMIN_IDS:
-            try:
-                await context.bot.send_message(
-                    chat_id=admin_id,
-                    text=f"📩 تیکت جدید #{ticket_id}\n"
-                         f"👤 کاربر: {update.effective_user.full_name}\n"
-                         f"📝 موضوع: {message_text}",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("✏️ پاسخ به تیکت", callback_data=f"support_reply_{ticket_id}")],
-                        [InlineKeyboardButton("📋 مشاهده تیکت", callback_data=f"admin_view_ticket_{ticket_id}")]
-                    ])
-                )
-            except Exception as e:
-                logger.error(f"Error notifying admin: {e}")
+        # Notify admins in the background
+        notify_admins(
+            context.application, "send_message",
+            text=f"📩 تیکت جدید #{ticket_id}\n"
+                 f"👤 کاربر: {update.effective_user.full_name}\n"
+                 f"📝 موضوع: {message_text}",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("✏️ پاسخ به تیکت", callback_data=f"support_reply_{ticket_id}")],
+                [InlineKeyboardButton("📋 مشاهده تیکت", callback_data=f"admin_view_ticket_{ticket_id}")]
+            ])
+        )
 
     # Replying to a ticket
-    elif 'replying_to' in context.user_data:
-        ticket_id = context.user_data['replying_to']
+    elif reply_state is not None:
+        ticket_id = reply_state['ticket_id']
         is_admin = user_id in ADMIN_IDS
 
-        # Add the message to the ticket
-        add_ticket_message(ticket_id, user_id, message_text, is_admin)
-
-        # Update ticket status if admin replied
-        if is_admin:
-            update_ticket_status(ticket_id, 'answered')
-        else:
-            update_ticket_status(ticket_id, 'open')
+        # Add the message and update the status; returns the owner for notifications
+        ticket_owner_id = record_ticket_reply(ticket_id, user_id, message_text, is_admin,
+                                              owner_id=None if is_admin else user_id)
 
-        # Get ticket owner for notifications
-        import sqlite3
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute('SELECT user_id FROM tickets WHERE ticket_id = ?', (ticket_id,))
-        ticket_owner_id = cursor.fetchone()[0]
-        conn.close()
-
-        del context.user_data['replying_to']
+        clear_state(context.user_data)
+        if ticket_owner_id is None:
+            await update.message.reply_text("❌ تیکت یافت نشد.")
+            return
 
         # Notify the other party
         if is_admin and ticket_owner_id != user_id:
@@ -843,19 +1411,15 @@ async def handle_support_message(update: Update, context: ContextTypes.DEFAULT_T
             except Exception as e:
                 logger.error(f"Error notifying ticket owner: {e}")
         elif not is_admin:
-            for admin_id in ADMIN_IDS:
-                try:
-                    await context.bot.send_message(
-                        chat_id=admin_id,
-                        text=f"📬 پاسخ کاربر به تیکت #{ticket_id}\n\n"
-                             f"{message_text}\n\n",
-                        reply_markup=InlineKeyboardMarkup([
-                            [InlineKeyboardButton("✏️ پاسخ", callback_data=f"support_reply_{ticket_id}")],
-                            [InlineKeyboardButton("📋 مشاهده تیکت", callback_data=f"admin_view_ticket_{ticket_id}")]
-                        ])
-                    )
-                except Exception as e:
-                    logger.error(f"Error notifying admin: {e}")
+            notify_admins(
+                context.application, "send_message",
+                text=f"📬 پاسخ کاربر به تیکت #{ticket_id}\n\n"
+                     f"{message_text}\n\n",
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("✏️ پاسخ", callback_data=f"support_reply_{ticket_id}")],
+                    [InlineKeyboardButton("📋 مشاهده تیکت", callback_data=f"admin_view_ticket_{ticket_id}")]
+                ])
+            )
 
         await update.message.reply_text(
             "✅ پاسخ شما ارسال شد.",
@@ -864,7 +1428,7 @@ async def handle_support_message(update: Update, context: ContextTypes.DEFAULT_T
             ])
         )
 async def create_new_ticket(query, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data['creating_ticket'] = True
+    set_state(context.user_data, AWAITING_TICKET_SUBJECT)
     await query.edit_message_text(
         "لطفا موضوع تیکت خود را ارسال کنید:",
         reply_markup=InlineKeyboardMarkup([
@@ -903,16 +1467,13 @@ async def show_user_tickets(query, user_id):
         "تیکت های شما:",
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
-async def show_ticket_messages(query, ticket_id, user_id):
-    """Show messages in a ticket for user"""
-    # Get ticket conversation from database
-    ticket_data = get_ticket_conversation(ticket_id, user_id, ADMIN_IDS)
-
-    if not ticket_data['access']:
-        await query.answer("دسترسی denied.")
-        return
+async def show_ticket_messages(query, ticket_id, user_id, before=None, after=None):
+    """Show a window of a ticket's messages to its owner"""
+    # Admins may open any ticket, users only their own
+    owner_id = None if user_id in ADMIN_IDS else user_id
+    ticket = get_ticket_view(ticket_id, owner_id, before=before, after=after, limit=TICKET_MESSAGE_WINDOW)
 
-    if 'error' in ticket_data and not ticket_data.get('ticket_info'):
+    if not ticket:
         await query.edit_message_text(
             "تیکت یافت نشد.",
             reply_markup=InlineKeyboardMarkup([
@@ -921,9 +1482,11 @@ async def show_ticket_messages(query, ticket_id, user_id):
         )
         return
 
-    # Use the formatted message text from the database function
-    message_text = ticket_data['formatted_text']
-    status = ticket_data['status']
+    status = ticket['status']
+    message_text, shown_ids, has_older, has_newer = render_ticket_conversation(
+        _ticket_header(ticket_id, ticket['subject'], status), ticket['messages'],
+        ticket['has_older'], ticket['has_newer'], "👤 شما", keep_newest=after is None
+    )
 
     # Create keyboard
     keyboard = [
@@ -933,6 +1496,9 @@ async def show_ticket_messages(query, ticket_id, user_id):
 
     if status != 'closed':
         keyboard.insert(1, [InlineKeyboardButton("🔒 بستن تیکت", callback_data=f"support_close_{ticket_id}")])
+    navigation = get_ticket_navigation("support_ticket", ticket_id, shown_ids, has_older, has_newer)
+    if navigation:
+        keyboard.insert(0, navigation)
 
     await query.edit_message_text(
         message_text,
@@ -940,14 +1506,10 @@ async def show_ticket_messages(query, ticket_id, user_id):
     )
 async def close_user_ticket(query, ticket_id, user_id):
     """Close a ticket and show updated ticket view"""
-    # Check access permission
-    has_access, ticket_owner_id = verify_ticket_access(ticket_id, user_id, ADMIN_IDS)
-    if not has_access:
+    # Close the ticket if the user owns it or is an admin
+    if not close_ticket(ticket_id, None if user_id in ADMIN_IDS else user_id):
         await query.answer("دسترسی رد شد.")
         return
-
-    # Close the ticket in database
-    close_ticket(ticket_id)
     await query.answer("تیکت بسته شد.")
 
     # Show updated ticket view
@@ -965,11 +1527,15 @@ async def handle_support_callback(query, data, user_id, context: ContextTypes.DE
     elif data == "support_my_tickets":
         await show_user_tickets(query, user_id)
     elif data.startswith("support_ticket_"):
-        ticket_id = int(data.split("_")[2])
-        await show_ticket_messages(query, ticket_id, user_id)
+        parts = data.split("_")
+        await show_ticket_messages(query, int(parts[2]), user_id, **parse_ticket_window(parts[3:]))
     elif data.startswith("support_reply_"):
         ticket_id = int(data.split("_")[2])
-        context.user_data['replying_to'] = ticket_id
+        # Admins may reply to any ticket, users only to their own
+        if user_id not in ADMIN_IDS and get_ticket_view(ticket_id, user_id, limit=1) is None:
+            await query.answer("دسترسی رد شد.")
+            return
+        set_state(context.user_data, AWAITING_REPLY, ticket_id=ticket_id)
         await query.edit_message_text(
             "لطفا پیام پاسخ خود را ارسال کنید:",
             reply_markup=InlineKeyboardMarkup([
@@ -988,166 +1554,282 @@ async def handle_admin_decision(query, data, user_id, context: ContextTypes.DEFA
 
     if data.startswith("approve_"):
         payment_id = int(data[8:])
+        resolve_payment_type_from_caption(query, payment_id)
         await approve_payment(query, payment_id, context)
     elif data.startswith("reject_"):
         payment_id = int(data[7:])
         await reject_payment(query, payment_id, context)
 
-async def approve_payment(query, payment_id, context: ContextTypes.DEFAULT_TYPE):
-    """Approve a payment and create VPN configuration for the user or extend existing one"""
-    # Get payment info including user_id, plan details and username
-    payment_info = get_payment_info(payment_id)
+def resolve_payment_type_from_caption(query, payment_id):
+    """Resolve a payment from before extension details were stored using its receipt caption
 
-    if not payment_info:
-        await query.answer("پرداخت یافت نشد یا قبلاً پردازش ��ده است.")
+    Older versions only wrote the extension target into the admin caption
+    ("تمدید برای: email"). Does nothing for payments that are already resolved
+    or when the button is not on that payment's receipt message.
+    """
+    caption = query.message.caption if query.message else None
+    if not caption or f"شناسه پرداخت: {payment_id}" not in caption:
         return
+    match = LEGACY_EXTENSION_CAPTION.search(caption)
+    extension = None
+    if match:
+        extension = {'email': match.group(1), 'client_id': None, 'gb': None, 'days': 30}
+    if resolve_payment_type(payment_id, extension):
+        logger.info(f"Resolved payment {payment_id} from its caption as "
+                    f"{'extension of ' + extension['email'] if extension else 'new config'}")
+
+# Approvals of the same payment inside this process wait for each other; the
+# database claim in claim_payment covers other bot instances
+_payment_locks = weakref.WeakValueDictionary()
+
+def _payment_lock(payment_id):
+    lock = _payment_locks.get(payment_id)
+    if lock is None:
+        lock = _payment_locks[payment_id] = asyncio.Lock()
+    return lock
+
+async def report_processed_payment(query, payment_id, context: ContextTypes.DEFAULT_TYPE):
+    """Tell the admin what already happened to a payment that could not be claimed"""
+    outcome = get_payment_outcome(payment_id)
+    if not outcome:
+        text = f"پرداخت {payment_id} یافت نشد."
+    else:
+        status, result, processed_at, type_unknown = outcome
+        if status == 'pending' and type_unknown:
+            text = (f"پرداخت {payment_id} پیش از به‌روزرسانی ربات ثبت شده و مشخص نیست خرید است یا تمدید.\n"
+                    f"آن را از پیام اصلی رسید (که نوع درخواست در آن آمده) تأیید یا رد کنید.")
+        elif status == 'pending':
+            text = f"پرداخت {payment_id} در صف انتظار است."
+        elif status == 'processing':
+            text = f"پرداخت {payment_id} در حال پردازش است."
+        elif status == 'approved':
+            text = f"پرداخت {payment_id} قبلاً تأیید شده است." + (f"\nکانفیگ: {result}" if result else "")
+        else:
+            text = f"پرداخت {payment_id} قبلاً رد شده است."
+    await context.bot.send_message(chat_id=query.message.chat_id, text=text)
 
-    user_id, plan_name, username = payment_info
-    plan_gb = int(plan_name.split()[0])  # Extract GB amount from plan name
+class ExtensionConfigMissing(Exception):
+    """Raised when the config an extension payment targets no longer exists"""
 
-    # Check if this is an extension request
-    is_extension = False
-    extension_email = None
-    extension_client_id = None
-
-    if 'extension_requests' in context.bot_data and str(payment_id) in context.bot_data['extension_requests']:
-        is_extension = True
-        extension_data = context.bot_data['extension_requests'][str(payment_id)]
-        extension_email = extension_data.get('email')
-        extension_client_id = extension_data.get('client_id')
-    elif "تمدید" in query.message.caption:
-        update_payment_status(payment_id, 'rejected')
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=f"مشکلی پیش آمد مجدد برای تمدید را درخواست کنید!\n\n",
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(get_back_to_main_button())
-        )
-        return
-    try:
-        if is_extension and extension_email and extension_client_id:
-            # Handle extension of existing service
+# Difference in GB below which an extension counts as already applied on the panel
+EXTENSION_APPLIED_TOLERANCE_GB = 0.01
 
-            # Get current status to obtain expiry date
-            status = get_client_status(extension_email)
-            if not status:
-                raise Exception("خطا در دریافت اطلاعات سرویس فعلی")
+def provision_payment(payment_id, payment_info):
+    """Create or extend the VPN config paid for by a claimed payment
 
-            # Extend the client service
-            success, error_msg = extend_client(extension_email, extension_client_id, plan_gb, timedelta(days=30))
+    Blocking: talks to the XUI panel and the database. The change is recorded
+    on the payment row before it is sent to the panel, and a payment that
+    already has a record (an earlier attempt that failed, timed out or
+    crashed) is first looked up on the panel, so running this again never
+    provisions a payment twice.
 
-            if not success:
-                raise Exception(f"خطا در تمدید سرویس: {error_msg}")
+    Args:
+        payment_id (int): The claimed payment
+        payment_info (tuple): Row returned by claim_payment
 
-            # Update the database with the new total GB amount
-            db_update_success = update_config_total_gb(extension_email, user_id, plan_gb)
-            if not db_update_success:
-                logger.warning(f"Failed to update database for config {extension_email} after extension")
+    Returns:
+        dict: 'user_id', 'email', 'client_id', 'gb', 'days' and 'is_extension'
 
-            # Update payment status to approved
-            update_payment_status(payment_id, 'approved')
+    Raises:
+        ExtensionConfigMissing: If the config to extend cannot be found
+        Exception: If the panel rejected the change; nothing was provisioned
+    """
+    user_id, plan_name, username, extension, provision = payment_info
+    plan_gb = int(plan_name.split()[0])  # Extract GB amount from plan name
 
-            # Generate VLESS link
-            vless_link = generate_vless_link(extension_client_id, extension_email)
+    if extension is not None:
+        email = extension['email']
+        client_id = extension['client_id'] or get_client_id_by_email(email, user_id)
+        days = extension['days'] or 30
+        if not client_id:
+            raise ExtensionConfigMissing(email)
+
+        # Get current status to obtain expiry date
+        status = get_client_status(email)
+        if not status:
+            raise Exception("خطا در دریافت اطلاعات سرویس فعلی")
+
+        already_applied = (provision is not None and provision['base_gb'] is not None
+                           and status['total_gb'] >= provision['base_gb'] + plan_gb - EXTENSION_APPLIED_TOLERANCE_GB)
+        if already_applied:
+            # The database total may have missed this extension; reconciliation repairs it
+            logger.info(f"Extension of {email} for payment {payment_id} was already applied on the panel")
+        else:
+            record_payment_provision(payment_id, email, client_id, status['total_gb'])
 
-            # Notify the user about their approved extension
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"✅ درخواست تمدید شما تأیید شد!\n\n"
-                     f"حجم {plan_gb} گیگابایت به سرویس شما اضافه شد\n"
-                     f"تاریخ انقضا ۳۰ روز تمدید شد\n\n"
-                     f"🔗 لینک کانفیگ شما:\n`{vless_link}`",
-                parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup(get_back_to_main_button())
-            )
+            # Extend the client service
+            success, error_msg = extend_client(email, client_id, plan_gb, timedelta(days=days))
+            if not success:
+                raise Exception(f"خطا در تمدید سرویس: {error_msg}")
 
-            # Clean up extension request data
-            del context.bot_data['extension_requests'][str(payment_id)]
+            # Update the database with the new total GB amount
+            if not update_config_total_gb(email, user_id, plan_gb, days):
+                logger.warning(f"Failed to update database for config {email} after extension")
+    else:
+        days = 30
 
-            # Confirm successful approval to admin
-            await context.bot.send_message(
-                chat_id=query.message.chat_id,
-                text=f"تمدید سرویس {extension_email} با {plan_gb} گیگابایت تأیید شد."
-            )
+        if provision is not None and get_client_status(provision['email']):
+            # An earlier attempt created the client; only the database row may be missing
+            email, client_id = provision['email'], provision['client_id']
+            logger.info(f"Client {email} for payment {payment_id} already exists on the panel")
         else:
-            # Handle new service creation (existing logic)
-            # Create unique identifiers for the new client
-            client_id = str(uuid.uuid4())
-            suffix = random_suffix()
+            if provision is not None:
+                email, client_id = provision['email'], provision['client_id']
+            else:
+                suffix = random_suffix()
 
-            # Create email identifier for the client
-            user_identifier = username if username else str(user_id)
-            email = f"{user_identifier}_{suffix}@vpn"
+                # Create email identifier for the client
+                user_identifier = username if username else str(user_id)
+                email = f"{user_identifier}_{suffix}@vpn"
 
-            # Ensure email is not too long
-            if len(email) > 50:
-                email = f"u{user_id}_{suffix}@vpn"
+                # Ensure email is not too long
+                if len(email) > 50:
+                    email = f"u{user_id}_{suffix}@vpn"
+
+                client_id = str(uuid.uuid4())
+                record_payment_provision(payment_id, email, client_id)
 
             # Calculate configuration details
             total_bytes = plan_gb * 1024 ** 3  # Convert GB to bytes
-            expiry_time = int(time.time() + 30 * 86400) * 1000  # 30 days in milliseconds
+            expiry_time = int(time.time() + days * 86400) * 1000  # 30 days in milliseconds
 
             # Create the client on the VPN server
-            client_id, error = create_client(email, total_bytes, expiry_time)
-
+            client_id, error = create_client(email, total_bytes, expiry_time, client_id)
             if error:
                 raise Exception(f"خطا در ایجاد کانفیگ: {error}")
 
-            # Save the new configuration in the database
-            save_new_config(user_id, email, client_id, plan_gb)
+        # The client exists on the panel now, so a database error must not
+        # send the payment back to pending and provision it twice
+        try:
+            if not get_client_id_by_email(email, user_id):
+                save_new_config(user_id, email, client_id, plan_gb)
+        except Exception as e:
+            logger.error(f"Created client {email} but failed to save it: {e}")
+
+    return {
+        'user_id': user_id,
+        'email': email,
+        'client_id': client_id,
+        'gb': plan_gb,
+        'days': days,
+        'is_extension': extension is not None
+    }
+
+async def notify_extension_missing(context: ContextTypes.DEFAULT_TYPE, user_id):
+    """Ask the user to request their extension again"""
+    await context.bot.send_message(
+        chat_id=user_id,
+        text=f"مشکلی پیش آمد مجدد برای تمدید را درخواست کنید!\n\n",
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup(get_back_to_main_button())
+    )
 
-            # Update payment status to approved
-            update_payment_status(payment_id, 'approved')
+async def notify_payment_approved(context: ContextTypes.DEFAULT_TYPE, outcome):
+    """Send the user their config after their payment was approved"""
+    vless_link = generate_vless_link(outcome['client_id'], outcome['email'])
+    if outcome['is_extension']:
+        text = (f"✅ درخواست تمدید شما تأیید شد!\n\n"
+                f"حجم {outcome['gb']} گیگابایت به سرویس شما اضافه شد\n"
+                f"تاریخ انقضا {outcome['days']} روز تمدید شد\n\n"
+                f"🔗 لینک کانفیگ شما:\n`{vless_link}`")
+    else:
+        text = (f"✅ پرداخت شما تأیید شد!\n\n"
+                f"🔗 لینک کانفیگ:\n`{vless_link}`")
+    await context.bot.send_message(
+        chat_id=outcome['user_id'],
+        text=text,
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup(get_back_to_main_button())
+    )
+    # The QR code follows in the background so approval does not wait for rendering
+    context.application.create_task(
+        send_config_qr(context.bot, outcome['user_id'], outcome['client_id'], vless_link,
+                       caption=f"📷 QR کد کانفیگ {outcome['email']}"),
+        name="send_config_qr"
+    )
 
-            # Generate VPN connection link
-            vless_link = generate_vless_link(client_id, email)
+async def approve_payment(query, payment_id, context: ContextTypes.DEFAULT_TYPE):
+    """Approve a payment and create VPN configuration for the user or extend existing one"""
+    async with _payment_lock(payment_id):
+        # Claim the payment; if someone else already did, report what happened to it
+        payment_info = claim_payment(payment_id)
+        if not payment_info:
+            await report_processed_payment(query, payment_id, context)
+            return
+        outcome = await provision_claimed_payment(query, payment_id, payment_info, context)
 
-            # Notify the user about their approved payment and send config
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"✅ پرداخت شما تأیید شد!\n\n"
-                     f"🔗 لینک کانفیگ:\n`{vless_link}`",
-                parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup(get_back_to_main_button())
-            )
+    if outcome:
+        await report_payment_approved(query, payment_id, outcome, context)
 
-            # Confirm successful approval to admin
-            await context.bot.send_message(
-                chat_id=query.message.chat_id,
-                text=f"پرداخت {payment_id} تأیید شد و کانفیگ برای کارب�� ارسال شد."
-            )
+async def retry_stale_payment(query, payment_id, context: ContextTypes.DEFAULT_TYPE):
+    """Finish a payment left in processing, checking the panel for what was already done"""
+    async with _payment_lock(payment_id):
+        payment_info = reclaim_stale_payment(payment_id)
+        if not payment_info:
+            await report_processed_payment(query, payment_id, context)
+            return
+        outcome = await provision_claimed_payment(query, payment_id, payment_info, context)
+
+    if outcome:
+        await report_payment_approved(query, payment_id, outcome, context)
+
+async def provision_claimed_payment(query, payment_id, payment_info, context: ContextTypes.DEFAULT_TYPE):
+    """Provision a claimed payment and record the outcome
 
+    Returns:
+        dict: The outcome from provision_payment, or None if the payment was
+              rejected or went back to pending
+    """
+    try:
+        outcome = await asyncio.to_thread(provision_payment, payment_id, payment_info)
+    except ExtensionConfigMissing:
+        finish_payment(payment_id, 'rejected', "extension config not found", query.from_user.id)
+        await notify_extension_missing(context, payment_info[0])
+        return None
     except Exception as e:
-        logger.error(f"Error approving payment: {str(e)}")
+        logger.error(f"Error approving payment {payment_id}: {str(e)}")
+        # Safe to retry: the next attempt checks the panel for what this one recorded
+        release_payment(payment_id)
         # Notify admin about the error
         await context.bot.send_message(
             chat_id=query.message.chat_id,
             text=f"خطا در پردازش پرداخت: {str(e)}", reply_markup=InlineKeyboardMarkup(get_admin_menu_keyboard())
         )
+        return None
 
-async def reject_payment(query, payment_id, context: ContextTypes.DEFAULT_TYPE):
-    """Reject a payment and notify the user"""
-    try:
-        # Get user ID and plan information associated with the payment
-        payment_info = get_payment_info(payment_id)
+    finish_payment(payment_id, 'approved', outcome['email'], query.from_user.id)
+    return outcome
 
-        if not payment_info:
-            await query.answer("پرداخت یافت نشد یا قبلاً پردازش شده است.")
-            return
+async def report_payment_approved(query, payment_id, outcome, context: ContextTypes.DEFAULT_TYPE):
+    """Send the user their config and confirm the approval to the admin"""
+    try:
+        await notify_payment_approved(context, outcome)
+        if outcome['is_extension']:
+            text = f"تمدید سرویس {outcome['email']} با {outcome['gb']} گیگابایت تأیید شد."
+        else:
+            text = f"پرداخت {payment_id} تأیید شد و کانفیگ برای کاربر ارسال شد."
+    except Exception as e:
+        logger.error(f"Error notifying user {outcome['user_id']} about approved payment {payment_id}: {e}")
+        text = f"پرداخت {payment_id} تأیید شد اما ارسال کانفیگ به کاربر با خطا مواجه شد: {str(e)}"
 
-        user_id, plan_name, username = payment_info
+    # Confirm approval to admin
+    await context.bot.send_message(chat_id=query.message.chat_id, text=text)
 
-        # Check if this is an extension request
-        is_extension = False
-        extension_email = None
+async def reject_payment(query, payment_id, context: ContextTypes.DEFAULT_TYPE):
+    """Reject a payment and notify the user"""
+    try:
+        async with _payment_lock(payment_id):
+            # Claim the payment so it cannot be approved at the same time
+            payment_info = claim_payment(payment_id, allow_unknown_type=True)
+            if not payment_info:
+                await report_processed_payment(query, payment_id, context)
+                return
+            finish_payment(payment_id, 'rejected', None, query.from_user.id)
 
-        if hasattr(context.bot_data, 'extension_requests') and str(payment_id) in context.bot_data['extension_requests']:
-            is_extension = True
-            extension_data = context.bot_data['extension_requests'][str(payment_id)]
-            extension_email = extension_data.get('email')
+        user_id, plan_name, username, extension, _ = payment_info
 
-        # Update payment status to rejected
-        update_payment_status(payment_id, 'rejected')
+        is_extension = extension is not None
+        extension_email = extension['email'] if is_extension else None
 
         # Notify user about the rejection with details
         try:
@@ -1181,11 +1863,6 @@ async def reject_payment(query, payment_id, context: ContextTypes.DEFAULT_TYPE):
                 text=f"پرداخت {payment_id} رد شد و کاربر با موفقیت مطلع شد."
             )
 
-            # Clean up extension request data if it exists
-            if is_extension and hasattr(context.bot_data, 'extension_requests'):
-                if str(payment_id) in context.bot_data['extension_requests']:
-                    del context.bot_data['extension_requests'][str(payment_id)]
-
         except Exception as e:
             logger.error(f"Error notifying user {user_id} about rejected payment: {e}")
 
@@ -1246,38 +1923,50 @@ async def handle_view_receipt(query, data, user_id, context: ContextTypes.DEFAUL
         logger.error(f"Error viewing receipt: {e}")
         await query.answer("خطا در نمایش رسید!", reply_markup=InlineKeyboardMarkup(get_admin_menu_keyboard()))
 
-async def refresh_config_status(query, context: ContextTypes.DEFAULT_TYPE):
-    """Refresh the status of the current config"""
-    # Extract email from the previous message
-    message_text = query.message.text
-    email_lines = [line for line in message_text.split('\n') if '📧 نام:' in line]
+def get_status_email(message_text):
+    """Extract the config email from a status message (line format: "📧 نام: `email`")"""
+    for line in (message_text or "").split('\n'):
+        if '📧 نام:' in line:
+            return line.split(':')[1].strip()
+    return None
 
-    if not email_lines:
+async def send_status_qr(query, context: ContextTypes.DEFAULT_TYPE):
+    """Send the QR code of the config shown in a status message"""
+    email = get_status_email(query.message.text)
+    user_id = query.from_user.id
+    client_id = get_client_id_by_email(email, user_id) if email else None
+    if not client_id:
         await query.edit_message_text("خطا در بازیابی اطلاعات کانفیگ.", reply_markup=InlineKeyboardMarkup(get_back_to_main_button()))
         return
 
-    # Extract email from the line (format: "📧 نام: `email`")
-    email_line = email_lines[0]
-    email = email_line.split(':')[1]
-    email = email.strip()
-    # Get user_id and show status
-    user_id = query.from_user.id
-    await handle_show_status(query, email, user_id)
+    vless_link = generate_vless_link(client_id, email)
+    sent = await send_config_qr(context.bot, query.message.chat_id, client_id, vless_link,
+                                caption=f"📷 QR کد کانفیگ {email}")
+    if not sent:
+        await context.bot.send_message(chat_id=query.message.chat_id,
+                                       text="⚠️ ساخت QR کد در حال حاضر ممکن نیست. لطفاً لینک کانفیگ را کپی کنید.")
+
+async def refresh_config_status(query, context: ContextTypes.DEFAULT_TYPE):
+    """Refresh the status of the current config, answering with a toast when nothing changed"""
+    toast = None
+    try:
+        email = get_status_email(query.message.text)
+        if not email:
+            await query.edit_message_text("خطا در بازیابی اطلاعات کانفیگ.", reply_markup=InlineKeyboardMarkup(get_back_to_main_button()))
+            return
+        # Get user_id and show status
+        user_id = query.from_user.id
+        if await handle_show_status(query, email, user_id) is False:
+            toast = "✅ وضعیت سرویس تغییری نکرده است."
+    finally:
+        await query.answer(toast)
 
 async def show_extend_options(query, context: ContextTypes.DEFAULT_TYPE):
     """Show options for extending a config"""
-    # Extract email from the previous message
-    message_text = query.message.text
-    email_lines = [line for line in message_text.split('\n') if '📧 نام:' in line]
-
-    if not email_lines:
+    email = get_status_email(query.message.text)
+    if not email:
         await query.edit_message_text("خطا در بازیابی اطلاعات کانفیگ.", reply_markup=InlineKeyboardMarkup(get_back_to_main_button()))
         return
-
-    # Extract email from the line (format: "📧 نام: `email`")
-    email_line = email_lines[0]
-    email = email_line.split(':')[1]
-    email = email.strip()
     # Store the email in context for the extend handler
     context.user_data['extending_email'] = email
 
@@ -1309,21 +1998,15 @@ async def handle_extend_selection(query, data, user_id, context: ContextTypes.DE
         await query.edit_message_text("خطا در بازیابی اطلاعات کانفیگ.", reply_markup=InlineKeyboardMarkup(get_back_to_main_button()))
         return
 
-    # Store extension details in context for later use
-    context.user_data['extension_details'] = {
-        'email': email,
-        'gb_amount': gb_amount,
-        'client_id': client_id,
-        'type': 'extension'  # Mark this as an extension request
-    }
-
     # Create a "plan" object similar to what's used for new service purchases
-    context.user_data['selected_plan'] = {
+    plan = {
         'name': f"تمدید {gb_amount}GB",
         'gb': gb_amount,
         'is_extension': True,
+        'days': 30,
         'email': email  # Store email to identify which config to extend
     }
+    set_state(context.user_data, AWAITING_RECEIPT, plan=plan, extension_client_id=client_id)
 
     keyboard = get_back_to_main_button()
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -1339,6 +2022,31 @@ async def handle_extend_selection(query, data, user_id, context: ContextTypes.DE
     # Log the extension request
     logger.info(f"User {user_id} requested extension for {email} by {gb_amount}GB")
 
+def migrate_extension_requests(application):
+    """Move extension requests kept in bot_data by older versions into their payment rows"""
+    extension_requests = application.bot_data.pop('extension_requests', None)
+    if not extension_requests:
+        return
+    for payment_id, request in extension_requests.items():
+        set_payment_extension(int(payment_id), {
+            'email': request.get('email'),
+            'client_id': request.get('client_id'),
+            'gb': request.get('gb_amount'),
+            'days': 30
+        })
+    logger.info(f"Migrated {len(extension_requests)} pending extension requests to the payments table")
+
+async def post_init(application):
+    """Configure the bot and start background tasks once the Application is initialized"""
+    await set_bot_commands(application)
+    await set_chat_menu_button(application)
+    migrate_extension_requests(application)
+    conversation_state.start_sweeper(application)
+
+async def post_stop(application):
+    """Stop background tasks started in post_init"""
+    await conversation_state.stop_sweeper()
+
 async def set_bot_commands(application):
     await application.bot.set_my_commands([
         ("start", "شروع کار با ربات"),
@@ -1351,18 +2059,26 @@ async def set_chat_menu_button(application):
         menu_button=MenuButtonCommands()
     )
 
-def main():
-    """Main function to start the bot"""
-    # Initialize database
-    init_db()
-
-    # Create application
-    # application = ApplicationBuilder().token(BOT_TOKEN).build()
-    application = ApplicationBuilder().token(BOT_TOKEN).post_init(set_bot_commands).post_init(set_chat_menu_button).build()
+def build_application(builder=None):
+    """Build the Application and register all handlers
+
+    Args:
+        builder (ApplicationBuilder, optional): Pre-configured builder, e.g. with a custom
+                                                request object. Defaults to one using BOT_TOKEN.
+    """
+    if builder is None:
+        builder = ApplicationBuilder().token(BOT_TOKEN).request(InstrumentedRequest())
+    # TrackedDicts let the persistence write only the keys handlers touched
+    builder = builder.persistence(SQLitePersistence()).context_types(
+        ContextTypes(user_data=TrackedDict, bot_data=TrackedDict))
+    application = builder.post_init(post_init).post_stop(post_stop).build()
+    metrics.UPDATE_QUEUE_SIZE.set_function(application.update_queue.qsize)
 
     # Add handlers
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("admin", admin_command))
+    # Non-blocking so updates keep being processed while the capture runs
+    application.add_handler(CommandHandler("profile", profile_command, block=False))
     application.add_handler(CommandHandler("broadcast", broadcast_command))
     application.add_handler(CommandHandler("support", support_command))
 
@@ -1372,6 +2088,21 @@ def main():
     # Add handler for text messages to process support tickets
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_support_message))
 
+    return application
+
+def main():
+    """Main function to start the bot"""
+    # Initialize database
+    init_db()
+
+    # Create application
+    application = build_application()
+
+    if METRICS_PORT:
+        metrics.start_metrics_server(METRICS_PORT)
+    if SUBSCRIPTION_PORT:
+        start_subscription_server(SUBSCRIPTION_PORT, SUBSCRIPTION_HOST)
+
     # Start the notification service
     logger.info("Starting notification service...")
     start_notification_service(application)
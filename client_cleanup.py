@@ -0,0 +1,204 @@
+"""
+Cleanup of expired and depleted clients
+Finds clients that expired or ran out of traffic more than CLEANUP_GRACE_DAYS
+ago from one inbounds/list snapshot, removes them from the panel one delClient
+request each and marks their configs inactive in one transaction. Planning
+only reads; since when clients have been depleted is recorded separately by
+the scheduled report. A shown plan is kept under a short id, and confirming it
+removes only the shown clients that still qualify in a fresh snapshot.
+"""
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from config import CLEANUP_GRACE_DAYS
+from database import get_depleted_marks, update_depleted_marks, deactivate_configs
+from xui_api import get_inbound_clients, remove_clients
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Shown plans that can still be confirmed
+SHOWN_PLANS_KEPT = 20
+
+REMOVED = metrics.Counter("vpnbot_cleanup_removed_clients_total", "Clients removed from the panel by cleanup")
+
+_shown_plans = OrderedDict()
+_shown_lock = threading.Lock()
+
+def _scan_clients(grace_days):
+    """Split an inbounds/list snapshot into expired, depleted and replenished clients
+
+    Returns:
+        tuple: (client count, expired, depleted, replenished) where expired and
+               depleted are lists of (client_id, email) and replenished is a
+               list of client_ids, or None if the panel could not be read
+    """
+    clients = get_inbound_clients()
+    if clients is None:
+        logger.error("Cleanup skipped: could not read the panel")
+        return None
+
+    now_ms = int(time.time() * 1000)
+    expired_before_ms = now_ms - int(timedelta(days=grace_days).total_seconds() * 1000)
+
+    expired = []
+    depleted = []
+    replenished = []
+    for client in clients:
+        client_id = client.get('id')
+        if not client_id:
+            continue
+        # A negative expiryTime is a duration that starts on first use
+        expiry_ms = client.get('expiryTime') or 0
+        if 0 < expiry_ms < expired_before_ms:
+            expired.append((client_id, client.get('email')))
+            continue
+        total_bytes = client.get('totalGB') or 0
+        if total_bytes > 0 and client.get('up', 0) + client.get('down', 0) >= total_bytes:
+            depleted.append((client_id, client.get('email')))
+        else:
+            replenished.append(client_id)
+    return len(clients), expired, depleted, replenished
+
+def record_depletion():
+    """Record since when configs have been out of traffic, from a fresh snapshot
+
+    Depleted clients only count toward cleanup once they have been seen
+    depleted for the grace period, so this runs on a schedule rather than on
+    every look at the plan.
+
+    Returns:
+        int: Number of depleted clients, or None if the panel could not be read
+    """
+    scan = _scan_clients(CLEANUP_GRACE_DAYS)
+    if scan is None:
+        return None
+    _, _, depleted, replenished = scan
+    update_depleted_marks([client_id for client_id, _ in depleted], replenished)
+    return len(depleted)
+
+def _plan_id(plan):
+    """Short id of the set of clients a plan would remove"""
+    client_ids = sorted(client_id for client_id, _ in plan['expired'] + plan['depleted'])
+    return hashlib.sha256("\n".join(client_ids).encode()).hexdigest()[:16]
+
+def _build_plan(grace_days):
+    scan = _scan_clients(grace_days)
+    if scan is None:
+        return None
+    inbound_clients, expired, depleted, _ = scan
+
+    # Clients without a config row have no depletion mark, so they are only removed once expired
+    depleted_since = get_depleted_marks()
+    depleted_before = datetime.now() - timedelta(days=grace_days)
+    depleted = [(client_id, email) for client_id, email in depleted
+                if client_id in depleted_since and depleted_since[client_id] < depleted_before]
+
+    return {
+        'inbound_clients': inbound_clients,
+        'expired': expired,
+        'depleted': depleted,
+    }
+
+def _remember(plan):
+    plan['plan_id'] = _plan_id(plan)
+    with _shown_lock:
+        _shown_plans[plan['plan_id']] = {client_id for client_id, _ in plan['expired'] + plan['depleted']}
+        _shown_plans.move_to_end(plan['plan_id'])
+        while len(_shown_plans) > SHOWN_PLANS_KEPT:
+            _shown_plans.popitem(last=False)
+
+def plan_cleanup(grace_days=CLEANUP_GRACE_DAYS):
+    """Find the clients a cleanup would remove, without changing the panel or the database
+
+    The plan is kept so run_cleanup can later be confirmed against it.
+
+    Returns:
+        dict: 'inbound_clients' (count), 'expired' and 'depleted' lists of
+              (client_id, email) and 'plan_id', or None if the panel could not be read
+    """
+    plan = _build_plan(grace_days)
+    if plan is None:
+        return None
+
+    _remember(plan)
+    return plan
+
+def run_cleanup(plan_id, grace_days=CLEANUP_GRACE_DAYS):
+    """Remove the clients of a shown plan that still qualify, and deactivate their configs
+
+    Only clients both in the shown plan and in a fresh plan are removed, so a
+    client extended since it was shown is kept and no client is removed
+    without having been shown. An unknown or already run plan_id removes
+    nothing and returns a fresh plan marked 'outdated' to be shown instead.
+
+    Args:
+        plan_id (str): The 'plan_id' of the plan shown to the admin
+
+    Returns:
+        dict: The plan plus 'removed', 'failed', 'deactivated', 'skipped' and
+              'error' (the first failure),
+              the fresh plan with 'outdated' set, or None if the panel could not be read
+    """
+    plan = _build_plan(grace_days)
+    if plan is None:
+        return None
+
+    # Taken only now so a failed panel read leaves the plan confirmable, and
+    # only once so a second confirmation removes nothing
+    with _shown_lock:
+        shown = _shown_plans.pop(plan_id, None)
+    if shown is None:
+        _remember(plan)
+        plan['outdated'] = True
+        return plan
+
+    plan['expired'] = [client for client in plan['expired'] if client[0] in shown]
+    plan['depleted'] = [client for client in plan['depleted'] if client[0] in shown]
+    client_ids = [client_id for client_id, _ in plan['expired'] + plan['depleted']]
+    plan['skipped'] = len(shown) - len(client_ids)
+
+    removed, failed = remove_clients(client_ids)
+    REMOVED.inc(amount=len(removed))
+    plan['removed'] = len(removed)
+    plan['failed'] = len(failed)
+    plan['error'] = failed[0][1] if failed else None
+    if failed:
+        logger.error(f"Cleanup failed to remove {len(failed)} clients, e.g. {failed[0][0]}: {failed[0][1]}")
+
+    plan['deactivated'] = deactivate_configs(removed)
+    logger.info(f"Cleanup removed {len(removed)} clients from the panel and deactivated "
+                f"{plan['deactivated']} configs")
+    return plan
+
+def format_plan(plan, grace_days=CLEANUP_GRACE_DAYS, limit=10):
+    """Format a cleanup plan or result as an admin message"""
+    if plan is None:
+        return "❌ خطا در دریافت اطلاعات از پنل."
+
+    lines = [f"🧹 پاکسازی کلاینت‌ها (مهلت {grace_days} روز)\n",
+             f"🔌 کلاینت‌های پنل: {plan['inbound_clients']}\n"]
+    for key, title in (('expired', "⏰ منقضی شده"), ('depleted', "📦 اتمام حجم")):
+        lines.append(f"{title}: {len(plan[key])}")
+        for _, email in plan[key][:limit]:
+            lines.append(f"  • {email}")
+        if len(plan[key]) > limit:
+            lines.append(f"  ... و {len(plan[key]) - limit} مورد دیگر")
+
+    if plan.get('outdated'):
+        lines.append("\n⚠️ فهرست قبلی منقضی شده است؛ فهرست بالا را بررسی و دوباره تأیید کنید.")
+    if 'removed' in plan:
+        lines.append(f"\n✅ {plan['removed']} کلاینت از پنل حذف و {plan['deactivated']} کانفیگ غیرفعال شد.")
+        if plan['skipped']:
+            lines.append(f"ℹ️ {plan['skipped']} کلاینت فهرست‌شده دیگر شرایط حذف را نداشت و باقی ماند.")
+        if plan['failed']:
+            lines.append(f"❌ حذف {plan['failed']} کلاینت از پنل ناموفق بود: {plan['error']}")
+    return "\n".join(lines)
+
+def cleanup_count(plan):
+    """Number of clients a plan would remove"""
+    return len(plan['expired']) + len(plan['depleted']) if plan else 0
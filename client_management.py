@@ -173,9 +173,6 @@ async def show_all_clients(query, context, page=0, admin_ids=config.ADMIN_IDS):
     # Add back button
     keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data="admin_menu")])
 
-    # Save current client list in context for later use
-    context.user_data['client_list'] = clients
-
     await query.edit_message_text(
         message,
         reply_markup=InlineKeyboardMarkup(keyboard)
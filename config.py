@@ -24,4 +24,26 @@ DB_FILE = "xui_bot_.db"
 
 payment_msg = "for example your bank card number or payment link"
 
-ALLOW_BUY = False
\ No newline at end of file
+ALLOW_BUY = False
+
+# Metrics configuration
+METRICS_PORT = 0  # Port for the local /metrics endpoint, 0 to disable
+
+# Subscription endpoint
+SUBSCRIPTION_PORT = 0  # Port for the local /sub/<sub_id> endpoint, 0 to disable
+SUBSCRIPTION_HOST = "127.0.0.1"  # Interface the subscription endpoint listens on
+SUBSCRIPTION_BASE_URL = ""  # Public URL users add to their clients, e.g. "https://sub.example.com/sub/", empty to hide it
+
+# Bulk payment approval
+BULK_APPROVAL_WORKERS = 4  # Payments provisioned on the XUI panel at the same time
+
+# Admin notifications
+ADMIN_GROUP_ID = None  # Group chat that receives admin notifications instead of each admin, None to message admins
+
+# Panel/database reconciliation
+RECONCILE_INTERVAL_HOURS = 6  # Hours between scheduled reconciliations, 0 to disable
+RECONCILE_AUTO_REPAIR = False  # Let scheduled runs fix the database, not just report drift
+
+# Expired/depleted client cleanup
+CLEANUP_INTERVAL_HOURS = 24  # Hours between cleanup reports sent to admins, 0 to disable
+CLEANUP_GRACE_DAYS = 3  # Days after expiry or running out of traffic before a client is removed
@@ -0,0 +1,14 @@
+"""
+Client connection links
+Builds the vless:// links users import into their VPN apps, shared by the
+bot messages and the subscription server.
+"""
+from config import IPDOMAIN, PORT, HOST, SNI
+
+def generate_vless_link(client_id, email):
+    """Generate a VLESS link for the client"""
+    return (
+        f"vless://{client_id}@{IPDOMAIN}:{PORT}"
+        f"?type=ws&path=%2F&host={HOST}&security=tls&fp=firefox&alpn=h3%2Ch2%2Chttp%2F1.1&sni={SNI}"
+        f"#{email}"
+    )
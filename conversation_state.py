@@ -0,0 +1,152 @@
+"""
+Per-user conversation state with expiry
+Tracks which multi-step flow a user is in (sending a receipt, writing a
+ticket, ...) inside context.user_data, so it is persisted with the rest of
+the user's data. Each state has a TTL; expired states are ignored on access
+and removed by a periodic sweeper, which also reports memory usage.
+"""
+import asyncio
+import logging
+import sys
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+AWAITING_RECEIPT = "awaiting_receipt"
+AWAITING_TICKET_SUBJECT = "awaiting_ticket_subject"
+AWAITING_REPLY = "awaiting_reply"
+AWAITING_BROADCAST = "awaiting_broadcast"
+AWAITING_USER_SEARCH = "awaiting_user_search"
+AWAITING_TICKET_SEARCH = "awaiting_ticket_search"
+
+# Seconds a state stays valid after it was entered
+STATE_TTLS = {
+    AWAITING_RECEIPT: 24 * 3600,
+    AWAITING_TICKET_SUBJECT: 30 * 60,
+    AWAITING_REPLY: 30 * 60,
+    AWAITING_BROADCAST: 10 * 60,
+    AWAITING_USER_SEARCH: 10 * 60,
+    AWAITING_TICKET_SEARCH: 10 * 60,
+}
+
+SWEEP_INTERVAL_SECONDS = 300
+
+# user_data key holding the current state entry
+STATE_KEY = 'conversation'
+
+STATE_COUNT = metrics.Gauge("vpnbot_conversation_states", "Users currently in each conversation state", ["state"])
+USER_DATA_BYTES = metrics.Gauge("vpnbot_user_data_bytes", "Approximate memory held by user_data after the last sweep")
+
+# Running sweeper task, see start_sweeper
+_sweeper_task = None
+
+def set_state(user_data, state, **data):
+    """Enter a conversation state, replacing any previous one"""
+    user_data[STATE_KEY] = {
+        'state': state,
+        'data': data,
+        'expires_at': time.time() + STATE_TTLS[state],
+    }
+
+def get_state(user_data, state):
+    """Return the data of `state` if it is the user's current, unexpired state, else None"""
+    entry = user_data.get(STATE_KEY)
+    if not entry:
+        return None
+    if entry['expires_at'] < time.time():
+        del user_data[STATE_KEY]
+        return None
+    if entry['state'] != state:
+        return None
+    return entry['data']
+
+def clear_state(user_data):
+    """Leave the current conversation state"""
+    user_data.pop(STATE_KEY, None)
+
+def _deep_sizeof(value, seen=None):
+    """Approximate memory used by a value and everything it references"""
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_deep_sizeof(k, seen) + _deep_sizeof(v, seen) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(_deep_sizeof(item, seen) for item in value)
+    return size
+
+def sweep(application):
+    """Drop expired states and empty user_data, and update memory accounting
+
+    Returns:
+        int: Number of expired states removed
+    """
+    now = time.time()
+    removed = 0
+    counts = {state: 0 for state in STATE_TTLS}
+    total_bytes = 0
+    empty_users = []
+    expired_users = []
+
+    for user_id, user_data in list(application.user_data.items()):
+        entry = user_data.get(STATE_KEY)
+        if entry:
+            if entry['expires_at'] < now:
+                del user_data[STATE_KEY]
+                expired_users.append(user_id)
+                removed += 1
+            else:
+                counts[entry['state']] = counts.get(entry['state'], 0) + 1
+        if not user_data:
+            empty_users.append(user_id)
+        else:
+            total_bytes += _deep_sizeof(user_data)
+
+    for user_id in empty_users:
+        application.drop_user_data(user_id)
+    # The sweep runs outside any update, so persistence would otherwise never
+    # write the removals and the states would come back after a restart
+    kept_users = set(expired_users).difference(empty_users)
+    if kept_users:
+        application.mark_data_for_update_persistence(user_ids=kept_users)
+
+    for state, count in counts.items():
+        STATE_COUNT.set(count, state)
+    USER_DATA_BYTES.set(total_bytes)
+
+    if removed or empty_users:
+        logger.info(f"Conversation sweep removed {removed} expired states and {len(empty_users)} empty users, "
+                    f"user_data now ~{total_bytes / 1024:.1f} KiB")
+    return removed
+
+async def run_sweeper(application, interval=SWEEP_INTERVAL_SECONDS):
+    """Sweep expired conversation states forever"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            sweep(application)
+        except Exception as e:
+            logger.error(f"Error sweeping conversation states: {e}")
+
+def start_sweeper(application, interval=SWEEP_INTERVAL_SECONDS):
+    """Run the sweeper as a task on the running loop, until stop_sweeper is called"""
+    global _sweeper_task
+    _sweeper_task = asyncio.get_running_loop().create_task(
+        run_sweeper(application, interval), name="conversation_sweeper")
+
+async def stop_sweeper():
+    """Cancel the sweeper task started by start_sweeper and wait for it to end"""
+    global _sweeper_task
+    task, _sweeper_task = _sweeper_task, None
+    if task is None:
+        return
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
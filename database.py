@@ -3,11 +3,21 @@ Database operations for the VPN bot
 """
 import sqlite3
 import logging
-from datetime import datetime
+import secrets
+from datetime import datetime, timedelta
 from config import DB_FILE
+import metrics
 
 logger = logging.getLogger(__name__)
 
+# Seconds after which a payment stuck in 'processing' (e.g. the bot crashed
+# mid-approval) is offered to admins for a check against the panel. Such
+# payments are never claimed again automatically.
+PAYMENT_CLAIM_TIMEOUT = 600
+
+# Most recent matching messages and subjects ranked per ticket search
+TICKET_SEARCH_HIT_LIMIT = 500
+
 def init_db():
     """Initialize database tables if they don't exist"""
     conn = sqlite3.connect(DB_FILE)
@@ -48,6 +58,17 @@ def init_db():
         ADD COLUMN last_notified TIMESTAMP
         ''')
 
+    # Add depleted_at column, set when cleanup first sees a config out of traffic
+    if 'depleted_at' not in columns:
+        logger.info("Adding depleted_at column to configs table")
+        cursor.execute('''
+        ALTER TABLE configs
+        ADD COLUMN depleted_at TIMESTAMP
+        ''')
+
+    # Cleanup, reconciliation and client deletion look configs up by client_id
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_configs_client_id ON configs (client_id)")
+
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS status_logs (
         log_id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -72,6 +93,55 @@ def init_db():
     )
     ''')
 
+    # Extension requests keep their target config with the payment row,
+    # claimed/processed columns record the outcome of approve/reject, and
+    # provision_* columns record what an approval is about to change on the
+    # panel, so a retry can tell whether the change already happened
+    cursor.execute("PRAGMA table_info(payments)")
+    payment_columns = [column_info[1] for column_info in cursor.fetchall()]
+    for column, column_type in (('extension_unknown', 'BOOLEAN NOT NULL DEFAULT 0'), ('extension_email', 'TEXT'), ('extension_client_id', 'TEXT'),
+                                ('extension_gb', 'INTEGER'), ('extension_days', 'INTEGER'),
+                                ('claimed_at', 'TIMESTAMP'), ('processed_at', 'TIMESTAMP'),
+                                ('processed_by', 'INTEGER'), ('result', 'TEXT'),
+                                ('receipt_unique_id', 'TEXT'), ('duplicate_of', 'INTEGER'), ('provision_email', 'TEXT'),
+                                ('provision_client_id', 'TEXT'), ('provision_base_gb', 'REAL')):
+        if column not in payment_columns:
+            logger.info(f"Adding {column} column to payments table")
+            cursor.execute(f"ALTER TABLE payments ADD COLUMN {column} {column_type}")
+    if 'extension_email' not in payment_columns:
+        # Open payments from before extension details were stored may be
+        # extensions; only the admin caption of their receipt tells
+        cursor.execute("UPDATE payments SET extension_unknown = 1 WHERE status IN ('pending', 'processing')")
+        if cursor.rowcount:
+            logger.info(f"Marked {cursor.rowcount} open payments as needing their receipt caption to approve")
+
+    # The first payment with a receipt owns it; resubmissions point at it through duplicate_of
+    cursor.execute('''
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_payments_receipt_unique ON payments (receipt_unique_id)
+    WHERE receipt_unique_id IS NOT NULL AND duplicate_of IS NULL
+    ''')
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_payments_receipt_hash'")
+    if cursor.fetchone():
+        # Receipts used to be matched by perceptual hash too, which flagged
+        # different receipts from the same banking app; keep only flags with
+        # the same file_unique_id, pointing each at the first payment that has it
+        logger.info("Re-checking receipts flagged as duplicates by perceptual hash")
+        cursor.execute("DROP INDEX idx_payments_receipt_hash")
+        cursor.execute('''
+        SELECT p.payment_id, p.receipt_unique_id FROM payments p
+        JOIN payments original ON original.payment_id = p.duplicate_of
+        WHERE p.receipt_unique_id IS NOT original.receipt_unique_id
+        ORDER BY p.payment_id
+        ''')
+        for payment_id, receipt_unique_id in cursor.fetchall():
+            cursor.execute('''
+            SELECT payment_id FROM payments
+            WHERE receipt_unique_id = ? AND duplicate_of IS NULL AND payment_id < ?
+            ''', (receipt_unique_id, payment_id))
+            original = cursor.fetchone()
+            cursor.execute("UPDATE payments SET duplicate_of = ? WHERE payment_id = ?",
+                           (original[0] if original else None, payment_id))
+
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS tickets (
         ticket_id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -94,9 +164,351 @@ def init_db():
         FOREIGN KEY (sender_id) REFERENCES users (user_id)
     )''')
 
+    # Per-ticket summary maintained by triggers, so the admin queue is an index range scan
+    cursor.execute("PRAGMA table_info(tickets)")
+    ticket_columns = [column_info[1] for column_info in cursor.fetchall()]
+    added_summary = False
+    for column, column_type in (('last_message_at', 'TIMESTAMP'), ('message_count', 'INTEGER NOT NULL DEFAULT 0'),
+                                ('last_sender_is_admin', 'BOOLEAN'), ('status_rank', 'INTEGER')):
+        if column not in ticket_columns:
+            logger.info(f"Adding {column} column to tickets table")
+            cursor.execute(f"ALTER TABLE tickets ADD COLUMN {column} {column_type}")
+            added_summary = True
+    for name, body in _TICKET_SUMMARY_TRIGGERS.items():
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {body}")
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_ticket_messages_ticket ON ticket_messages (ticket_id, created_at, message_id)
+    ''')
+    if added_summary:
+        _rebuild_ticket_summaries(cursor)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tickets_queue ON tickets (status_rank, created_at DESC)")
+
+    _create_ticket_search(cursor)
+
+    # Persisted context.user_data / context.bot_data entries, one pickled value per key
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS user_state (
+        user_id INTEGER,
+        key TEXT,
+        value TEXT,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (user_id, key)
+    )''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS bot_state (
+        key TEXT PRIMARY KEY,
+        value TEXT,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+
+    # Indexes for the admin user browser and per-user lookups
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users (username COLLATE NOCASE)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_configs_user ON configs (user_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_payments_user ON payments (user_id)")
+
+    # Telegram file_id of each config's uploaded QR code, valid while the link hash matches
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS config_qr_codes (
+        client_id TEXT PRIMARY KEY,
+        link_hash TEXT,
+        file_id TEXT
+    )''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS config_qr_code_delete AFTER DELETE ON configs BEGIN
+        DELETE FROM config_qr_codes WHERE client_id = OLD.client_id;
+    END''')
+
+    _create_subscription_tables(cursor)
+    _create_stats_tables(cursor)
+
     conn.commit()
     conn.close()
 
+def _bump(name_sql, delta_sql):
+    """SQL adding delta_sql to the stats counter named by name_sql"""
+    return (f"INSERT INTO stats_counters (name, value) VALUES ({name_sql}, {delta_sql}) "
+            f"ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;")
+
+def _bump_user_active(user_sql, delta_sql):
+    return (f"INSERT INTO user_active_configs (user_id, active_count) VALUES ({user_sql}, {delta_sql}) "
+            f"ON CONFLICT(user_id) DO UPDATE SET active_count = active_count + excluded.active_count;")
+
+# Triggers keeping the dashboard aggregates in step with every write
+_STATS_TRIGGERS = {
+    'stats_users_insert': f'''
+    AFTER INSERT ON users BEGIN
+        {_bump("'users'", "1")}
+    END''',
+    'stats_users_delete': f'''
+    AFTER DELETE ON users BEGIN
+        {_bump("'users'", "-1")}
+    END''',
+    'stats_configs_insert': f'''
+    AFTER INSERT ON configs WHEN NEW.is_active BEGIN
+        {_bump("'active_configs'", "1")}
+        {_bump_user_active("NEW.user_id", "1")}
+    END''',
+    'stats_configs_delete': f'''
+    AFTER DELETE ON configs WHEN OLD.is_active BEGIN
+        {_bump("'active_configs'", "-1")}
+        {_bump_user_active("OLD.user_id", "-1")}
+    END''',
+    'stats_configs_update': f'''
+    AFTER UPDATE OF is_active, user_id ON configs
+    WHEN (CASE WHEN OLD.is_active THEN 1 ELSE 0 END) != (CASE WHEN NEW.is_active THEN 1 ELSE 0 END)
+      OR OLD.user_id IS NOT NEW.user_id BEGIN
+        {_bump("'active_configs'", "(CASE WHEN NEW.is_active THEN 1 ELSE 0 END) - (CASE WHEN OLD.is_active THEN 1 ELSE 0 END)")}
+        {_bump_user_active("OLD.user_id", "-(CASE WHEN OLD.is_active THEN 1 ELSE 0 END)")}
+        {_bump_user_active("NEW.user_id", "CASE WHEN NEW.is_active THEN 1 ELSE 0 END")}
+    END''',
+    'stats_user_active_insert': f'''
+    AFTER INSERT ON user_active_configs WHEN NEW.active_count > 0 BEGIN
+        {_bump("'active_users'", "1")}
+    END''',
+    'stats_user_active_update': f'''
+    AFTER UPDATE OF active_count ON user_active_configs
+    WHEN (OLD.active_count > 0) != (NEW.active_count > 0) BEGIN
+        {_bump("'active_users'", "CASE WHEN NEW.active_count > 0 THEN 1 ELSE -1 END")}
+    END''',
+    'stats_payments_insert': f'''
+    AFTER INSERT ON payments BEGIN
+        {_bump("'payments_' || NEW.status", "1")}
+    END''',
+    'stats_payments_delete': f'''
+    AFTER DELETE ON payments BEGIN
+        {_bump("'payments_' || OLD.status", "-1")}
+    END''',
+    'stats_payments_update': f'''
+    AFTER UPDATE OF status ON payments WHEN OLD.status != NEW.status BEGIN
+        {_bump("'payments_' || OLD.status", "-1")}
+        {_bump("'payments_' || NEW.status", "1")}
+    END''',
+    'stats_payments_approved': f'''
+    AFTER UPDATE OF status ON payments WHEN NEW.status = 'approved' AND OLD.status != 'approved' BEGIN
+        {_bump("'traffic_sold_gb'", "CAST(NEW.plan AS REAL)")}
+        INSERT INTO daily_plan_approvals (day, plan, approvals, gb)
+        VALUES (date(COALESCE(NEW.approved_at, datetime('now', 'localtime'))), NEW.plan, 1, CAST(NEW.plan AS REAL))
+        ON CONFLICT(day, plan) DO UPDATE SET approvals = approvals + 1, gb = gb + excluded.gb;
+    END''',
+    'stats_tickets_insert': f'''
+    AFTER INSERT ON tickets BEGIN
+        {_bump("'tickets_' || NEW.status", "1")}
+    END''',
+    'stats_tickets_delete': f'''
+    AFTER DELETE ON tickets BEGIN
+        {_bump("'tickets_' || OLD.status", "-1")}
+    END''',
+    'stats_tickets_update': f'''
+    AFTER UPDATE OF status ON tickets WHEN OLD.status != NEW.status BEGIN
+        {_bump("'tickets_' || OLD.status", "-1")}
+        {_bump("'tickets_' || NEW.status", "1")}
+    END''',
+}
+
+# Bumps a user's config version whenever the set of their configs or their links change
+_CONFIG_VERSION_TRIGGERS = {
+    'config_version_insert': '''
+    AFTER INSERT ON configs BEGIN
+        INSERT INTO config_versions (user_id, version) VALUES (NEW.user_id, 1)
+        ON CONFLICT(user_id) DO UPDATE SET version = version + 1;
+    END''',
+    'config_version_update': '''
+    AFTER UPDATE OF user_id, email, client_id, is_active ON configs
+    WHEN OLD.user_id IS NOT NEW.user_id OR OLD.email IS NOT NEW.email
+        OR OLD.client_id IS NOT NEW.client_id OR OLD.is_active IS NOT NEW.is_active
+    BEGIN
+        INSERT INTO config_versions (user_id, version) VALUES (OLD.user_id, 1)
+        ON CONFLICT(user_id) DO UPDATE SET version = version + 1;
+        INSERT INTO config_versions (user_id, version) SELECT NEW.user_id, 1 WHERE NEW.user_id IS NOT OLD.user_id
+        ON CONFLICT(user_id) DO UPDATE SET version = version + 1;
+    END''',
+    'config_version_delete': '''
+    AFTER DELETE ON configs BEGIN
+        INSERT INTO config_versions (user_id, version) VALUES (OLD.user_id, 1)
+        ON CONFLICT(user_id) DO UPDATE SET version = version + 1;
+    END''',
+}
+
+def _create_subscription_tables(cursor):
+    """Create the subscription id column and the config versions used to invalidate cached subscriptions"""
+    cursor.execute("PRAGMA table_info(users)")
+    if 'sub_id' not in [column_info[1] for column_info in cursor.fetchall()]:
+        logger.info("Adding sub_id column to users table")
+        cursor.execute("ALTER TABLE users ADD COLUMN sub_id TEXT")
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_sub_id ON users (sub_id) WHERE sub_id IS NOT NULL")
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS config_versions (
+        user_id INTEGER PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0
+    )''')
+    for name, body in _CONFIG_VERSION_TRIGGERS.items():
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {body}")
+
+# Queue position of a ticket status: open, then answered, then closed
+_TICKET_STATUS_RANK = "CASE {status} WHEN 'open' THEN 1 WHEN 'answered' THEN 2 ELSE 3 END"
+
+_TICKET_SUMMARY_TRIGGERS = {
+    'ticket_summary_message_insert': '''
+    AFTER INSERT ON ticket_messages BEGIN
+        UPDATE tickets
+        SET last_message_at = NEW.created_at,
+            message_count = message_count + 1,
+            last_sender_is_admin = NEW.is_admin
+        WHERE ticket_id = NEW.ticket_id;
+    END''',
+    'ticket_summary_insert': f'''
+    AFTER INSERT ON tickets BEGIN
+        UPDATE tickets SET status_rank = {_TICKET_STATUS_RANK.format(status="NEW.status")}
+        WHERE ticket_id = NEW.ticket_id;
+    END''',
+    'ticket_summary_status': f'''
+    AFTER UPDATE OF status ON tickets BEGIN
+        UPDATE tickets SET status_rank = {_TICKET_STATUS_RANK.format(status="NEW.status")}
+        WHERE ticket_id = NEW.ticket_id;
+    END''',
+}
+
+def _rebuild_ticket_summaries(cursor):
+    """Recompute the per-ticket summary columns from ticket_messages"""
+    cursor.execute(f'''
+    UPDATE tickets SET
+        status_rank = {_TICKET_STATUS_RANK.format(status="status")},
+        message_count = (SELECT COUNT(*) FROM ticket_messages m WHERE m.ticket_id = tickets.ticket_id),
+        last_message_at = (SELECT MAX(created_at) FROM ticket_messages m WHERE m.ticket_id = tickets.ticket_id),
+        last_sender_is_admin = (
+            SELECT is_admin FROM ticket_messages m WHERE m.ticket_id = tickets.ticket_id
+            ORDER BY created_at DESC, message_id DESC LIMIT 1
+        )
+    ''')
+
+# External-content FTS5 indexes over ticket messages and subjects, kept in sync
+# with the base tables as described in the FTS5 documentation
+_TICKET_SEARCH_TRIGGERS = {
+    'ticket_messages_fts_insert': '''
+    AFTER INSERT ON ticket_messages BEGIN
+        INSERT INTO ticket_messages_fts (rowid, message) VALUES (NEW.message_id, NEW.message);
+    END''',
+    'ticket_messages_fts_delete': '''
+    AFTER DELETE ON ticket_messages BEGIN
+        INSERT INTO ticket_messages_fts (ticket_messages_fts, rowid, message)
+        VALUES ('delete', OLD.message_id, OLD.message);
+    END''',
+    'ticket_messages_fts_update': '''
+    AFTER UPDATE OF message ON ticket_messages BEGIN
+        INSERT INTO ticket_messages_fts (ticket_messages_fts, rowid, message)
+        VALUES ('delete', OLD.message_id, OLD.message);
+        INSERT INTO ticket_messages_fts (rowid, message) VALUES (NEW.message_id, NEW.message);
+    END''',
+    'tickets_fts_insert': '''
+    AFTER INSERT ON tickets BEGIN
+        INSERT INTO tickets_fts (rowid, subject) VALUES (NEW.ticket_id, NEW.subject);
+    END''',
+    'tickets_fts_delete': '''
+    AFTER DELETE ON tickets BEGIN
+        INSERT INTO tickets_fts (tickets_fts, rowid, subject) VALUES ('delete', OLD.ticket_id, OLD.subject);
+    END''',
+    'tickets_fts_update': '''
+    AFTER UPDATE OF subject ON tickets BEGIN
+        INSERT INTO tickets_fts (tickets_fts, rowid, subject) VALUES ('delete', OLD.ticket_id, OLD.subject);
+        INSERT INTO tickets_fts (rowid, subject) VALUES (NEW.ticket_id, NEW.subject);
+    END''',
+}
+
+def _create_ticket_search(cursor):
+    """Create the ticket full-text indexes, or leave search on LIKE if FTS5 is unavailable"""
+    cursor.execute("SELECT name FROM sqlite_master WHERE name IN ('ticket_messages_fts', 'tickets_fts')")
+    existing = {row[0] for row in cursor.fetchall()}
+    try:
+        cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS ticket_messages_fts
+        USING fts5(message, content='ticket_messages', content_rowid='message_id')
+        ''')
+        cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS tickets_fts
+        USING fts5(subject, content='tickets', content_rowid='ticket_id')
+        ''')
+    except sqlite3.OperationalError as e:
+        logger.warning(f"Full-text ticket search unavailable, falling back to LIKE: {e}")
+        return
+
+    for name, body in _TICKET_SEARCH_TRIGGERS.items():
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {body}")
+
+    # Index existing tickets the first time
+    if 'ticket_messages_fts' not in existing:
+        cursor.execute("INSERT INTO ticket_messages_fts (ticket_messages_fts) VALUES ('rebuild')")
+    if 'tickets_fts' not in existing:
+        cursor.execute("INSERT INTO tickets_fts (tickets_fts) VALUES ('rebuild')")
+
+def _create_stats_tables(cursor):
+    """Create the dashboard aggregate tables and the triggers that maintain them"""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS stats_counters (
+        name TEXT PRIMARY KEY,
+        value REAL NOT NULL DEFAULT 0
+    )''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS user_active_configs (
+        user_id INTEGER PRIMARY KEY,
+        active_count INTEGER NOT NULL DEFAULT 0
+    )''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS daily_plan_approvals (
+        day TEXT,
+        plan TEXT,
+        approvals INTEGER NOT NULL DEFAULT 0,
+        gb REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, plan)
+    )''')
+
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'stats_%'")
+    existing = {row[0] for row in cursor.fetchall()}
+    for name, body in _STATS_TRIGGERS.items():
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {body}")
+
+    # Fill the aggregates from existing data the first time the triggers are installed
+    if not existing:
+        _rebuild_stats(cursor)
+
+def _rebuild_stats(cursor):
+    """Recompute every dashboard aggregate from the base tables"""
+    cursor.execute("DELETE FROM stats_counters")
+    cursor.execute("DELETE FROM user_active_configs")
+    cursor.execute("DELETE FROM daily_plan_approvals")
+
+    cursor.execute("INSERT INTO stats_counters (name, value) SELECT 'users', COUNT(*) FROM users")
+    # The user_active_configs insert trigger counts active_users
+    cursor.execute('''
+    INSERT INTO user_active_configs (user_id, active_count)
+    SELECT user_id, COUNT(*) FROM configs WHERE is_active GROUP BY user_id
+    ''')
+    cursor.execute('''
+    INSERT INTO stats_counters (name, value)
+    SELECT 'active_configs', COUNT(*) FROM configs WHERE is_active
+    ''')
+    cursor.execute('''
+    INSERT INTO stats_counters (name, value)
+    SELECT 'payments_' || status, COUNT(*) FROM payments GROUP BY status
+    ''')
+    cursor.execute('''
+    INSERT INTO stats_counters (name, value)
+    SELECT 'tickets_' || status, COUNT(*) FROM tickets GROUP BY status
+    ''')
+    cursor.execute('''
+    INSERT INTO stats_counters (name, value)
+    SELECT 'traffic_sold_gb', COALESCE(SUM(CAST(plan AS REAL)), 0) FROM payments WHERE status = 'approved'
+    ''')
+    cursor.execute('''
+    INSERT INTO daily_plan_approvals (day, plan, approvals, gb)
+    SELECT date(approved_at), plan, COUNT(*), SUM(CAST(plan AS REAL))
+    FROM payments WHERE status = 'approved' AND approved_at IS NOT NULL
+    GROUP BY date(approved_at), plan
+    ''')
+
 def get_or_create_user(user_id, username, first_name, last_name):
     """Get or create a user record"""
     conn = sqlite3.connect(DB_FILE)
@@ -126,6 +538,32 @@ def save_new_config(user_id, email, client_id, total_gb):
     conn.close()
     return config_id
 
+def save_new_configs(configs):
+    """Save several VPN configurations in one transaction
+
+    Args:
+        configs (list): List of (user_id, email, client_id, total_gb) tuples
+
+    Returns:
+        int: Number of saved configurations
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    try:
+        cursor.executemany('''
+        INSERT INTO configs (user_id, email, client_id, total_gb)
+        VALUES (?, ?, ?, ?)
+        ''', configs)
+        conn.commit()
+        return len(configs)
+    except Exception as e:
+        logger.error(f"Error saving configs in bulk: {e}")
+        conn.rollback()
+        return 0
+    finally:
+        conn.close()
+
 def get_user_configs(user_id):
     """Get all VPN configurations for a user"""
     conn = sqlite3.connect(DB_FILE)
@@ -155,20 +593,56 @@ def log_status_check(config_id, remaining_gb, remaining_days):
     conn.commit()
     conn.close()
 
-def save_payment_request(user_id, plan_name, file_id):
-    """Save a payment request"""
+def save_payment_request(user_id, plan_name, file_id, extension=None, receipt_unique_id=None):
+    """Save a payment request, flagging receipts that were sent before
+
+    A receipt is a resubmission if an earlier payment has the same Telegram
+    file_unique_id. The lookup uses the receipt index, and the write lock is
+    taken first so concurrent resubmissions agree on the original.
+
+    Args:
+        user_id (int): User who sent the receipt
+        plan_name (str): Plan the payment is for
+        file_id (str): Telegram file_id of the receipt photo
+        extension (dict, optional): For extension requests, the target config as
+            {'email', 'client_id', 'gb', 'days'}
+        receipt_unique_id (str, optional): Telegram file_unique_id of the receipt photo
+
+    Returns:
+        tuple: (payment_id, duplicate) where duplicate is (payment_id, status)
+               of the earlier payment with the same receipt, or None
+    """
     conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
 
-    cursor.execute('''
-    INSERT INTO payments (user_id, plan, receipt_file_id)
-    VALUES (?, ?, ?)
-    ''', (user_id, plan_name, file_id))
+    extension = extension or {}
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        duplicate = None
+        if receipt_unique_id:
+            cursor.execute('''
+            SELECT payment_id, status FROM payments
+            WHERE receipt_unique_id = ? AND duplicate_of IS NULL
+            ''', (receipt_unique_id,))
+            duplicate = cursor.fetchone()
 
-    payment_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    return payment_id
+        cursor.execute('''
+        INSERT INTO payments (user_id, plan, receipt_file_id,
+                              extension_email, extension_client_id, extension_gb, extension_days,
+                              receipt_unique_id, duplicate_of)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (user_id, plan_name, file_id, extension.get('email'), extension.get('client_id'),
+              extension.get('gb'), extension.get('days'), receipt_unique_id,
+              duplicate[0] if duplicate else None))
+
+        payment_id = cursor.lastrowid
+        conn.commit()
+        return payment_id, duplicate
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
 
 def update_payment_status(payment_id, status, approved_at=None):
     """Update the status of a payment"""
@@ -186,21 +660,288 @@ def update_payment_status(payment_id, status, approved_at=None):
     conn.commit()
     conn.close()
 
+def _select_payment_info(cursor, payment_id, status):
+    cursor.execute('''
+    SELECT p.user_id, p.plan, u.username,
+           p.extension_email, p.extension_client_id, p.extension_gb, p.extension_days,
+           p.provision_email, p.provision_client_id, p.provision_base_gb
+    FROM payments p
+    LEFT JOIN users u ON p.user_id = u.user_id
+    WHERE p.payment_id = ? AND p.status = ?
+    ''', (payment_id, status))
+
+    payment = cursor.fetchone()
+    if not payment:
+        return None
+    return _payment_info_from_row(payment)
+
+def _payment_info_from_row(row):
+    (user_id, plan, username, ext_email, ext_client_id, ext_gb, ext_days,
+     provision_email, provision_client_id, provision_base_gb) = row
+    extension = None
+    if ext_email:
+        extension = {'email': ext_email, 'client_id': ext_client_id, 'gb': ext_gb, 'days': ext_days}
+    provision = None
+    if provision_email:
+        provision = {'email': provision_email, 'client_id': provision_client_id, 'base_gb': provision_base_gb}
+    return user_id, plan, username, extension, provision
+
 def get_payment_info(payment_id):
-    """Get payment information"""
+    """Get information about a pending payment
+
+    Returns:
+        tuple: (user_id, plan, username, extension, provision) where extension is a
+               dict with 'email', 'client_id', 'gb' and 'days' for extension requests,
+               and provision is the dict recorded by record_payment_provision by an
+               earlier attempt ('email', 'client_id', 'base_gb'), else None.
+               None if the payment does not exist or is no longer pending.
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    payment = _select_payment_info(cursor, payment_id, 'pending')
+    conn.close()
+    return payment
+
+def claim_payment(payment_id, allow_unknown_type=False):
+    """Atomically move a payment from pending to processing
+
+    Only one caller can claim a payment; everyone else gets None. Payments left
+    in processing are not claimed again, see reclaim_stale_payment.
+
+    Args:
+        payment_id (int): Payment to claim
+        allow_unknown_type (bool): Also claim payments whose extension details
+            were never stored (see resolve_payment_type), e.g. to reject them
+
+    Returns:
+        tuple: Same as get_payment_info if the payment was claimed, else None
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    try:
+        cursor.execute('''
+        UPDATE payments SET status = 'processing', claimed_at = ?
+        WHERE payment_id = ? AND status = 'pending' AND (? OR NOT extension_unknown)
+        ''', (now, payment_id, allow_unknown_type))
+        if cursor.rowcount != 1:
+            conn.rollback()
+            return None
+        payment = _select_payment_info(cursor, payment_id, 'processing')
+        if payment is None:
+            conn.rollback()
+            return None
+        conn.commit()
+        return payment
+    finally:
+        conn.close()
+
+def resolve_payment_type(payment_id, extension):
+    """Record what a payment from before extension details were stored is for
+
+    Args:
+        payment_id (int): Payment marked extension_unknown by the migration
+        extension (dict): {'email', 'client_id', 'gb', 'days'}, or None for a new config
+
+    Returns:
+        bool: True if the payment was unresolved and is now resolved
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    extension = extension or {}
+    cursor.execute('''
+    UPDATE payments
+    SET extension_unknown = 0, extension_email = ?, extension_client_id = ?,
+        extension_gb = ?, extension_days = ?
+    WHERE payment_id = ? AND extension_unknown
+    ''', (extension.get('email'), extension.get('client_id'), extension.get('gb'),
+          extension.get('days'), payment_id))
+    resolved = cursor.rowcount == 1
+
+    conn.commit()
+    conn.close()
+    return resolved
+
+def get_pending_payment_ids():
+    """Get the pending payments that can be approved together, oldest first
+
+    Resubmitted receipts are left out; they need a decision of their own.
+
+    Returns:
+        tuple: (payment_ids, duplicates) where duplicates is the number of
+               pending payments left out because their receipt was sent before
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    cursor.execute("SELECT payment_id, duplicate_of FROM payments WHERE status = 'pending' ORDER BY submitted_at")
+    rows = cursor.fetchall()
+    payment_ids = [payment_id for payment_id, duplicate_of in rows if duplicate_of is None]
+
+    conn.close()
+    return payment_ids, len(rows) - len(payment_ids)
+
+def reclaim_stale_payment(payment_id):
+    """Take over a payment left in processing for longer than PAYMENT_CLAIM_TIMEOUT
+
+    For an explicit admin retry: the caller must check the panel for the
+    change recorded by record_payment_provision before provisioning again.
+
+    Returns:
+        tuple: Same as get_payment_info if the payment was reclaimed, else None
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    now = datetime.now()
+    stale_before = datetime.fromtimestamp(now.timestamp() - PAYMENT_CLAIM_TIMEOUT).strftime('%Y-%m-%d %H:%M:%S')
+    try:
+        cursor.execute('''
+        UPDATE payments SET claimed_at = ?
+        WHERE payment_id = ? AND status = 'processing' AND claimed_at < ?
+        ''', (now.strftime('%Y-%m-%d %H:%M:%S'), payment_id, stale_before))
+        if cursor.rowcount != 1:
+            conn.rollback()
+            return None
+        payment = _select_payment_info(cursor, payment_id, 'processing')
+        if payment is None:
+            conn.rollback()
+            return None
+        conn.commit()
+        return payment
+    finally:
+        conn.close()
+
+def get_stale_payments():
+    """Get payments left in processing for longer than PAYMENT_CLAIM_TIMEOUT
+
+    Returns:
+        list: (payment_id, user_id, plan, first_name, username, claimed_at) tuples, oldest first
+    """
     conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
 
+    stale_before = (datetime.now() - timedelta(seconds=PAYMENT_CLAIM_TIMEOUT)).strftime('%Y-%m-%d %H:%M:%S')
     cursor.execute('''
-    SELECT p.user_id, p.plan, u.username 
+    SELECT p.payment_id, p.user_id, p.plan, COALESCE(u.first_name, CAST(p.user_id AS TEXT)), u.username, p.claimed_at
     FROM payments p
-    JOIN users u ON p.user_id = u.user_id
-    WHERE p.payment_id = ? AND p.status = 'pending'
+    LEFT JOIN users u ON p.user_id = u.user_id
+    WHERE p.status = 'processing' AND p.claimed_at < ?
+    ORDER BY p.claimed_at
+    ''', (stale_before,))
+
+    payments = cursor.fetchall()
+    conn.close()
+    return payments
+
+def record_payment_provision(payment_id, email, client_id, base_gb=None):
+    """Record the panel change a claimed payment is about to make, before making it
+
+    Args:
+        payment_id (int): Claimed payment
+        email (str): Email of the client being created or extended
+        client_id (str): UUID of that client
+        base_gb (float, optional): For extensions, the client's total GB before the extension
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    cursor.execute('''
+    UPDATE payments SET provision_email = ?, provision_client_id = ?, provision_base_gb = ?
+    WHERE payment_id = ? AND status = 'processing'
+    ''', (email, client_id, base_gb, payment_id))
+
+    conn.commit()
+    conn.close()
+
+def release_payment(payment_id):
+    """Return a claimed payment to pending after a failed attempt"""
+    release_payments([payment_id])
+
+def release_payments(payment_ids):
+    """Return several claimed payments to pending in one transaction"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    cursor.executemany('''
+    UPDATE payments SET status = 'pending', claimed_at = NULL
+    WHERE payment_id = ? AND status = 'processing'
+    ''', [(payment_id,) for payment_id in payment_ids])
+
+    conn.commit()
+    conn.close()
+
+def finish_payment(payment_id, status, result, processed_by=None):
+    """Record the outcome of a claimed payment
+
+    Args:
+        payment_id (int): Payment that was claimed with claim_payment
+        status (str): 'approved' or 'rejected'
+        result (str): What was done, e.g. the created or extended config email
+        processed_by (int, optional): Admin who processed the payment
+    """
+    finish_payments([(payment_id, status, result, processed_by)])
+
+def finish_payments(outcomes):
+    """Record the outcome of several claimed payments in one transaction
+
+    Args:
+        outcomes (list): (payment_id, status, result, processed_by) tuples
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    cursor.executemany('''
+    UPDATE payments
+    SET status = ?, result = ?, processed_at = ?, processed_by = ?,
+        approved_at = CASE WHEN ? = 'approved' THEN ? ELSE approved_at END
+    WHERE payment_id = ? AND status = 'processing'
+    ''', [(status, result, now, processed_by, status, now, payment_id)
+          for payment_id, status, result, processed_by in outcomes])
+
+    conn.commit()
+    conn.close()
+
+def get_payment_outcome(payment_id):
+    """Get the recorded state of a payment
+
+    Returns:
+        tuple: (status, result, processed_at, extension_unknown) or None if the
+               payment does not exist
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    cursor.execute('''
+    SELECT status, result, processed_at, extension_unknown FROM payments WHERE payment_id = ?
     ''', (payment_id,))
 
-    payment = cursor.fetchone()
+    outcome = cursor.fetchone()
+    conn.close()
+    return outcome
+
+def set_payment_extension(payment_id, extension):
+    """Attach extension details to an existing payment
+
+    Args:
+        payment_id (int): Payment to update
+        extension (dict): {'email', 'client_id', 'gb', 'days'}
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    cursor.execute('''
+    UPDATE payments
+    SET extension_email = ?, extension_client_id = ?, extension_gb = ?, extension_days = ?
+    WHERE payment_id = ?
+    ''', (extension.get('email'), extension.get('client_id'), extension.get('gb'),
+          extension.get('days'), payment_id))
+
+    conn.commit()
     conn.close()
-    return payment
 
 def update_config_active_status(email, user_id, is_active):
     """Update the active status of a configuration"""
@@ -285,6 +1026,45 @@ def add_ticket_message(ticket_id, sender_id, message, is_admin):
     conn.commit()
     conn.close()
 
+def record_ticket_reply(ticket_id, sender_id, message, is_admin, owner_id=None):
+    """Add a reply to a ticket and set its status in one transaction
+
+    The ticket becomes 'answered' after an admin reply and 'open' after a
+    user reply.
+
+    Args:
+        ticket_id (int): Ticket ID
+        sender_id (int): User or admin sending the reply
+        message (str): Reply text
+        is_admin (bool): Whether the sender is an admin
+        owner_id (int, optional): Only reply if this user owns the ticket;
+                                  None for admins
+
+    Returns:
+        int: The ticket owner's user_id, or None if the ticket does not exist
+             or the caller may not reply to it
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    cursor.execute(
+        "UPDATE tickets SET status = ? WHERE ticket_id = ? AND (? IS NULL OR user_id = ?) RETURNING user_id",
+        ('answered' if is_admin else 'open', ticket_id, owner_id, owner_id)
+    )
+    row = cursor.fetchone()
+    if row is None:
+        conn.close()
+        return None
+
+    cursor.execute(
+        "INSERT INTO ticket_messages (ticket_id, sender_id, message, is_admin) VALUES (?, ?, ?, ?)",
+        (ticket_id, sender_id, message, is_admin)
+    )
+
+    conn.commit()
+    conn.close()
+    return row[0]
+
 def get_user_tickets(user_id):
     """Get all tickets for a user"""
     conn = sqlite3.connect(DB_FILE)
@@ -301,198 +1081,150 @@ def get_user_tickets(user_id):
     conn.close()
     return tickets
 
-def get_ticket_info(ticket_id):
-    """Get information about a ticket"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-
-    cursor.execute('''
-    SELECT t.subject, t.status, t.user_id, u.first_name, u.username 
-    FROM tickets t
-    JOIN users u ON t.user_id = u.user_id
-    WHERE t.ticket_id = ?
-    ''', (ticket_id,))
-
-    ticket_info = cursor.fetchone()
-    conn.close()
-    return ticket_info
+def get_ticket_view(ticket_id, owner_id=None, before=None, after=None, limit=10):
+    """Get a ticket's header, owner and a window of its messages in one query
 
-def get_ticket_messages(ticket_id):
-    """Get all messages for a ticket"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
+    Messages are read through idx_ticket_messages_ticket, at most limit + 1
+    rows however long the ticket is. Without a cursor the latest messages
+    are returned.
 
-    cursor.execute('''
-    SELECT message, is_admin, created_at 
-    FROM ticket_messages 
-    WHERE ticket_id = ?
-    ORDER BY created_at
-    ''', (ticket_id,))
+    Args:
+        ticket_id (int): Ticket ID
+        owner_id (int, optional): Only return the ticket if this user owns it;
+                                  None for admins
+        before (int, optional): message_id; return the messages just older than it
+        after (int, optional): message_id; return the messages just newer than it
+        limit (int): Window size
 
-    messages = cursor.fetchall()
-    conn.close()
-    return messages
+    Returns:
+        dict: 'subject', 'status', 'owner_id', 'first_name', 'username',
+              'messages' as (message_id, message, is_admin, created_at) oldest
+              first, 'has_older' and 'has_newer'; or None if the ticket does
+              not exist or owner_id does not own it
+    """
+    forwards = after is not None
+    cursor_id = after if forwards else before
+    direction = 'ASC' if forwards else 'DESC'
+    cursor_filter = ""
+    params = [ticket_id, owner_id, owner_id]
+    if cursor_id is not None:
+        cursor_filter = f'''
+            AND (m.created_at, m.message_id) {'>' if forwards else '<'}
+                (SELECT created_at, message_id FROM ticket_messages WHERE message_id = ?)
+        '''
+        params.append(cursor_id)
+    params.append(limit + 1)
 
-def close_ticket(ticket_id):
-    """Close a ticket"""
     conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
 
-    cursor.execute(
-        "UPDATE tickets SET status = 'closed' WHERE ticket_id = ?",
-        (ticket_id,)
+    cursor.execute(f'''
+    WITH ticket AS (
+        SELECT t.ticket_id, t.subject, t.status, t.user_id, u.first_name, u.username
+        FROM tickets t
+        LEFT JOIN users u ON u.user_id = t.user_id
+        WHERE t.ticket_id = ? AND (? IS NULL OR t.user_id = ?)
+    ),
+    message_window AS (
+        SELECT m.message_id, m.message, m.is_admin, m.created_at
+        FROM ticket_messages m
+        WHERE m.ticket_id = (SELECT ticket_id FROM ticket) {cursor_filter}
+        ORDER BY m.created_at {direction}, m.message_id {direction}
+        LIMIT ?
     )
+    SELECT ticket.subject, ticket.status, ticket.user_id, ticket.first_name, ticket.username,
+           w.message_id, w.message, w.is_admin, w.created_at
+    FROM ticket
+    LEFT JOIN message_window w
+    ORDER BY w.created_at {direction}, w.message_id {direction}
+    ''', params)
 
-    conn.commit()
+    rows = cursor.fetchall()
     conn.close()
 
-def update_ticket_status(ticket_id, status):
-    """Update the status of a ticket"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-
-    cursor.execute(
-        "UPDATE tickets SET status = ? WHERE ticket_id = ?",
-        (status, ticket_id)
-    )
+    if not rows:
+        return None
 
-    conn.commit()
-    conn.close()
+    subject, status, ticket_owner_id, first_name, username = rows[0][:5]
+    messages = [row[5:] for row in rows if row[5] is not None]
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if forwards:
+        has_older, has_newer = True, has_more
+    else:
+        messages.reverse()
+        has_older, has_newer = has_more, before is not None
 
-def get_all_tickets():
-    """Get all tickets"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
+    return {
+        'subject': subject,
+        'status': status,
+        'owner_id': ticket_owner_id,
+        'first_name': first_name,
+        'username': username,
+        'messages': messages,
+        'has_older': has_older,
+        'has_newer': has_newer,
+    }
 
-    cursor.execute('''
-    SELECT t.ticket_id, t.subject, t.status, u.first_name, u.username 
-    FROM tickets t
-    JOIN users u ON t.user_id = u.user_id
-    ORDER BY t.created_at DESC
-    LIMIT 50
-    ''')
+def close_ticket(ticket_id, owner_id=None):
+    """Close a ticket
 
-    tickets = cursor.fetchall()
-    conn.close()
-    return tickets
+    Args:
+        ticket_id (int): Ticket ID
+        owner_id (int, optional): Only close the ticket if this user owns it;
+                                  None for admins
 
-def verify_ticket_access(ticket_id, user_id, admin_ids):
-    """Check if user has access to this ticket (as owner or admin)"""
+    Returns:
+        bool: True if the ticket exists and the caller may close it
+    """
     conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
 
-    cursor.execute('SELECT user_id FROM tickets WHERE ticket_id = ?', (ticket_id,))
-    result = cursor.fetchone()
-    conn.close()
-
-    if not result:
-        return False, None
-
-    ticket_owner_id = result[0]
-    has_access = (ticket_owner_id == user_id) or (user_id in admin_ids)
+    cursor.execute(
+        "UPDATE tickets SET status = 'closed' WHERE ticket_id = ? AND (? IS NULL OR user_id = ?)",
+        (ticket_id, owner_id, owner_id)
+    )
+    closed = cursor.rowcount > 0
 
-    return has_access, ticket_owner_id
+    conn.commit()
+    conn.close()
+    return closed
 
-def get_ticket_details(ticket_id):
-    """Get complete details about a ticket including subject and status"""
+def update_ticket_status(ticket_id, status):
+    """Update the status of a ticket"""
     conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
 
-    cursor.execute('''
-    SELECT t.subject, t.status, t.user_id, u.first_name, u.username 
-    FROM tickets t
-    JOIN users u ON t.user_id = u.user_id
-    WHERE t.ticket_id = ?
-    ''', (ticket_id,))
-
-    ticket_info = cursor.fetchone()
-
-    if not ticket_info:
-        conn.close()
-        return None
-
-    # Get messages
-    cursor.execute('''
-    SELECT message, is_admin, created_at, sender_id 
-    FROM ticket_messages 
-    WHERE ticket_id = ?
-    ORDER BY created_at
-    ''', (ticket_id,))
+    cursor.execute(
+        "UPDATE tickets SET status = ? WHERE ticket_id = ?",
+        (status, ticket_id)
+    )
 
-    messages = cursor.fetchall()
+    conn.commit()
     conn.close()
 
-    return {
-        'info': ticket_info,
-        'messages': messages
-    }
+def get_all_tickets(limit=50):
+    """Get the admin ticket queue: open, then answered, then closed, newest first
 
-def get_formatted_ticket_messages(ticket_id, for_admin=False):
-    """Get formatted ticket messages ready for display"""
+    Returns:
+        list: (ticket_id, subject, status, first_name, username, message_count,
+               last_sender_is_admin, last_message_at) tuples
+    """
     conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
 
-    # Get ticket info
-    if for_admin:
-        cursor.execute('''
-        SELECT t.subject, t.status, t.user_id, u.first_name, u.username
-        FROM tickets t
-        JOIN users u ON t.user_id = u.user_id
-        WHERE t.ticket_id = ?
-        ''', (ticket_id,))
-    else:
-        cursor.execute('''
-        SELECT subject, status
-        FROM tickets
-        WHERE ticket_id = ?
-        ''', (ticket_id,))
-
-    ticket_info = cursor.fetchone()
-
-    if not ticket_info:
-        conn.close()
-        return None
-
-    # Get messages
     cursor.execute('''
-    SELECT message, is_admin, created_at
-    FROM ticket_messages 
-    WHERE ticket_id = ?
-    ORDER BY created_at
-    ''', (ticket_id,))
+    SELECT t.ticket_id, t.subject, t.status, u.first_name, u.username,
+           t.message_count, t.last_sender_is_admin, t.last_message_at
+    FROM tickets t
+    JOIN users u ON t.user_id = u.user_id
+    ORDER BY t.status_rank, t.created_at DESC
+    LIMIT ?
+    ''', (limit,))
 
-    messages = cursor.fetchall()
+    tickets = cursor.fetchall()
     conn.close()
-
-    if for_admin:
-        subject, status, owner_id, first_name, username = ticket_info
-        message_text = f"📋 تیکت #{ticket_id}\n\n"
-        message_text += f"📝 موضوع: {subject}\n"
-        message_text += f"👤 کاربر: {first_name}" + (f" (@{username})" if username else "") + f"\n"
-        message_text += f"📊 وضعیت: {status}\n\n"
-    else:
-        subject, status = ticket_info
-        message_text = f"📋 تیکت #{ticket_id}\n\n"
-        message_text += f"موضوع: {subject}\n"
-        message_text += f"وضعیت: {status}\n\n"
-
-    message_text += "📬 پیام ها:\n\n"
-
-    for msg in messages:
-        text, is_admin, timestamp = msg
-        sender = "👤 پشتیبانی" if is_admin else "👤 شما"
-        message_text += f"{sender} ({timestamp}):\n{text}\n\n"
-
-    result = {
-        'text': message_text,
-        'status': status,
-        'info': ticket_info
-    }
-
-    if for_admin:
-        result['owner_id'] = owner_id
-
-    return result
+    return tickets
 
 def get_user_tickets_list(user_id):
     """Get a formatted list of user tickets"""
@@ -550,81 +1282,19 @@ def get_formatted_user_tickets(user_id):
 
     return formatted_tickets
 
-def get_ticket_conversation(ticket_id, user_id, admin_ids=None):
-    """Get ticket conversation details with permission check
+def get_pending_payments():
+    """Get all pending payment requests
 
     Returns:
-        dict: {'access': bool, 'ticket_info': tuple, 'messages': list, 'formatted_text': str} or None if no access
+        list: (payment_id, user_id, plan, first_name, username, receipt_file_id,
+               duplicate_of, extension_unknown) tuples, oldest first
     """
     conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
 
-    # Verify ticket belongs to user or user is admin
-    cursor.execute('SELECT user_id FROM tickets WHERE ticket_id = ?', (ticket_id,))
-    result = cursor.fetchone()
-
-    if not result:
-        conn.close()
-        return {'access': False, 'error': 'Ticket not found'}
-
-    ticket_owner_id = result[0]
-    has_access = (ticket_owner_id == user_id)
-
-    # If admin_ids provided, check if user is admin
-    if not has_access and admin_ids and user_id in admin_ids:
-        has_access = True
-
-    if not has_access:
-        conn.close()
-        return {'access': False, 'error': 'Access denied'}
-
-    # Get ticket info
-    cursor.execute('SELECT subject, status FROM tickets WHERE ticket_id = ?', (ticket_id,))
-    ticket_info = cursor.fetchone()
-
-    # Get messages
-    cursor.execute('''
-    SELECT message, is_admin, created_at 
-    FROM ticket_messages 
-    WHERE ticket_id = ?
-    ORDER BY created_at
-    ''', (ticket_id,))
-
-    messages = cursor.fetchall()
-    conn.close()
-
-    if not ticket_info:
-        return {'access': True, 'error': 'Ticket data not found'}
-
-    subject, status = ticket_info
-
-    # Format message text
-    message_text = f"📋 تیکت #{ticket_id}\n\n"
-    message_text += f"موضوع: {subject}\n"
-    message_text += f"وضعیت: {status}\n\n"
-    message_text += "📬 پیام ها:\n\n"
-
-    for msg in messages:
-        text, is_admin, timestamp = msg
-        sender = "👤 پشتیبانی" if is_admin else "👤 شما"
-        message_text += f"{sender} ({timestamp}):\n{text}\n\n"
-
-    return {
-        'access': True,
-        'ticket_info': ticket_info,
-        'messages': messages,
-        'formatted_text': message_text,
-        'owner_id': ticket_owner_id,
-        'status': status
-    }
-
-def get_pending_payments():
-    """Get all pending payment requests"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-
     cursor.execute('''
-    SELECT p.payment_id, p.user_id, p.plan, u.first_name, u.username, p.receipt_file_id
+    SELECT p.payment_id, p.user_id, p.plan, u.first_name, u.username, p.receipt_file_id, p.duplicate_of,
+           p.extension_unknown
     FROM payments p
     JOIN users u ON p.user_id = u.user_id
     WHERE p.status = 'pending'
@@ -713,10 +1383,547 @@ def update_config_total_gb(email, user_id, additional_gb, extend_days=30):
     # Resetting last_notified ensures users will get fresh notifications about their extended service
     cursor.execute('''
     UPDATE configs 
-    SET total_gb = ?, last_notified = NULL
+    SET total_gb = ?, last_notified = NULL, depleted_at = NULL
     WHERE email = ? AND user_id = ?
     ''', (new_total_gb, email, user_id))
 
     conn.commit()
     conn.close()
-    return True
\ No newline at end of file
+    return True
+
+def update_depleted_marks(depleted_client_ids, replenished_client_ids):
+    """Track since when configs have been out of traffic
+
+    Configs newly seen depleted get depleted_at set to now; configs that have
+    traffic again get it cleared.
+
+    Args:
+        depleted_client_ids (list): Client IDs currently out of traffic on the panel
+        replenished_client_ids (list): Client IDs that have traffic left
+
+    Returns:
+        dict: client_id -> depleted_at (datetime) for every depleted config
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    try:
+        cursor.executemany('''
+        UPDATE configs SET depleted_at = ? WHERE client_id = ? AND depleted_at IS NULL
+        ''', [(now, client_id) for client_id in depleted_client_ids])
+        cursor.executemany('''
+        UPDATE configs SET depleted_at = NULL WHERE client_id = ? AND depleted_at IS NOT NULL
+        ''', [(client_id,) for client_id in replenished_client_ids])
+        cursor.execute('''
+        SELECT client_id, depleted_at FROM configs WHERE depleted_at IS NOT NULL
+        ''')
+        marks = {client_id: datetime.strptime(depleted_at, '%Y-%m-%d %H:%M:%S')
+                 for client_id, depleted_at in cursor.fetchall()}
+        conn.commit()
+        return marks
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def get_depleted_marks():
+    """Get since when configs have been out of traffic, as recorded by update_depleted_marks
+
+    Returns:
+        dict: client_id -> depleted_at (datetime) for every config marked depleted
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    cursor.execute("SELECT client_id, depleted_at FROM configs WHERE depleted_at IS NOT NULL")
+    marks = {client_id: datetime.strptime(depleted_at, '%Y-%m-%d %H:%M:%S')
+             for client_id, depleted_at in cursor.fetchall()}
+
+    conn.close()
+    return marks
+
+def deactivate_configs(client_ids):
+    """Mark several configs inactive in one transaction
+
+    Args:
+        client_ids (list): Client IDs to deactivate
+
+    Returns:
+        int: Number of configs updated
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    try:
+        cursor.executemany('''
+        UPDATE configs SET is_active = 0 WHERE client_id = ?
+        ''', [(client_id,) for client_id in client_ids])
+        conn.commit()
+        return cursor.rowcount
+    except Exception as e:
+        logger.error(f"Error deactivating configs: {e}")
+        conn.rollback()
+        return 0
+    finally:
+        conn.close()
+
+# Largest user_id a numeric prefix search expands to
+_MAX_USER_ID = 10 ** 15
+
+def _user_id_prefix_ranges(prefix):
+    """[start, end) user_id ranges whose decimal form starts with prefix, in ascending order"""
+    value = int(prefix)
+    if value == 0:
+        return []
+    ranges = []
+    start, end = value, value + 1
+    while start < _MAX_USER_ID:
+        ranges.append((start, end))
+        start, end = start * 10, end * 10
+    return ranges
+
+def get_users_page(search=None, after=None, before=None, limit=10):
+    """Get one page of users with keyset pagination
+
+    Without a search users are ordered by user_id. A numeric search matches
+    user_ids that start with it, any other search matches usernames that start
+    with it (case-insensitive) ordered by username. Every page is one query
+    whose cost is bounded by `limit`, not by the number of users.
+
+    Args:
+        search (str, optional): user_id or username prefix
+        after (int, optional): user_id of the last row of the previous page
+        before (int, optional): user_id of the first row of the next page, to go back
+        limit (int): Page size
+
+    Returns:
+        tuple: (rows, has_more) where rows are (user_id, first_name, username,
+               active_configs) and has_more tells whether another page follows
+               in the direction of travel
+    """
+    backwards = before is not None
+    cursor_id = before if backwards else after
+    op, direction = ('<', 'DESC') if backwards else ('>', 'ASC')
+    search = (search or '').strip().lstrip('@')
+
+    params = []
+    if search.isdigit():
+        # One bounded range scan on the primary key per prefix length
+        branches = []
+        for start, end in _user_id_prefix_ranges(search):
+            branch = f"SELECT user_id FROM users WHERE user_id >= ? AND user_id < ?"
+            params.extend([start, end])
+            if cursor_id is not None:
+                branch += f" AND user_id {op} ?"
+                params.append(cursor_id)
+            branches.append(f"SELECT * FROM ({branch} ORDER BY user_id {direction} LIMIT ?)")
+            params.append(limit + 1)
+        if not branches:
+            return [], False
+        ids_query = " UNION ALL ".join(branches)
+        order = f"u.user_id {direction}"
+    elif search:
+        # Username range [prefix, prefix with its last character incremented) on the NOCASE index.
+        # NOCASE compares ASCII letters lowercased, so the bounds are built from the
+        # lowercased prefix; "Z" + 1 would be "[", which sorts before every letter
+        prefix = "".join(char.lower() if char.isascii() else char for char in search)
+        ids_query = '''
+        SELECT user_id FROM users
+        WHERE username >= ? COLLATE NOCASE AND username < ? COLLATE NOCASE
+        '''
+        params.extend([prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)])
+        if cursor_id is not None:
+            ids_query += f'''
+            AND (username COLLATE NOCASE, user_id) {op}
+                ((SELECT username FROM users WHERE user_id = ?), ?)
+            '''
+            params.extend([cursor_id, cursor_id])
+        ids_query += f" ORDER BY username COLLATE NOCASE {direction}, user_id {direction} LIMIT ?"
+        params.append(limit + 1)
+        order = f"u.username COLLATE NOCASE {direction}, u.user_id {direction}"
+    else:
+        ids_query = "SELECT user_id FROM users"
+        if cursor_id is not None:
+            ids_query += f" WHERE user_id {op} ?"
+            params.append(cursor_id)
+        ids_query += f" ORDER BY user_id {direction} LIMIT ?"
+        params.append(limit + 1)
+        order = f"u.user_id {direction}"
+
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    cursor.execute(f'''
+    SELECT u.user_id, u.first_name, u.username, COALESCE(a.active_count, 0)
+    FROM ({ids_query}) page
+    JOIN users u ON u.user_id = page.user_id
+    LEFT JOIN user_active_configs a ON a.user_id = u.user_id
+    ORDER BY {order}
+    LIMIT ?
+    ''', params + [limit + 1])
+
+    rows = cursor.fetchall()
+    conn.close()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backwards:
+        rows.reverse()
+    return rows, has_more
+
+def get_user_overview(user_id, config_limit=20, payment_limit=10):
+    """Get a user with their most recent configs and payments
+
+    Returns:
+        dict: 'user' (user_id, username, first_name, last_name, join_date),
+              'configs' as in get_user_configs and 'payments'
+              (payment_id, plan, status, submitted_at), or None if no such user
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    cursor.execute('''
+    SELECT user_id, username, first_name, last_name, join_date FROM users WHERE user_id = ?
+    ''', (user_id,))
+    user = cursor.fetchone()
+    if not user:
+        conn.close()
+        return None
+
+    cursor.execute('''
+    SELECT config_id, email, client_id, total_gb, is_active
+    FROM configs
+    WHERE user_id = ?
+    ORDER BY created_at DESC
+    LIMIT ?
+    ''', (user_id, config_limit))
+    configs = cursor.fetchall()
+
+    cursor.execute('''
+    SELECT payment_id, plan, status, submitted_at
+    FROM payments
+    WHERE user_id = ?
+    ORDER BY payment_id DESC
+    LIMIT ?
+    ''', (user_id, payment_limit))
+    payments = cursor.fetchall()
+
+    conn.close()
+    return {'user': user, 'configs': configs, 'payments': payments}
+
+def get_or_create_sub_id(user_id):
+    """Get the user's subscription id, creating it on first use
+
+    Returns:
+        str: The sub_id, or None if the user does not exist
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    cursor.execute("SELECT sub_id FROM users WHERE user_id = ?", (user_id,))
+    row = cursor.fetchone()
+    if row and row[0] is None:
+        cursor.execute(
+            "UPDATE users SET sub_id = ? WHERE user_id = ? AND sub_id IS NULL",
+            (secrets.token_urlsafe(16), user_id)
+        )
+        cursor.execute("SELECT sub_id FROM users WHERE user_id = ?", (user_id,))
+        row = cursor.fetchone()
+        conn.commit()
+
+    conn.close()
+    return row[0] if row else None
+
+def get_subscription_version(sub_id):
+    """Look up a subscription id
+
+    Returns:
+        tuple: (user_id, config version), or None if no user has this sub_id
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    cursor.execute('''
+    SELECT u.user_id, COALESCE(v.version, 0)
+    FROM users u
+    LEFT JOIN config_versions v ON v.user_id = u.user_id
+    WHERE u.sub_id = ?
+    ''', (sub_id,))
+    row = cursor.fetchone()
+
+    conn.close()
+    return row
+
+def get_subscription_configs(user_id):
+    """Get the active configs served in a user's subscription
+
+    Returns:
+        list: (client_id, email) tuples, oldest first
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    cursor.execute('''
+    SELECT client_id, email FROM configs
+    WHERE user_id = ? AND is_active = 1
+    ORDER BY created_at, config_id
+    ''', (user_id,))
+    configs = cursor.fetchall()
+
+    conn.close()
+    return configs
+
+def get_qr_file_id(client_id, link_hash):
+    """Get the cached Telegram file_id of a config's QR code
+
+    Returns:
+        str: The file_id, or None if none was cached for this link
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    cursor.execute(
+        "SELECT file_id FROM config_qr_codes WHERE client_id = ? AND link_hash = ?",
+        (client_id, link_hash)
+    )
+    row = cursor.fetchone()
+
+    conn.close()
+    return row[0] if row else None
+
+def save_qr_file_id(client_id, link_hash, file_id):
+    """Cache the Telegram file_id of an uploaded QR code, replacing one for an older link"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    cursor.execute('''
+    INSERT INTO config_qr_codes (client_id, link_hash, file_id) VALUES (?, ?, ?)
+    ON CONFLICT(client_id) DO UPDATE SET link_hash = excluded.link_hash, file_id = excluded.file_id
+    ''', (client_id, link_hash, file_id))
+
+    conn.commit()
+    conn.close()
+
+def delete_qr_file_id(client_id):
+    """Forget a cached QR code file_id that Telegram no longer accepts"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    cursor.execute("DELETE FROM config_qr_codes WHERE client_id = ?", (client_id,))
+
+    conn.commit()
+    conn.close()
+
+def _fts_query(text):
+    """Turn free text into an FTS5 query matching every word
+
+    Words match whole tokens; a trailing * makes a word a prefix. Everything
+    else is quoted, so user input cannot form FTS5 syntax.
+    """
+    terms = []
+    for word in text.split():
+        prefix = word.endswith('*')
+        word = word.rstrip('*')
+        if word:
+            terms.append('"' + word.replace('"', '""') + '"' + ('*' if prefix else ''))
+    return " ".join(terms)
+
+def search_tickets(text, offset=0, limit=10):
+    """Search ticket subjects and messages
+
+    Tickets are ranked by their best matching subject or message (bm25, with
+    subject matches weighted double). Only the TICKET_SEARCH_HIT_LIMIT most
+    recent matching messages and subjects are ranked, so the cost does not
+    grow with the number of messages.
+    Falls back to an unranked LIKE scan when FTS5 is not available.
+
+    Args:
+        text (str): Words to search for, see _fts_query
+        offset (int): Number of tickets to skip
+        limit (int): Page size
+
+    Returns:
+        tuple: (tickets, has_more) where tickets are (ticket_id, subject,
+               status, first_name, username, snippet)
+    """
+    match = _fts_query(text)
+    if not match:
+        return [], False
+
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute('''
+        WITH hits AS (
+            SELECT m.ticket_id, f.rank, f.message_id FROM (
+                SELECT rowid AS message_id, bm25(ticket_messages_fts) AS rank
+                FROM ticket_messages_fts
+                WHERE ticket_messages_fts MATCH ?
+                ORDER BY rowid DESC
+                LIMIT ?
+            ) f
+            JOIN ticket_messages m ON m.message_id = f.message_id
+            UNION ALL
+            SELECT * FROM (
+                SELECT rowid, bm25(tickets_fts) * 2, NULL FROM tickets_fts
+                WHERE tickets_fts MATCH ?
+                ORDER BY rowid DESC
+                LIMIT ?
+            )
+        ),
+        best AS (
+            -- With MIN(), SQLite takes the bare message_id column from the best ranked hit
+            SELECT ticket_id, MIN(rank) AS rank, message_id FROM hits GROUP BY ticket_id
+        )
+        SELECT t.ticket_id, t.subject, t.status, u.first_name, u.username, b.message_id
+        FROM best b
+        JOIN tickets t ON t.ticket_id = b.ticket_id
+        LEFT JOIN users u ON u.user_id = t.user_id
+        ORDER BY b.rank, t.ticket_id DESC
+        LIMIT ? OFFSET ?
+        ''', (match, TICKET_SEARCH_HIT_LIMIT, match, TICKET_SEARCH_HIT_LIMIT, limit + 1, offset))
+        tickets = cursor.fetchall()
+
+        # Snippets only for the page, each a rowid lookup
+        message_ids = [row[5] for row in tickets[:limit] if row[5] is not None]
+        snippets = {}
+        if message_ids:
+            placeholders = ",".join("?" * len(message_ids))
+            cursor.execute(f'''
+            SELECT rowid, snippet(ticket_messages_fts, 0, '«', '»', '…', 8)
+            FROM ticket_messages_fts
+            WHERE ticket_messages_fts MATCH ? AND rowid IN ({placeholders})
+            ''', [match] + message_ids)
+            snippets = dict(cursor.fetchall())
+        tickets = [row[:5] + (snippets.get(row[5]),) for row in tickets]
+    except sqlite3.OperationalError as e:
+        logger.debug(f"Full-text ticket search failed, using LIKE: {e}")
+        pattern = f"%{text.strip()}%"
+        cursor.execute('''
+        SELECT t.ticket_id, t.subject, t.status, u.first_name, u.username, NULL
+        FROM tickets t
+        LEFT JOIN users u ON u.user_id = t.user_id
+        WHERE t.subject LIKE ?
+           OR t.ticket_id IN (SELECT ticket_id FROM ticket_messages WHERE message LIKE ?)
+        ORDER BY t.ticket_id DESC
+        LIMIT ? OFFSET ?
+        ''', (pattern, pattern, limit + 1, offset))
+        tickets = cursor.fetchall()
+
+    conn.close()
+    return tickets[:limit], len(tickets) > limit
+
+def get_dashboard_stats(days=7):
+    """Get the admin dashboard figures from the aggregate tables
+
+    Args:
+        days (int): Number of recent days of approvals to include
+
+    Returns:
+        dict: 'counters' {name: value} and 'daily' [(day, plan, approvals, gb)]
+              newest day first
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    cursor.execute("SELECT name, value FROM stats_counters")
+    counters = dict(cursor.fetchall())
+
+    since = (datetime.now() - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+    cursor.execute('''
+    SELECT day, plan, approvals, gb FROM daily_plan_approvals
+    WHERE day >= ?
+    ORDER BY day DESC, CAST(plan AS REAL)
+    ''', (since,))
+    daily = cursor.fetchall()
+
+    conn.close()
+    return {'counters': counters, 'daily': daily}
+
+def rebuild_dashboard_stats():
+    """Recompute the dashboard aggregates from scratch, e.g. after editing the database by hand"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    try:
+        _rebuild_stats(cursor)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def load_user_state():
+    """Load all persisted user_data entries
+
+    Returns:
+        list: (user_id, key, value) tuples with pickled (older entries: JSON) values
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    cursor.execute('SELECT user_id, key, value FROM user_state')
+    rows = cursor.fetchall()
+    conn.close()
+    return rows
+
+def load_bot_state():
+    """Load all persisted bot_data entries
+
+    Returns:
+        list: (key, value) tuples with pickled (older entries: JSON) values
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    cursor.execute('SELECT key, value FROM bot_state')
+    rows = cursor.fetchall()
+    conn.close()
+    return rows
+
+def write_state_changes(changes):
+    """Write changed user_data and bot_data entries in one transaction, in order
+
+    Args:
+        changes (list): (scope, user_id, key, value) tuples where scope is 'user'
+                        or 'bot' (user_id None). A value of None deletes the
+                        entry; a 'user' change with key None deletes all of
+                        the user's entries.
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    try:
+        for scope, user_id, key, value in changes:
+            if scope == 'bot':
+                if value is None:
+                    cursor.execute('DELETE FROM bot_state WHERE key = ?', (key,))
+                else:
+                    cursor.execute('''
+                    INSERT OR REPLACE INTO bot_state (key, value, updated_at)
+                    VALUES (?, ?, CURRENT_TIMESTAMP)
+                    ''', (key, value))
+            elif key is None:
+                cursor.execute('DELETE FROM user_state WHERE user_id = ?', (user_id,))
+            elif value is None:
+                cursor.execute('DELETE FROM user_state WHERE user_id = ? AND key = ?', (user_id, key))
+            else:
+                cursor.execute('''
+                INSERT OR REPLACE INTO user_state (user_id, key, value, updated_at)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                ''', (user_id, key, value))
+        conn.commit()
+        return True
+    except Exception as e:
+        logger.error(f"Error writing persisted state: {e}")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+
+metrics.instrument_module(globals(), __name__)
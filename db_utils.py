@@ -4,6 +4,7 @@ Additional database utilities for VPN Bot
 import sqlite3
 import logging
 from config import DB_FILE
+import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -81,3 +82,54 @@ def get_all_db_configs():
         return []
     finally:
         conn.close()
+
+def get_configs_for_reconciliation():
+    """Get the fields of every config that are compared against the XUI panel
+
+    Returns:
+        list: (config_id, client_id, email, total_gb, is_active) tuples
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute('''
+        SELECT config_id, client_id, email, total_gb, is_active
+        FROM configs
+        WHERE client_id IS NOT NULL
+        ''')
+        return cursor.fetchall()
+    finally:
+        conn.close()
+
+def apply_config_repairs(repairs, batch_size=500):
+    """Overwrite is_active and total_gb of configs, one transaction per batch
+
+    Args:
+        repairs (list): (config_id, is_active, total_gb) tuples
+        batch_size (int): Rows written per transaction
+
+    Returns:
+        int: Number of configs updated
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    updated = 0
+    try:
+        for start in range(0, len(repairs), batch_size):
+            batch = repairs[start:start + batch_size]
+            cursor.executemany('''
+            UPDATE configs SET is_active = ?, total_gb = ? WHERE config_id = ?
+            ''', [(is_active, total_gb, config_id) for config_id, is_active, total_gb in batch])
+            conn.commit()
+            updated += len(batch)
+        return updated
+    except Exception as e:
+        logger.error(f"Error applying config repairs after {updated} rows: {e}")
+        conn.rollback()
+        return updated
+    finally:
+        conn.close()
+
+metrics.instrument_module(globals(), __name__)
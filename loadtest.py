@@ -0,0 +1,284 @@
+"""
+End-to-end load test harness
+Builds the bot Application against a recording fake of the Telegram Bot API
+and the local XUI panel simulator, replays synthetic updates for N users and
+reports handler latency percentiles and throughput.
+
+Usage:
+    python loadtest.py --users 200 --concurrency 8
+"""
+import argparse
+import asyncio
+import base64
+import itertools
+import json
+import logging
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import config
+from xui_simulator import XUIPanelSimulator
+
+logger = logging.getLogger(__name__)
+
+ADMIN_ID = 1000
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "LoadTestBot", "username": "loadtest_bot"}
+# Served for every file download, e.g. receipts fetched for hashing (1x1 GIF)
+FILE_CONTENT = base64.b64decode("R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7")
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+def _make_recording_request(latency):
+    """Create a telegram BaseRequest that records Bot API calls instead of sending them"""
+    from telegram.request import BaseRequest
+
+    class RecordingRequest(BaseRequest):
+        def __init__(self):
+            self.calls = []
+            self._message_ids = itertools.count(1)
+
+        @property
+        def read_timeout(self):
+            return None
+
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            pass
+
+        async def do_request(self, url, method, request_data=None, read_timeout=None,
+                             write_timeout=None, connect_timeout=None, pool_timeout=None):
+            endpoint = url.rsplit("/", 1)[-1]
+            params = request_data.parameters if request_data else {}
+            self.calls.append((endpoint, params))
+            if latency:
+                await asyncio.sleep(latency)
+            if "/file/bot" in url:
+                return 200, FILE_CONTENT
+            result = self._result(endpoint, params)
+            return 200, json.dumps({"ok": True, "result": result}).encode("utf-8")
+
+        def _result(self, endpoint, params):
+            if endpoint == "getMe":
+                return dict(BOT_USER, can_join_groups=False, can_read_all_group_messages=False,
+                            supports_inline_queries=False)
+            if endpoint in ("sendMessage", "sendPhoto", "sendDocument", "editMessageText", "editMessageCaption"):
+                message = {
+                    "message_id": next(self._message_ids),
+                    "date": int(time.time()),
+                    "chat": {"id": params.get("chat_id", 0), "type": "private"},
+                    "from": BOT_USER,
+                }
+                if "text" in params:
+                    message["text"] = params["text"]
+                if endpoint == "sendPhoto":
+                    file_id = f"photo_{message['message_id']}"
+                    message["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 1, "height": 1}]
+                return message
+            if endpoint == "getFile":
+                return {"file_id": params["file_id"], "file_unique_id": params["file_id"],
+                        "file_size": len(FILE_CONTENT), "file_path": f"photos/{params['file_id']}.gif"}
+            return True
+
+    return RecordingRequest()
+
+class SyntheticUpdates:
+    """Builds Telegram update payloads for simulated users"""
+
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    @staticmethod
+    def user(user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+    def _message(self, user_id, **fields):
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self.user(user_id),
+        }
+        message.update(fields)
+        return message
+
+    def command(self, user_id, command):
+        return {"update_id": next(self._update_ids),
+                "message": self._message(user_id, text=command,
+                                         entities=[{"type": "bot_command", "offset": 0, "length": len(command)}])}
+
+    def text(self, user_id, text):
+        return {"update_id": next(self._update_ids), "message": self._message(user_id, text=text)}
+
+    def photo(self, user_id):
+        file_id = f"receipt_{user_id}_{next(self._message_ids)}"
+        return {"update_id": next(self._update_ids),
+                "message": self._message(user_id, photo=[
+                    {"file_id": file_id, "file_unique_id": file_id, "width": 800, "height": 600}
+                ])}
+
+    def callback(self, user_id, data, text="...", caption=None):
+        shown = self._message(user_id, text=text) if caption is None else self._message(user_id, caption=caption)
+        shown["from"] = BOT_USER
+        return {"update_id": next(self._update_ids),
+                "callback_query": {"id": str(next(self._update_ids)), "from": self.user(user_id),
+                                   "chat_instance": str(user_id), "data": data, "message": shown}}
+
+class LoadTest:
+    """Replays synthetic user sessions through the bot Application"""
+
+    def __init__(self, users, concurrency, bot_latency):
+        self.users = users
+        self.concurrency = concurrency
+        self.bot_latency = bot_latency
+        self.latencies = {}
+        self.updates = SyntheticUpdates()
+
+    async def _process(self, application, kind, payload):
+        from telegram import Update
+
+        update = Update.de_json(payload, application.bot)
+        start = time.perf_counter()
+        await application.process_update(update)
+        self.latencies.setdefault(kind, []).append(time.perf_counter() - start)
+
+    async def _user_session(self, application, user_id):
+        import database
+
+        updates = self.updates
+        await self._process(application, "start", updates.command(user_id, "/start"))
+        await self._process(application, "check_status", updates.callback(user_id, "check_status"))
+        await self._process(application, "free_trial", updates.callback(user_id, "free_1gb"))
+
+        configs = database.get_user_configs(user_id)
+        if configs:
+            email = configs[0][1]
+            await self._process(application, "show_status", updates.callback(user_id, f"status_{email}"))
+            await self._process(application, "refresh_status",
+                                updates.callback(user_id, "refresh_status", text=f"📧 نام: {email}"))
+
+        await self._process(application, "plan_selection", updates.callback(user_id, random.choice(
+            ["gb_10", "gb_30", "gb_40", "gb_50"])))
+        await self._process(application, "receipt", updates.photo(user_id))
+
+        await self._process(application, "ticket_new", updates.callback(user_id, "support_new"))
+        await self._process(application, "ticket_message", updates.text(user_id, f"مشکل اتصال کاربر {user_id}"))
+        tickets = database.get_user_tickets(user_id)
+        if tickets:
+            ticket_id = tickets[0][0]
+            await self._process(application, "ticket_reply",
+                                updates.callback(user_id, f"support_reply_{ticket_id}"))
+            await self._process(application, "ticket_message", updates.text(user_id, "هنوز وصل نمی‌شود"))
+
+    async def _admin_approvals(self, application):
+        import database
+
+        for payment in database.get_pending_payments():
+            payment_id = payment[0]
+            await self._process(application, "admin_approval", self.updates.callback(
+                ADMIN_ID, f"approve_{payment_id}", caption="درخواست پرداخت جدید"))
+
+    async def run(self):
+        from telegram.ext import ApplicationBuilder
+
+        import bot
+        import database
+
+        database.init_db()
+        request = _make_recording_request(self.bot_latency)
+        builder = ApplicationBuilder().token("123456:LOADTEST").request(request).get_updates_request(request)
+        application = bot.build_application(builder)
+        await application.initialize()
+        # Running, as under run_polling, so create_task schedules background work
+        await application.start()
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def limited(user_id):
+            async with semaphore:
+                await self._user_session(application, user_id)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(limited(100000 + i) for i in range(self.users)))
+        await self._admin_approvals(application)
+        # stop() waits for the create_task work (admin notifications, QR codes),
+        # which is part of the run
+        await application.stop()
+        elapsed = time.perf_counter() - start
+
+        await application.shutdown()
+        return self._report(elapsed, request.calls)
+
+    def _report(self, elapsed, calls):
+        all_latencies = [value for values in self.latencies.values() for value in values]
+        report = {
+            "users": self.users,
+            "concurrency": self.concurrency,
+            "updates": len(all_latencies),
+            "elapsed_s": round(elapsed, 3),
+            "updates_per_s": round(len(all_latencies) / elapsed, 1) if elapsed else 0.0,
+            "bot_api_calls": len(calls),
+            "handlers": {},
+        }
+        for kind, values in sorted(self.latencies.items()) + [("all", all_latencies)]:
+            report["handlers"][kind] = {
+                "count": len(values),
+                "mean_ms": round(statistics.fmean(values) * 1000, 2) if values else 0.0,
+                "p50_ms": round(percentile(values, 50) * 1000, 2),
+                "p95_ms": round(percentile(values, 95) * 1000, 2),
+                "p99_ms": round(percentile(values, 99) * 1000, 2),
+            }
+        return report
+
+def print_report(report):
+    print(f"{report['updates']} updates from {report['users']} users in {report['elapsed_s']}s "
+          f"({report['updates_per_s']} updates/s, {report['bot_api_calls']} Bot API calls)")
+    print(f"{'handler':<16}{'count':>8}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for kind, stats in report["handlers"].items():
+        print(f"{kind:<16}{stats['count']:>8}{stats['mean_ms']:>10}{stats['p50_ms']:>10}"
+              f"{stats['p95_ms']:>10}{stats['p99_ms']:>10}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay synthetic Telegram updates through the bot")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=1, help="simulated users in flight at once")
+    parser.add_argument("--bot-latency", type=float, default=0.0, help="seconds per Bot API call")
+    parser.add_argument("--panel-latency", type=float, default=0.0, help="seconds per panel request")
+    parser.add_argument("--seed-clients", type=int, default=0, help="extra clients preloaded on the panel")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    workdir = tempfile.mkdtemp(prefix="vpnbot_loadtest_")
+    with XUIPanelSimulator(latency=args.panel_latency) as panel:
+        panel.seed_clients(args.seed_clients)
+
+        # Point the bot modules at the scratch database and simulator before importing them
+        config.DB_FILE = os.path.join(workdir, "loadtest.db")
+        config.XUI_URL = panel.url
+        config.ADMIN_IDS = [ADMIN_ID]
+        config.ALLOW_BUY = True
+
+        test = LoadTest(args.users, args.concurrency, args.bot_latency)
+        report = asyncio.run(test.run())
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+if __name__ == '__main__':
+    main()
@@ -73,10 +73,13 @@ def get_configs_keyboard(configs):
     return InlineKeyboardMarkup(keyboard)
 
 # Create a keyboard for showing config status
-def get_config_status_keyboard():
+def get_config_status_keyboard(show_qr=True):
     """Get keyboard for config status view"""
+    first_row = [InlineKeyboardButton("🔄 بروزرسانی", callback_data="refresh_status")]
+    if show_qr:
+        first_row.append(InlineKeyboardButton("📷 QR کد", callback_data="config_qr"))
     keyboard = [
-        [InlineKeyboardButton("🔄 بروزرسانی", callback_data="refresh_status")],
+        first_row,
         [InlineKeyboardButton("⏫ افزایش حجم", callback_data="extend_config")],
         [InlineKeyboardButton("بازگشت به لیست سرویس ها", callback_data="check_status")],
         [InlineKeyboardButton("🏠 منوی اصلی", callback_data="back_to_main")]
@@ -95,12 +98,17 @@ def get_admin_approval_keyboard(payment_id):
 # Admin menu keyboard
 def get_admin_menu_keyboard():
     return InlineKeyboardMarkup([
+        [InlineKeyboardButton("📈 داشبورد", callback_data="admin_dashboard")],
         [InlineKeyboardButton("📊 درخواست‌های در انتظار", callback_data="admin_pending")],
         [InlineKeyboardButton("👥 مشاهده کاربران", callback_data="admin_users")],
+        [InlineKeyboardButton("🟢 کاربران آنلاین", callback_data="admin_online")],
         [InlineKeyboardButton("🎫 تیکت‌های پشتیبانی", callback_data="admin_tickets")],
         [InlineKeyboardButton("👨‍💻 مدیریت کلاینت ها", callback_data="admin_manage_clients")],
         [InlineKeyboardButton("📢 ارسال پیام به همه", callback_data="admin_broadcast")],
         [InlineKeyboardButton("⏱️ تمدید همه کلاینت ها", callback_data="admin_extend_all")],
+        [InlineKeyboardButton("🎁 ساخت گروهی کانفیگ هدیه", callback_data="admin_bulk_gift")],
+        [InlineKeyboardButton("🔄 همگام‌سازی پنل و دیتابیس", callback_data="admin_reconcile")],
+        [InlineKeyboardButton("🧹 پاکسازی کلاینت‌های منقضی", callback_data="admin_cleanup")],
         [InlineKeyboardButton("فعال/غیر فعال سازی فروش", callback_data="admin_buy_allow")]
     ])
 
@@ -118,3 +126,23 @@ def get_buy_allow_keyboard():
         [InlineKeyboardButton("برگشت", callback_data="admin_menu")],
 
     ])
+
+def get_cleanup_keyboard(count, plan_id=None):
+    keyboard = []
+    if count:
+        keyboard.append([InlineKeyboardButton(f"🗑 حذف {count} کلاینت",
+                                              callback_data=f"admin_cleanup_confirm_{plan_id}")])
+    keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data="admin_menu")])
+    return InlineKeyboardMarkup(keyboard)
+
+# Bulk gift presets: (count, gb, days)
+BULK_GIFT_PRESETS = [(10, 1, 1), (10, 5, 7), (50, 1, 1), (50, 5, 7)]
+
+def get_bulk_gift_keyboard():
+    keyboard = [
+        [InlineKeyboardButton(f"{count} کانفیگ {gb}GB / {days} روزه",
+                              callback_data=f"admin_bulk_gift_{count}_{gb}_{days}")]
+        for count, gb, days in BULK_GIFT_PRESETS
+    ]
+    keyboard.append([InlineKeyboardButton("برگشت", callback_data="admin_menu")])
+    return InlineKeyboardMarkup(keyboard)
@@ -0,0 +1,68 @@
+"""
+Edits that skip unchanged messages
+Keeps a hash of the text and keyboard last rendered into each (chat, message)
+in a bounded LRU. An edit with the same hash is skipped without a Bot API
+call, since Telegram would reject it with "message is not modified". The
+message text seen in the callback must still match what was rendered, so an
+edit made by another handler in between is never mistaken for a repeat.
+"""
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+
+from telegram.error import BadRequest
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Messages whose last rendering is remembered
+CACHE_SIZE = 5000
+
+EDITS = metrics.Counter("vpnbot_message_edits_total", "Message edits by result", ["result"])
+
+_rendered = OrderedDict()
+
+def _render_hash(text, reply_markup, parse_mode):
+    markup = json.dumps(reply_markup.to_dict(), sort_keys=True) if reply_markup else ""
+    return hashlib.sha256(f"{parse_mode}\0{text}\0{markup}".encode("utf-8")).hexdigest()
+
+def _remember(key, digest, shown_text):
+    _rendered[key] = (digest, shown_text)
+    _rendered.move_to_end(key)
+    while len(_rendered) > CACHE_SIZE:
+        _rendered.popitem(last=False)
+
+async def safe_edit(query, text, reply_markup=None, parse_mode=None):
+    """Edit a callback query's message unless it already shows this text and keyboard
+
+    Returns:
+        bool: True if the message was edited, False if it was already up to date
+    """
+    message = query.message
+    if message is None:
+        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+        return True
+
+    key = (message.chat_id, message.message_id)
+    digest = _render_hash(text, reply_markup, parse_mode)
+    cached = _rendered.get(key)
+    if cached and cached[0] == digest and cached[1] == message.text:
+        _rendered.move_to_end(key)
+        EDITS.inc("skipped")
+        return False
+
+    try:
+        edited = await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+        _remember(key, digest, message.text)
+        EDITS.inc("not_modified")
+        return False
+
+    if edited is not True:
+        _remember(key, digest, edited.text)
+    EDITS.inc("edited")
+    return True
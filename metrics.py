@@ -0,0 +1,205 @@
+"""
+Prometheus-style metrics for the VPN bot
+Counters, gauges and latency histograms kept in memory and served as text
+exposition format on a local /metrics endpoint.
+"""
+import bisect
+import contextvars
+import functools
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+
+# Set while an instrumented function runs, so calls it makes to other
+# instrumented functions are not counted and timed a second time
+_in_instrumented_call = contextvars.ContextVar("in_instrumented_call", default=False)
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+class _Metric:
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+
+class Counter(_Metric):
+    """Monotonically increasing value per label set"""
+    type_name = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        with self._lock:
+            items = list(self._values.items())
+        return self._header() + [f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+                                 for labels, value in items]
+
+class Gauge(_Metric):
+    """Value that can go up and down, or be read from a callback at scrape time"""
+    type_name = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set_function(self, function):
+        """Read the (unlabelled) value from `function` on every scrape"""
+        self._function = function
+
+    def render(self):
+        if self._function is not None:
+            try:
+                self.set(self._function())
+            except Exception as e:
+                logger.error(f"Error reading gauge {self.name}: {e}")
+        with self._lock:
+            items = list(self._values.items())
+        return self._header() + [f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+                                 for labels, value in items]
+
+class Histogram(_Metric):
+    """Cumulative bucketed distribution of observed values"""
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # Per-bucket counts, then sum; buckets are made cumulative at render time
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def render(self):
+        with self._lock:
+            items = [(labels, (list(counts), total)) for labels, (counts, total) in self._values.items()]
+        lines = self._header()
+        for labels, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, ('le', le))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+# Bot metrics
+CALLBACK_DURATION = Histogram("vpnbot_callback_duration_seconds",
+                              "Callback query handling time by route", ["route"])
+CALLBACK_ERRORS = Counter("vpnbot_callback_errors_total", "Callback queries that raised, by route", ["route"])
+XUI_REQUESTS = Counter("vpnbot_xui_requests_total", "XUI panel API responses by endpoint and status",
+                       ["endpoint", "status"])
+XUI_DURATION = Histogram("vpnbot_xui_request_duration_seconds", "XUI panel API latency by endpoint", ["endpoint"])
+DB_DURATION = Histogram("vpnbot_db_call_duration_seconds", "Database function time by function", ["function"],
+                        buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0))
+DB_ERRORS = Counter("vpnbot_db_call_errors_total", "Database functions that raised", ["function"])
+BOT_API_DURATION = Histogram("vpnbot_bot_api_request_duration_seconds", "Telegram Bot API latency by method",
+                             ["method"])
+BOT_API_INFLIGHT = Gauge("vpnbot_bot_api_requests_in_flight", "Outbound Telegram Bot API requests waiting on a reply")
+UPDATE_QUEUE_SIZE = Gauge("vpnbot_update_queue_size", "Updates received but not yet processed")
+NOTIFICATION_SWEEP_SECONDS = Gauge("vpnbot_notification_sweep_seconds", "Duration of the last expiry notification sweep")
+
+def render():
+    """Render every registered metric in Prometheus text format"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+def instrument_module(namespace, module_name):
+    """Wrap every public function defined in a module so its calls are timed
+
+    Call at the bottom of the module with globals(). Only the outermost call
+    is recorded when instrumented functions call each other.
+    """
+    for name, value in list(namespace.items()):
+        if name.startswith("_") or not callable(value) or getattr(value, "__module__", None) != module_name:
+            continue
+        if isinstance(value, type):
+            continue
+        namespace[name] = _timed_db_call(value)
+
+def _timed_db_call(func):
+    label = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _in_instrumented_call.get():
+            return func(*args, **kwargs)
+        token = _in_instrumented_call.set(True)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            DB_ERRORS.inc(label)
+            raise
+        finally:
+            DB_DURATION.observe(time.perf_counter() - start, label)
+            _in_instrumented_call.reset(token)
+
+    return wrapper
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+def start_metrics_server(port, host="127.0.0.1"):
+    """Serve /metrics from a background thread"""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logger.info(f"Metrics endpoint listening on http://{host}:{server.server_address[1]}/metrics")
+    return server
@@ -11,10 +11,14 @@ import schedule
 from telegram.ext import ApplicationBuilder
 from telegram import Bot, InlineKeyboardMarkup
 
-from config import BOT_TOKEN
+from config import BOT_TOKEN, RECONCILE_INTERVAL_HOURS, RECONCILE_AUTO_REPAIR, CLEANUP_INTERVAL_HOURS
 from database import get_all_configs_with_users, update_notification_sent
 from xui_api import get_client_status, ensure_authenticated
-from menus import get_back_to_main_button
+from menus import get_back_to_main_button, get_cleanup_keyboard
+import metrics
+import reconciliation
+import client_cleanup
+from admin_notifications import send_to_admins
 
 logger = logging.getLogger(__name__)
 
@@ -38,6 +42,13 @@ async def send_notification(bot, user_id, message):
 
 async def check_and_notify_expiring_configs(bot):
     """Check for configs near expiry or data limit and send notifications"""
+    start = time.perf_counter()
+    try:
+        await _check_and_notify_expiring_configs(bot)
+    finally:
+        metrics.NOTIFICATION_SWEEP_SECONDS.set(time.perf_counter() - start)
+
+async def _check_and_notify_expiring_configs(bot):
     logger.info("Starting check for expiring configs")
 
     # Ensure we're authenticated with the XUI panel once at the beginning
@@ -95,6 +106,19 @@ async def check_and_notify_expiring_configs(bot):
                 # Update notification timestamp
                 update_notification_sent(config_id)
 
+async def send_cleanup_report(bot):
+    """Record depleted clients, then send admins a dry run of the client cleanup
+
+    Removal needs their confirmation.
+    """
+    client_cleanup.record_depletion()
+    plan = client_cleanup.plan_cleanup()
+    count = client_cleanup.cleanup_count(plan)
+    if not count:
+        return
+    await send_to_admins(bot, "send_message", text=client_cleanup.format_plan(plan),
+                         reply_markup=get_cleanup_keyboard(count, plan['plan_id']))
+
 def run_scheduler():
     """Run the scheduler in a background thread"""
     bot = Bot(token=BOT_TOKEN)
@@ -105,8 +129,27 @@ def run_scheduler():
         asyncio.set_event_loop(loop)
         loop.run_until_complete(check_and_notify_expiring_configs(bot))
 
-    # Schedule the job
+    def reconcile_job():
+        try:
+            reconciliation.reconcile(repair=RECONCILE_AUTO_REPAIR)
+        except Exception as e:
+            logger.error(f"Scheduled reconciliation failed: {e}")
+
+    def cleanup_job():
+        import asyncio
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(send_cleanup_report(bot))
+        except Exception as e:
+            logger.error(f"Scheduled cleanup report failed: {e}")
+
+    # Schedule the jobs
     schedule.every(CHECK_INTERVAL_HOURS).hours.do(job)
+    if CLEANUP_INTERVAL_HOURS:
+        schedule.every(CLEANUP_INTERVAL_HOURS).hours.do(cleanup_job)
+    if RECONCILE_INTERVAL_HOURS:
+        schedule.every(RECONCILE_INTERVAL_HOURS).hours.do(reconcile_job)
 
     while True:
         schedule.run_pending()
@@ -0,0 +1,256 @@
+"""
+SQLite persistence for context.user_data and context.bot_data
+Entries are stored one pickled value per key in the bot database, so values
+come back with the same types (e.g. dicts keyed by int payment ids).
+user_data and bot_data are TrackedDicts that remember which keys were set,
+deleted or read since the last persistence run; each update call pickles only
+those keys and writes the ones whose pickle changed. Changes from one
+persistence run are flushed in a single transaction in the order they happened.
+"""
+import asyncio
+import copy
+import json
+import logging
+import pickle
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from database import load_user_state, load_bot_state, write_state_changes
+
+logger = logging.getLogger(__name__)
+
+# Seconds between persistence runs triggered by the Application
+UPDATE_INTERVAL = 10
+
+class TrackedDict(dict):
+    """A dict that remembers which keys were touched since the last persistence run
+
+    Setting, deleting or reading a key marks it: a value read may be changed in
+    place. Iterating items() or values() does not, so in-place changes must go
+    through key access to be persisted. The Application deep-copies the data
+    for the persistence, and the copy takes over the touched keys.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.touched = set()
+
+    def __setitem__(self, key, value):
+        self.touched.add(key)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.touched.add(key)
+        super().__delitem__(key)
+
+    def __getitem__(self, key):
+        self.touched.add(key)
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self.touched.add(key)
+        return super().get(key, default)
+
+    def setdefault(self, key, default=None):
+        self.touched.add(key)
+        return super().setdefault(key, default)
+
+    def pop(self, key, *default):
+        self.touched.add(key)
+        return super().pop(key, *default)
+
+    def popitem(self):
+        key, value = super().popitem()
+        self.touched.add(key)
+        return key, value
+
+    def update(self, *args, **kwargs):
+        changes = dict(*args, **kwargs)
+        self.touched.update(changes)
+        super().update(changes)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self):
+        self.touched.update(self.keys())
+        super().clear()
+
+    def __deepcopy__(self, memo):
+        result = TrackedDict()
+        memo[id(self)] = result
+        for key, value in super().items():
+            dict.__setitem__(result, key, copy.deepcopy(value, memo))
+        result.touched, self.touched = self.touched, set()
+        return result
+
+class SQLitePersistence(BasePersistence):
+    """Persist user_data and bot_data in the bot's SQLite database"""
+
+    def __init__(self, update_interval=UPDATE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=True, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        # Last written pickle per key, used to detect which keys changed
+        self._user_written = {}
+        self._bot_written = {}
+        # Changes not yet written, in the order they happened:
+        # (scope, user_id, key) -> encoded value, or None to delete; key None drops a whole user
+        self._pending = {}
+        self._flush_scheduled = False
+
+    @staticmethod
+    def _encode(key, value):
+        if not isinstance(key, str):
+            logger.warning(f"Not persisting non-string key {key!r}")
+            return None
+        try:
+            return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            logger.warning(f"Not persisting key {key!r}: {e}")
+            return None
+
+    @staticmethod
+    def _decode(value):
+        # Entries written before values were pickled are JSON text
+        if isinstance(value, str):
+            return json.loads(value)
+        return pickle.loads(value)
+
+    def _queue(self, change, value):
+        """Queue a change after every change queued before it"""
+        self._pending.pop(change, None)
+        self._pending[change] = value
+
+    def _diff(self, written, data):
+        """Return (changed {key: pickle}, removed keys) between written snapshot and data
+
+        Only the keys touched since the last run are compared; data that is not
+        a TrackedDict is compared key by key in full.
+        """
+        if isinstance(data, TrackedDict):
+            keys = data.touched
+        else:
+            keys = set(data).union(written)
+        changed = {}
+        removed = []
+        for key in keys:
+            if dict.__contains__(data, key):
+                encoded = self._encode(key, dict.__getitem__(data, key))
+                if encoded is not None and written.get(key) != encoded:
+                    changed[key] = encoded
+            elif key in written:
+                removed.append(key)
+        return changed, removed
+
+    # Loading
+
+    async def get_user_data(self):
+        user_data = {}
+        for user_id, key, value in load_user_state():
+            dict.__setitem__(user_data.setdefault(user_id, TrackedDict()), key, self._decode(value))
+            self._user_written.setdefault(user_id, {})[key] = value
+        logger.info(f"Loaded persisted state for {len(user_data)} users")
+        return user_data
+
+    async def get_bot_data(self):
+        bot_data = TrackedDict()
+        for key, value in load_bot_state():
+            dict.__setitem__(bot_data, key, self._decode(value))
+            self._bot_written[key] = value
+        return bot_data
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    # Updating
+
+    async def update_user_data(self, user_id, data):
+        written = self._user_written.setdefault(user_id, {})
+        changed, removed = self._diff(written, data)
+        if not changed and not removed:
+            return
+        for key, encoded in changed.items():
+            written[key] = encoded
+            self._queue(('user', user_id, key), encoded)
+        for key in removed:
+            del written[key]
+            self._queue(('user', user_id, key), None)
+        self._schedule_flush()
+
+    async def update_bot_data(self, data):
+        changed, removed = self._diff(self._bot_written, data)
+        if not changed and not removed:
+            return
+        for key, encoded in changed.items():
+            self._bot_written[key] = encoded
+            self._queue(('bot', None, key), encoded)
+        for key in removed:
+            del self._bot_written[key]
+            self._queue(('bot', None, key), None)
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id):
+        self._user_written.pop(user_id, None)
+        # Earlier changes of this user are superseded by the drop
+        for change in [change for change in self._pending if change[:2] == ('user', user_id)]:
+            del self._pending[change]
+        self._queue(('user', user_id, None), None)
+        self._schedule_flush()
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    # Flushing
+
+    def _schedule_flush(self):
+        """Write pending changes once the current persistence run has queued all of its updates"""
+        if self._flush_scheduled:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._flush_pending()
+            return
+        self._flush_scheduled = True
+        loop.call_soon(self._flush_pending)
+
+    def _flush_pending(self):
+        self._flush_scheduled = False
+        if not self._pending:
+            return
+
+        changes = [(scope, user_id, key, value) for (scope, user_id, key), value in self._pending.items()]
+        if write_state_changes(changes):
+            self._pending.clear()
+            deleted = sum(1 for change in changes if change[3] is None)
+            logger.debug(f"Persisted {len(changes) - deleted} changed entries, removed {deleted}")
+
+    async def flush(self):
+        self._flush_pending()
@@ -0,0 +1,115 @@
+"""
+On-demand profiling of the running bot
+Captures a time-boxed cProfile of the event loop thread together with a
+sampled view of every other thread (such as the notification scheduler) and
+the asyncio task stacks. Nothing is installed while no capture is running.
+"""
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+MAX_CAPTURE_SECONDS = 300
+_capture_running = False
+
+class ProfilerBusyError(Exception):
+    """Raised when a capture is requested while another one is running"""
+
+def _sample_threads(stop_event, interval, loop_thread_id, samples):
+    """Collect collapsed stacks of all other threads until stop_event is set"""
+    exclude_ids = {loop_thread_id, threading.get_ident()}
+    names = {}
+    while not stop_event.wait(interval):
+        for thread in threading.enumerate():
+            names[thread.ident] = thread.name
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id in exclude_ids:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            samples[(names.get(thread_id, str(thread_id)), ";".join(reversed(stack)))] += 1
+
+def _format_task_stacks(loop):
+    output = io.StringIO()
+    for task in asyncio.all_tasks(loop):
+        output.write(f"--- {task.get_name()} ({'done' if task.done() else 'pending'})\n")
+        task.print_stack(limit=20, file=output)
+    return output.getvalue()
+
+async def capture(seconds, top_n=25, sample_interval=0.01):
+    """Profile the process for `seconds` and return the results
+
+    Returns:
+        dict: 'summary' (top-N functions as text), 'profile' (pstats file bytes)
+              and 'stacks' (thread samples and asyncio task stacks as text)
+    """
+    global _capture_running
+    if _capture_running:
+        raise ProfilerBusyError("A profile capture is already running")
+    _capture_running = True
+
+    seconds = max(1, min(seconds, MAX_CAPTURE_SECONDS))
+    samples = Counter()
+    stop_event = threading.Event()
+    sampler = threading.Thread(
+        target=_sample_threads,
+        args=(stop_event, sample_interval, threading.get_ident(), samples),
+        name="profiler-sampler",
+        daemon=True
+    )
+
+    profile = cProfile.Profile()
+    try:
+        sampler.start()
+        profile.enable()
+        started = time.perf_counter()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profile.disable()
+            task_stacks = _format_task_stacks(asyncio.get_running_loop())
+            stop_event.set()
+            sampler.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        _capture_running = False
+
+    summary_stream = io.StringIO()
+    stats = pstats.Stats(profile, stream=summary_stream)
+    stats.strip_dirs().sort_stats("tottime").print_stats(top_n)
+
+    fd, path = tempfile.mkstemp(suffix=".prof")
+    os.close(fd)
+    try:
+        profile.dump_stats(path)
+        with open(path, "rb") as f:
+            profile_bytes = f.read()
+    finally:
+        os.remove(path)
+
+    stacks = io.StringIO()
+    stacks.write(f"Capture of {elapsed:.1f}s, sampled every {sample_interval * 1000:.0f}ms\n\n")
+    stacks.write("=== Other threads (samples, collapsed stack) ===\n")
+    for (thread_name, stack), count in samples.most_common():
+        stacks.write(f"{count} [{thread_name}] {stack}\n")
+    stacks.write("\n=== asyncio tasks at end of capture ===\n")
+    stacks.write(task_stacks)
+
+    logger.info(f"Profile capture finished after {elapsed:.1f}s")
+    return {
+        'summary': summary_stream.getvalue(),
+        'profile': profile_bytes,
+        'stacks': stacks.getvalue(),
+    }
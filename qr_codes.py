@@ -0,0 +1,94 @@
+"""
+QR codes for config links
+Renders a vless:// link as a PNG QR code and sends it as a photo. The first
+upload's Telegram file_id is cached per client_id together with a hash of the
+link, so repeat views resend the file_id without rendering or uploading again,
+and a changed link (e.g. after a server move) renders a fresh code. The qrcode
+package is optional; without it only already cached codes can be sent.
+"""
+import asyncio
+import hashlib
+import io
+import logging
+
+from telegram.error import BadRequest
+
+try:
+    import qrcode
+except ImportError:
+    qrcode = None
+
+from database import get_qr_file_id, save_qr_file_id, delete_qr_file_id
+import metrics
+
+logger = logging.getLogger(__name__)
+
+QR_CODES = metrics.Counter("vpnbot_qr_codes_total", "QR codes sent by source", ["result"])
+
+# Whether new QR codes can be rendered; the QR button is only offered if so
+QR_AVAILABLE = qrcode is not None
+
+def link_hash(link):
+    """Short hash identifying the link a cached QR code was rendered from"""
+    return hashlib.sha256(link.encode("utf-8")).hexdigest()[:16]
+
+def render_qr(link):
+    """Render a link as a QR code
+
+    Returns:
+        bytes: PNG image, or None if qrcode is unavailable or rendering failed
+    """
+    if qrcode is None:
+        return None
+    try:
+        image = qrcode.make(link, border=2)
+        buffer = io.BytesIO()
+        image.save(buffer)
+    except Exception as e:
+        logger.warning(f"Could not render QR code: {e}")
+        return None
+    return buffer.getvalue()
+
+async def send_config_qr(bot, chat_id, client_id, link, caption=None, **kwargs):
+    """Send the QR code of a config link as a photo, reusing the cached upload
+
+    Args:
+        bot: telegram.Bot
+        chat_id (int): Chat to send the photo to
+        client_id (str): Config the link belongs to, the cache key
+        link (str): The vless:// link
+        caption (str, optional): Photo caption
+        **kwargs: Extra send_photo arguments such as parse_mode or reply_markup
+
+    Returns:
+        telegram.Message: The sent photo, or None if no QR code could be sent
+    """
+    digest = link_hash(link)
+    file_id = get_qr_file_id(client_id, digest)
+    if file_id:
+        try:
+            message = await bot.send_photo(chat_id=chat_id, photo=file_id, caption=caption, **kwargs)
+            QR_CODES.inc("cached")
+            return message
+        except BadRequest as e:
+            logger.warning(f"Cached QR code of {client_id} was rejected, rendering it again: {e}")
+            delete_qr_file_id(client_id)
+        except Exception as e:
+            logger.error(f"Error sending QR code to {chat_id}: {e}")
+            QR_CODES.inc("failed")
+            return None
+
+    png = await asyncio.to_thread(render_qr, link)
+    if png is None:
+        QR_CODES.inc("unavailable")
+        return None
+    try:
+        message = await bot.send_photo(chat_id=chat_id, photo=png, caption=caption, **kwargs)
+    except Exception as e:
+        logger.error(f"Error sending QR code to {chat_id}: {e}")
+        QR_CODES.inc("failed")
+        return None
+    if message.photo:
+        save_qr_file_id(client_id, digest, message.photo[-1].file_id)
+    QR_CODES.inc("rendered")
+    return message
@@ -0,0 +1,124 @@
+"""
+Panel to database reconciliation for the VPN bot
+Diffs one inbounds/list snapshot of the XUI panel against the configs table
+by client_id, comparing is_active and total_gb of every config found on both
+sides. Drift can be reported only, or repaired in the database.
+"""
+import logging
+
+from db_utils import get_configs_for_reconciliation, apply_config_repairs
+from xui_api import get_inbound_clients
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Differences in total_gb below this are rounding, not drift
+GB_TOLERANCE = 0.01
+
+DRIFT = metrics.Gauge("vpnbot_reconcile_drift", "Configs out of sync with the panel at the last reconciliation",
+                      ["kind"])
+
+def reconcile(repair=False):
+    """Compare the panel with the configs table and optionally fix the database
+
+    The panel is treated as the source of truth: configs missing from the panel
+    are deactivated and is_active/total_gb are copied from the panel. Clients
+    that only exist on the panel are reported but never touched.
+
+    Args:
+        repair (bool): Write the fixes to the database
+
+    Returns:
+        dict: Report with 'panel_clients', 'db_configs', 'panel_only',
+              'db_only', 'active_mismatch', 'gb_mismatch' and 'repaired',
+              or None if the panel could not be read
+    """
+    panel_clients = get_inbound_clients()
+    if panel_clients is None:
+        logger.error("Reconciliation skipped: could not read the panel")
+        return None
+
+    panel = {}
+    for client in panel_clients:
+        if not client.get('id'):
+            continue
+        total_gb = (client.get('totalGB') or 0) / (1024 ** 3)
+        panel[client['id']] = (client.get('email'), bool(client.get('stats_enable')), total_gb)
+
+    report = {
+        'panel_clients': len(panel),
+        'db_configs': 0,
+        'panel_only': [],
+        'db_only': [],
+        'active_mismatch': [],
+        'gb_mismatch': [],
+        'repaired': 0,
+    }
+    repairs = []
+    seen = set()
+
+    for config_id, client_id, email, total_gb, is_active in get_configs_for_reconciliation():
+        report['db_configs'] += 1
+        seen.add(client_id)
+        panel_row = panel.get(client_id)
+
+        if panel_row is None:
+            # Only active configs missing from the panel need attention
+            if is_active:
+                report['db_only'].append(email)
+                repairs.append((config_id, False, total_gb))
+            continue
+
+        panel_email, panel_active, panel_gb = panel_row
+        active_mismatch = bool(is_active) != panel_active
+        gb_mismatch = abs((total_gb or 0) - panel_gb) > GB_TOLERANCE
+        if active_mismatch:
+            report['active_mismatch'].append(email)
+        if gb_mismatch:
+            report['gb_mismatch'].append(email)
+        if active_mismatch or gb_mismatch:
+            repairs.append((config_id, panel_active, round(panel_gb, 2)))
+
+    report['panel_only'] = [row[0] for client_id, row in panel.items() if client_id not in seen]
+
+    for kind in ('panel_only', 'db_only', 'active_mismatch', 'gb_mismatch'):
+        DRIFT.set(len(report[kind]), kind)
+
+    if repair and repairs:
+        report['repaired'] = apply_config_repairs(repairs)
+
+    logger.info(f"Reconciliation: {len(report['panel_only'])} panel-only, {len(report['db_only'])} db-only, "
+                f"{len(report['active_mismatch'])} is_active and {len(report['gb_mismatch'])} total_gb "
+                f"mismatches, {report['repaired']} repaired")
+    return report
+
+def format_report(report, limit=10):
+    """Format a reconciliation report as an admin message"""
+    if report is None:
+        return "❌ خطا در دریافت اطلاعات از پنل."
+
+    lines = [
+        "🔄 گزارش همگام‌سازی پنل و دیتابیس\n",
+        f"🔌 پنل: {report['panel_clients']} | 💾 دیتابیس: {report['db_configs']}\n",
+    ]
+    sections = (
+        ('panel_only', "📱 فقط در پنل (بدون تغییر)"),
+        ('db_only', "💾 فعال در دیتابیس ولی حذف‌شده از پنل"),
+        ('active_mismatch', "🔌 وضعیت فعال/غیرفعال متفاوت"),
+        ('gb_mismatch', "📦 حجم متفاوت"),
+    )
+    for key, title in sections:
+        emails = report[key]
+        lines.append(f"{title}: {len(emails)}")
+        for email in emails[:limit]:
+            lines.append(f"  • {email}")
+        if len(emails) > limit:
+            lines.append(f"  ... و {len(emails) - limit} مورد دیگر")
+
+    if report['repaired']:
+        lines.append(f"\n✅ {report['repaired']} کانفیگ در دیتابیس اصلاح شد.")
+    return "\n".join(lines)
+
+def has_repairs(report):
+    """Whether a report contains drift that repair would fix"""
+    return bool(report and (report['db_only'] or report['active_mismatch'] or report['gb_mismatch']))
@@ -0,0 +1,119 @@
+"""
+Subscription endpoint for VPN clients
+Serves GET /sub/<sub_id> as a standard subscription document: the user's
+active vless:// links, one per line, base64 encoded. Bodies are built once per
+config version and kept in a bounded in-memory cache, so a poll costs one
+indexed lookup of the version. Clients that send the ETag back in
+If-None-Match get 304 Not Modified while nothing changed.
+"""
+import base64
+import hashlib
+import logging
+import re
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config_links import generate_vless_link
+from database import get_subscription_version, get_subscription_configs
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Subscriptions whose bodies are kept in memory
+CACHE_SIZE = 10000
+
+# Hours clients should wait between polls (Profile-Update-Interval header)
+UPDATE_INTERVAL_HOURS = 12
+
+REQUESTS = metrics.Counter("vpnbot_subscription_requests_total",
+                           "Subscription requests by result", ["result"])
+
+_SUB_PATH = re.compile(r"^/sub/([A-Za-z0-9_-]{1,64})$")
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+def build_subscription(user_id):
+    """Build the subscription body of a user
+
+    Returns:
+        tuple: (body bytes, digest) where digest is a short hash of the body
+    """
+    links = [generate_vless_link(client_id, email) for client_id, email in get_subscription_configs(user_id)]
+    body = base64.b64encode("\n".join(links).encode("utf-8"))
+    return body, hashlib.sha256(body).hexdigest()[:16]
+
+def get_subscription(sub_id):
+    """Get the current body and ETag of a subscription, using the cache when the version matches
+
+    Returns:
+        tuple: (body, etag, cached), or None if the sub_id is unknown
+    """
+    found = get_subscription_version(sub_id)
+    if found is None:
+        return None
+    user_id, version = found
+
+    with _cache_lock:
+        entry = _cache.get(sub_id)
+        if entry and entry[0] == version:
+            _cache.move_to_end(sub_id)
+            return entry[1], entry[2], True
+
+    body, digest = build_subscription(user_id)
+    etag = f'"{version}-{digest}"'
+    with _cache_lock:
+        _cache[sub_id] = (version, body, etag)
+        _cache.move_to_end(sub_id)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return body, etag, False
+
+class _SubscriptionHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        match = _SUB_PATH.match(self.path.split("?")[0])
+        if not match:
+            self.send_error(404)
+            return
+        try:
+            subscription = get_subscription(match.group(1))
+        except Exception as e:
+            logger.error(f"Error building subscription: {e}")
+            REQUESTS.inc("error")
+            self.send_error(500)
+            return
+        if subscription is None:
+            REQUESTS.inc("not_found")
+            self.send_error(404)
+            return
+
+        body, etag, cached = subscription
+        if etag in [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]:
+            REQUESTS.inc("not_modified")
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        REQUESTS.inc("hit" if cached else "miss")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Profile-Update-Interval", str(UPDATE_INTERVAL_HOURS))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+def start_subscription_server(port, host="127.0.0.1"):
+    """Serve /sub/<sub_id> from a background thread"""
+    server = ThreadingHTTPServer((host, port), _SubscriptionHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logger.info(f"Subscription endpoint listening on http://{host}:{server.server_address[1]}/sub/")
+    return server
@@ -0,0 +1,15 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """A fresh bot database for one test"""
+    monkeypatch.setattr(database, "DB_FILE", str(tmp_path / "bot.db"))
+    database.init_db()
+    return database
@@ -0,0 +1,139 @@
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytest
+
+def _payment(db, user_id=7):
+    db.get_or_create_user(user_id, f"user{user_id}", f"User {user_id}", None)
+    payment_id, _ = db.save_payment_request(user_id, "10", "file")
+    return payment_id
+
+def _status(db, payment_id):
+    return db.get_payment_outcome(payment_id)[0]
+
+def _backdate_claim(db, payment_id):
+    stale = datetime.now() - timedelta(seconds=db.PAYMENT_CLAIM_TIMEOUT + 60)
+    conn = sqlite3.connect(db.DB_FILE)
+    conn.execute("UPDATE payments SET claimed_at = ? WHERE payment_id = ?",
+                 (stale.strftime('%Y-%m-%d %H:%M:%S'), payment_id))
+    conn.commit()
+    conn.close()
+
+def _race(func, payment_id, workers=8):
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda _: func(payment_id), range(workers)))
+
+def test_claim_succeeds_once(db):
+    payment_id = _payment(db)
+
+    assert db.claim_payment(payment_id)[:2] == (7, "10")
+    assert db.claim_payment(payment_id) is None
+    assert _status(db, payment_id) == 'processing'
+
+def test_concurrent_claims_have_one_winner(db):
+    payment_id = _payment(db)
+
+    results = _race(db.claim_payment, payment_id)
+
+    assert sum(result is not None for result in results) == 1
+
+def test_release_makes_payment_claimable_again(db):
+    payment_id = _payment(db)
+    db.claim_payment(payment_id)
+
+    db.release_payment(payment_id)
+
+    assert _status(db, payment_id) == 'pending'
+    assert db.claim_payment(payment_id) is not None
+
+def test_release_after_finish_keeps_outcome(db):
+    payment_id = _payment(db)
+    db.claim_payment(payment_id)
+    db.finish_payment(payment_id, 'approved', "user7_x@vpn", 1)
+
+    db.release_payment(payment_id)
+
+    assert db.get_payment_outcome(payment_id)[:2] == ('approved', "user7_x@vpn")
+    assert db.claim_payment(payment_id) is None
+
+def test_finish_requires_claim(db):
+    payment_id = _payment(db)
+
+    db.finish_payment(payment_id, 'approved', "user7_x@vpn")
+
+    assert _status(db, payment_id) == 'pending'
+
+def test_second_finish_does_not_overwrite_first(db):
+    payment_id = _payment(db)
+    db.claim_payment(payment_id)
+
+    db.finish_payment(payment_id, 'approved', "first@vpn")
+    db.finish_payment(payment_id, 'rejected', "second")
+
+    assert db.get_payment_outcome(payment_id)[:2] == ('approved', "first@vpn")
+
+def test_fresh_claim_is_not_reclaimed(db):
+    payment_id = _payment(db)
+    db.claim_payment(payment_id)
+
+    assert db.reclaim_stale_payment(payment_id) is None
+    assert db.get_stale_payments() == []
+
+def test_stale_claim_is_listed_and_reclaimed_once(db):
+    payment_id = _payment(db)
+    db.claim_payment(payment_id)
+    _backdate_claim(db, payment_id)
+
+    assert [row[0] for row in db.get_stale_payments()] == [payment_id]
+    results = _race(db.reclaim_stale_payment, payment_id)
+
+    assert sum(result is not None for result in results) == 1
+    assert db.get_stale_payments() == []
+    assert _status(db, payment_id) == 'processing'
+
+def test_stalled_claim_is_not_claimed_again(db):
+    payment_id = _payment(db)
+    db.claim_payment(payment_id)
+    _backdate_claim(db, payment_id)
+
+    assert db.claim_payment(payment_id) is None
+
+def test_reclaim_keeps_recorded_provision(db):
+    payment_id = _payment(db)
+    db.claim_payment(payment_id)
+    db.record_payment_provision(payment_id, "user7_x@vpn", "client-1", 5)
+    _backdate_claim(db, payment_id)
+
+    provision = db.reclaim_stale_payment(payment_id)[4]
+
+    assert provision == {'email': "user7_x@vpn", 'client_id': "client-1", 'base_gb': 5}
+
+def test_claim_without_user_row(db):
+    payment_id, _ = db.save_payment_request(99, "10", "file")
+
+    assert db.claim_payment(payment_id)[:3] == (99, "10", None)
+    _backdate_claim(db, payment_id)
+    assert [row[:4] for row in db.get_stale_payments()] == [(payment_id, 99, "10", "99")]
+
+@pytest.mark.parametrize("allow_unknown_type", [False, True])
+def test_unknown_type_needs_resolving(db, allow_unknown_type):
+    payment_id = _payment(db)
+    conn = sqlite3.connect(db.DB_FILE)
+    conn.execute("UPDATE payments SET extension_unknown = 1 WHERE payment_id = ?", (payment_id,))
+    conn.commit()
+    conn.close()
+
+    claimed = db.claim_payment(payment_id, allow_unknown_type=allow_unknown_type)
+
+    assert (claimed is not None) == allow_unknown_type
+
+def test_resolved_payment_is_claimable(db):
+    payment_id = _payment(db)
+    conn = sqlite3.connect(db.DB_FILE)
+    conn.execute("UPDATE payments SET extension_unknown = 1 WHERE payment_id = ?", (payment_id,))
+    conn.commit()
+    conn.close()
+
+    assert db.resolve_payment_type(payment_id, {'email': "user7_x@vpn", 'client_id': None, 'gb': None, 'days': 30})
+    assert db.claim_payment(payment_id)[3]['email'] == "user7_x@vpn"
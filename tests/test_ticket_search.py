@@ -0,0 +1,55 @@
+import sqlite3
+
+import pytest
+
+@pytest.fixture
+def tickets(db):
+    db.get_or_create_user(7, "owner", "Owner", None)
+    router = db.create_ticket(7, "Router setup")
+    db.add_ticket_message(router, 7, "The VPN app crashes on start", False)
+    billing = db.create_ticket(7, "Billing")
+    db.add_ticket_message(billing, 7, "Payment receipt attached", False)
+    return db, router, billing
+
+def _drop_fts(db):
+    conn = sqlite3.connect(db.DB_FILE)
+    for name in db._TICKET_SEARCH_TRIGGERS:
+        conn.execute(f"DROP TRIGGER {name}")
+    conn.execute("DROP TABLE ticket_messages_fts")
+    conn.execute("DROP TABLE tickets_fts")
+    conn.commit()
+    conn.close()
+
+def test_search_matches_subjects_and_messages(tickets):
+    db, router, billing = tickets
+
+    assert [row[0] for row in db.search_tickets("router")[0]] == [router]
+    rows, has_more = db.search_tickets("crash*")
+    assert [row[0] for row in rows] == [router]
+    assert "«crashes»" in rows[0][5]
+    assert not has_more
+
+def test_search_input_cannot_form_fts_syntax(tickets):
+    db, _, _ = tickets
+
+    assert db.search_tickets('" OR NEAR(') == ([], False)
+    assert db.search_tickets("   ") == ([], False)
+
+def test_search_pages(tickets):
+    db, router, billing = tickets
+    db.add_ticket_message(billing, 7, "Router question too", False)
+
+    first, has_more = db.search_tickets("router", limit=1)
+    second, more_after = db.search_tickets("router", offset=1, limit=1)
+
+    assert has_more and not more_after
+    assert {first[0][0], second[0][0]} == {router, billing}
+
+def test_search_falls_back_to_like_without_fts(tickets):
+    db, router, billing = tickets
+    _drop_fts(db)
+    db.add_ticket_message(billing, 7, "New receipt", False)
+
+    assert [row[0] for row in db.search_tickets("receipt")[0]] == [billing]
+    assert [row[0] for row in db.search_tickets("Router")[0]] == [router]
+    assert db.search_tickets("receipt")[0][0][5] is None
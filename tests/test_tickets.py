@@ -0,0 +1,53 @@
+import pytest
+
+OWNER = 7
+OTHER = 8
+
+@pytest.fixture
+def ticket_id(db):
+    db.get_or_create_user(OWNER, "owner", "Owner", None)
+    db.get_or_create_user(OTHER, "other", "Other", None)
+    ticket_id = db.create_ticket(OWNER, "No connection")
+    db.add_ticket_message(ticket_id, OWNER, "It stopped working", False)
+    return ticket_id
+
+def _messages(db, ticket_id):
+    return [message for _, message, _, _ in db.get_ticket_view(ticket_id)['messages']]
+
+def test_owner_reply_reopens_ticket(db, ticket_id):
+    db.update_ticket_status(ticket_id, 'answered')
+
+    assert db.record_ticket_reply(ticket_id, OWNER, "Still broken", False, owner_id=OWNER) == OWNER
+    assert db.get_ticket_view(ticket_id)['status'] == 'open'
+    assert _messages(db, ticket_id)[-1] == "Still broken"
+
+def test_admin_reply_answers_ticket(db, ticket_id):
+    assert db.record_ticket_reply(ticket_id, 1, "Fixed", True) == OWNER
+    assert db.get_ticket_view(ticket_id)['status'] == 'answered'
+
+def test_reply_to_someone_elses_ticket_is_refused(db, ticket_id):
+    db.update_ticket_status(ticket_id, 'answered')
+
+    assert db.record_ticket_reply(ticket_id, OTHER, "Hijack", False, owner_id=OTHER) is None
+    assert db.get_ticket_view(ticket_id)['status'] == 'answered'
+    assert _messages(db, ticket_id) == ["It stopped working"]
+
+def test_reply_to_missing_ticket(db, ticket_id):
+    assert db.record_ticket_reply(ticket_id + 1, OWNER, "Hello", False, owner_id=OWNER) is None
+    assert db.record_ticket_reply(ticket_id + 1, 1, "Hello", True) is None
+
+def test_view_is_limited_to_owner(db, ticket_id):
+    assert db.get_ticket_view(ticket_id, owner_id=OTHER) is None
+    assert db.get_ticket_view(ticket_id, owner_id=OWNER)['owner_id'] == OWNER
+    assert db.get_ticket_view(ticket_id)['owner_id'] == OWNER
+
+def test_close_is_limited_to_owner(db, ticket_id):
+    assert not db.close_ticket(ticket_id, owner_id=OTHER)
+    assert db.get_ticket_view(ticket_id)['status'] == 'open'
+
+    assert db.close_ticket(ticket_id, owner_id=OWNER)
+    assert db.get_ticket_view(ticket_id)['status'] == 'closed'
+
+def test_admin_can_close_any_ticket(db, ticket_id):
+    assert db.close_ticket(ticket_id)
+    assert not db.close_ticket(ticket_id + 1)
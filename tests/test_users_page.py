@@ -0,0 +1,79 @@
+import pytest
+
+USERS = {
+    1: "alice", 2: "Alina", 3: "al_x", 4: "alx", 5: "ALZ", 6: "am",
+    7: "zed", 8: "Zoe", 9: "z", 10: "{brace", 11: "[bracket", 12: "zz",
+    13: "Ábel", 14: "ábel", 15: "ab", 16: None,
+    120: "n120", 123: "n123", 1200000: "big", 999: "n999",
+}
+
+def _fold(text):
+    return "".join(char.lower() if char.isascii() else char for char in text)
+
+def _expected(search):
+    if search.isdigit():
+        return sorted(user_id for user_id in USERS
+                      if str(user_id).startswith(search) and int(search) != 0)
+    prefix = _fold(search)
+    matches = [(_fold(name), user_id) for user_id, name in USERS.items()
+               if name is not None and _fold(name).startswith(prefix)]
+    return [user_id for _, user_id in sorted(matches)]
+
+def _walk(db, search, limit):
+    """All user_ids over every page forwards, then again walking back from the last page"""
+    pages = []
+    rows, has_more = db.get_users_page(search, limit=limit)
+    pages.append([row[0] for row in rows])
+    while has_more:
+        rows, has_more = db.get_users_page(search, after=rows[-1][0], limit=limit)
+        pages.append([row[0] for row in rows])
+
+    back = [pages[-1]]
+    first = pages[-1]
+    while first:
+        rows, has_more = db.get_users_page(search, before=first[0], limit=limit)
+        first = [row[0] for row in rows]
+        if first:
+            back.insert(0, first)
+        if not has_more:
+            break
+    return [user_id for page in pages for user_id in page], back
+
+@pytest.fixture
+def users(db):
+    for user_id, username in USERS.items():
+        db.get_or_create_user(user_id, username, f"User {user_id}", None)
+    return db
+
+@pytest.mark.parametrize("search", [
+    "al", "AL", "@Al", "al_", "alz", "z", "Z", "zz", "{", "[", "á", "Á", "ab", "nothing",
+])
+def test_username_prefix(users, search):
+    rows, has_more = users.get_users_page(search, limit=50)
+
+    assert [row[0] for row in rows] == _expected(search.lstrip('@'))
+    assert not has_more
+
+@pytest.mark.parametrize("search", ["1", "12", "120", "9", "999", "0", "00"])
+def test_user_id_prefix(users, search):
+    rows, has_more = users.get_users_page(search, limit=50)
+
+    assert [row[0] for row in rows] == _expected(search)
+    assert not has_more
+
+@pytest.mark.parametrize("search", [None, "a", "z", "1"])
+@pytest.mark.parametrize("limit", [1, 2, 3])
+def test_pages_cover_every_match_both_ways(users, search, limit):
+    forward, back = _walk(users, search, limit)
+    expected = sorted(USERS) if search is None else _expected(search)
+
+    assert forward == expected
+    assert [user_id for page in back for user_id in page] == expected
+    assert all(len(page) == limit for page in back[1:-1])
+
+def test_page_rows_carry_active_configs(users):
+    users.save_new_config(1, "alice_1@vpn", "client-1", 10)
+
+    rows, _ = users.get_users_page("alice")
+
+    assert rows == [(1, "User 1", "alice", 1)]
@@ -4,17 +4,57 @@ XUI Panel API interactions
 import requests
 import json
 import logging
+import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import uuid
 from config import XUI_URL, XUI_USERNAME, XUI_PASSWORD, INBOUND_ID
+import metrics
 
 logger = logging.getLogger(__name__)
-session = requests.Session()
-_session_authenticated = False
-_last_login_time = 0
 # Session timeout in seconds (30 minutes)
 SESSION_TIMEOUT = 1800
+# Seconds the online clients listing is reused before asking the panel again
+ONLINE_CACHE_SECONDS = 15
+_online_cache = (0.0, None)
+_online_lock = threading.Lock()
+# Concurrent delClient requests when removing several clients
+REMOVE_CLIENTS_WORKERS = 4
+
+# Strip client identifiers so each endpoint is a single metrics label
+_ENDPOINT_PATTERNS = [
+    (re.compile(r"/getClientTraffics/.*"), "/getClientTraffics"),
+    (re.compile(r"/updateClient/.*"), "/updateClient"),
+    (re.compile(r"/\d+/delClient/.*"), "/delClient"),
+]
+
+def _record_response(response, *args, **kwargs):
+    """Session response hook recording latency and status per panel endpoint"""
+    endpoint = response.request.path_url.split("?")[0]
+    for pattern, replacement in _ENDPOINT_PATTERNS:
+        endpoint = pattern.sub(replacement, endpoint)
+    metrics.XUI_REQUESTS.inc(endpoint, response.status_code)
+    metrics.XUI_DURATION.observe(response.elapsed.total_seconds(), endpoint)
+
+class _PanelSession(threading.local):
+    """Per-thread HTTP session and login state
+
+    requests.Session is not thread safe, and the event loop, the notification
+    scheduler and bulk approval workers all call the panel, so every thread
+    logs in with a session of its own.
+    """
+
+    def __init__(self):
+        self.http = requests.Session()
+        self.http.hooks['response'].append(_record_response)
+        self.authenticated = False
+        self.last_login_time = 0
+
+_panel = _PanelSession()
+# Logins happen one at a time, so a burst of 401s does not hammer the panel
+_login_lock = threading.Lock()
 
 def login_to_xui(force=False):
     """Login to the XUI panel
@@ -25,30 +65,31 @@ def login_to_xui(force=False):
     Returns:
         bool: True if login successful, False otherwise
     """
-    global _session_authenticated, _last_login_time
+    panel = _panel
 
     # If already logged in and session is fresh, don't re-login unless forced
     current_time = time.time()
-    if _session_authenticated and (current_time - _last_login_time) < SESSION_TIMEOUT and not force:
+    if panel.authenticated and (current_time - panel.last_login_time) < SESSION_TIMEOUT and not force:
         return True
 
     url = f"{XUI_URL}/login"
     data = {"username": XUI_USERNAME, "password": XUI_PASSWORD}
-    try:
-        response = session.post(url, json=data)
-        if response.ok:
-            _session_authenticated = True
-            _last_login_time = current_time
-            logger.info("Successfully logged in to XUI panel")
-            return True
-        else:
-            _session_authenticated = False
-            logger.error(f"Login failed with status code: {response.status_code}")
+    with _login_lock:
+        try:
+            response = panel.http.post(url, json=data)
+            if response.ok:
+                panel.authenticated = True
+                panel.last_login_time = current_time
+                logger.info("Successfully logged in to XUI panel")
+                return True
+            else:
+                panel.authenticated = False
+                logger.error(f"Login failed with status code: {response.status_code}")
+                return False
+        except Exception as e:
+            panel.authenticated = False
+            logger.error(f"Exception during login: {e}")
             return False
-    except Exception as e:
-        _session_authenticated = False
-        logger.error(f"Exception during login: {e}")
-        return False
 
 def ensure_authenticated():
     """Ensure the session is authenticated, attempt re-login if needed
@@ -56,10 +97,8 @@ def ensure_authenticated():
     Returns:
         bool: True if authenticated, False otherwise
     """
-    global _session_authenticated
-
     # Try using current session
-    if _session_authenticated:
+    if _panel.authenticated:
         return True
 
     # Session not authenticated, attempt login
@@ -70,11 +109,11 @@ def get_client_status(email):
     if not ensure_authenticated():
         return None
 
-    response = session.get(f"{XUI_URL}/panel/api/inbounds/getClientTraffics/{email}")
+    response = _panel.http.get(f"{XUI_URL}/panel/api/inbounds/getClientTraffics/{email}")
     # If unauthorized, try logging in again and retry
     if response.status_code == 401:
         if login_to_xui(force=True):
-            response = session.get(f"{XUI_URL}/panel/api/inbounds/getClientTraffics/{email}")
+            response = _panel.http.get(f"{XUI_URL}/panel/api/inbounds/getClientTraffics/{email}")
         else:
             return None
 
@@ -120,12 +159,16 @@ def get_client_status(email):
         logger.error(f"Error parsing client status: {e}")
         return None
 
-def create_client(email, total_gb, expiry_time_ms):
-    """Create a new client in the XUI panel"""
+def create_client(email, total_gb, expiry_time_ms, client_id=None):
+    """Create a new client in the XUI panel
+
+    Args:
+        client_id (str, optional): UUID for the client, generated if not given
+    """
     if not ensure_authenticated():
         return None, "Failed to login to XUI panel"
 
-    client_id = str(uuid.uuid4())
+    client_id = client_id or str(uuid.uuid4())
 
     settings = {
         "clients": [
@@ -155,7 +198,7 @@ def create_client(email, total_gb, expiry_time_ms):
     }
 
     try:
-        response = session.post(
+        response = _panel.http.post(
             f"{XUI_URL}/panel/api/inbounds/addClient",
             headers=headers,
             json=payload,
@@ -164,7 +207,7 @@ def create_client(email, total_gb, expiry_time_ms):
         # If unauthorized, try logging in again and retry
         if response.status_code == 401:
             if login_to_xui(force=True):
-                response = session.post(
+                response = _panel.http.post(
                     f"{XUI_URL}/panel/api/inbounds/addClient",
                     headers=headers,
                     json=payload,
@@ -182,6 +225,99 @@ def create_client(email, total_gb, expiry_time_ms):
         logger.error(f"Error creating client: {e}")
         return None, str(e)
 
+def create_clients(client_specs):
+    """Create several clients in the XUI panel with a single addClient request
+
+    Args:
+        client_specs (list): List of dicts with 'email', 'total_gb' (bytes) and
+                             'expiry_time_ms' keys
+
+    Returns:
+        tuple: (created, failed) where created is a list of (email, client_id)
+               and failed is a list of (email, error_message)
+    """
+    if not client_specs:
+        return [], []
+
+    if not ensure_authenticated():
+        return [], [(spec['email'], "Failed to login to XUI panel") for spec in client_specs]
+
+    clients = []
+    for spec in client_specs:
+        clients.append({
+            "id": str(uuid.uuid4()),
+            "flow": "",
+            "email": spec['email'],
+            "limitIp": 0,
+            "totalGB": spec['total_gb'],
+            "expiryTime": spec['expiry_time_ms'],
+            "enable": True,
+            "tgId": "",
+            "subId": str(uuid.uuid4())[:16],
+            "reset": 0
+        })
+
+    payload = {
+        "id": INBOUND_ID,
+        "settings": json.dumps({"clients": clients}, ensure_ascii=False)
+    }
+
+    headers = {
+        "Content-Type": "application/json",
+        "Accept": "application/json"
+    }
+
+    error = None
+    try:
+        response = _panel.http.post(
+            f"{XUI_URL}/panel/api/inbounds/addClient",
+            headers=headers,
+            json=payload,
+            timeout=60
+        )
+        # If unauthorized, try logging in again and retry
+        if response.status_code == 401:
+            if login_to_xui(force=True):
+                response = _panel.http.post(
+                    f"{XUI_URL}/panel/api/inbounds/addClient",
+                    headers=headers,
+                    json=payload,
+                    timeout=60
+                )
+
+        response.raise_for_status()
+
+        data = response.json()
+        if data.get("success"):
+            return [(client['email'], client['id']) for client in clients], []
+        error = data.get("msg", "Error adding clients")
+    except Exception as e:
+        logger.error(f"Error creating clients in bulk: {e}")
+        error = str(e)
+
+    # The request failed or timed out part way, so check what actually landed on the panel
+    return _reconcile_created_clients(clients, error)
+
+def _reconcile_created_clients(clients, error):
+    """Split a failed bulk creation into clients that exist on the panel and ones that don't"""
+    panel_clients = get_inbound_clients()
+    if panel_clients is None:
+        logger.error("Could not fetch panel snapshot to reconcile bulk client creation")
+        return [], [(client['email'], error) for client in clients]
+
+    panel_ids = {client.get('email'): client.get('id') for client in panel_clients}
+
+    created = []
+    failed = []
+    for client in clients:
+        if panel_ids.get(client['email']) == client['id']:
+            created.append((client['email'], client['id']))
+        else:
+            failed.append((client['email'], error))
+
+    logger.info(f"Bulk creation reconciled: {len(created)} created, {len(failed)} failed")
+    return created, failed
+
 def extend_client(email, client_id, additional_gb, new_expiry_time_ms=None):
     """Extend an existing client's quota and/or expiry time
 
@@ -247,7 +383,7 @@ def extend_client(email, client_id, additional_gb, new_expiry_time_ms=None):
 
     try:
         # Use the updateClient endpoint with the client's UUID
-        response = session.post(
+        response = _panel.http.post(
             f"{XUI_URL}/panel/api/inbounds/updateClient/{client_id}",
             headers=headers,
             json=payload,
@@ -257,7 +393,7 @@ def extend_client(email, client_id, additional_gb, new_expiry_time_ms=None):
         # If unauthorized, try logging in again and retry
         if response.status_code == 401:
             if login_to_xui(force=True):
-                response = session.post(
+                response = _panel.http.post(
                     f"{XUI_URL}/panel/api/inbounds/updateClient/{client_id}",
                     headers=headers,
                     json=payload,
@@ -286,12 +422,12 @@ def get_all_clients():
         return None
 
     try:
-        response = session.get(f"{XUI_URL}/panel/api/inbounds/list")
+        response = _panel.http.get(f"{XUI_URL}/panel/api/inbounds/list")
 
         # If unauthorized, try logging in again and retry
         if response.status_code == 401:
             if login_to_xui(force=True):
-                response = session.get(f"{XUI_URL}/panel/api/inbounds/list")
+                response = _panel.http.get(f"{XUI_URL}/panel/api/inbounds/list")
             else:
                 return None
 
@@ -335,6 +471,59 @@ def get_all_clients():
         logger.error(f"Error getting all clients: {e}")
         return None
 
+def get_inbound_clients():
+    """Get a snapshot of all clients on the inbound with one inbounds/list request
+
+    Unlike get_all_clients this does not query traffic per client; the usage
+    figures come from the inbound's clientStats in the same response.
+
+    Returns:
+        list: List of client dicts with 'up', 'down' and 'stats_enable' merged in,
+              or None if error
+    """
+    if not ensure_authenticated():
+        return None
+
+    try:
+        response = _panel.http.get(f"{XUI_URL}/panel/api/inbounds/list")
+
+        # If unauthorized, try logging in again and retry
+        if response.status_code == 401:
+            if login_to_xui(force=True):
+                response = _panel.http.get(f"{XUI_URL}/panel/api/inbounds/list")
+            else:
+                return None
+
+        if not response.ok:
+            logger.error(f"Failed to get inbounds list: {response.status_code}")
+            return None
+
+        data = response.json()
+        if not data.get("success"):
+            logger.error(f"API error: {data.get('msg', 'Unknown error')}")
+            return None
+
+        for inbound in data.get("obj", []):
+            if str(inbound.get("id")) != str(INBOUND_ID):
+                continue
+
+            settings = json.loads(inbound.get("settings", "{}"))
+            stats = {stat.get("email"): stat for stat in inbound.get("clientStats") or []}
+
+            clients = settings.get("clients", [])
+            for client in clients:
+                stat = stats.get(client.get("email"), {})
+                client["inboundId"] = inbound.get("id")
+                client["up"] = stat.get("up", 0)
+                client["down"] = stat.get("down", 0)
+                client["stats_enable"] = stat.get("enable", client.get("enable", False))
+            return clients
+
+        return []
+    except Exception as e:
+        logger.error(f"Error getting inbound clients: {e}")
+        return None
+
 def delete_client(client_id):
     """Delete a client by UUID
 
@@ -342,18 +531,18 @@ def delete_client(client_id):
         client_id (str): Client UUID to delete
 
     Returns:
-        bool: True if successful, False otherwise
+        tuple: (success, error message or None)
     """
     if not ensure_authenticated():
         return False, "Failed to login to XUI panel"
 
     try:
-        response = session.post(f"{XUI_URL}/panel/api/inbounds/{INBOUND_ID}/delClient/{client_id}")
+        response = _panel.http.post(f"{XUI_URL}/panel/api/inbounds/{INBOUND_ID}/delClient/{client_id}")
 
         # If unauthorized, try logging in again and retry
         if response.status_code == 401:
             if login_to_xui(force=True):
-                response = session.post(f"{XUI_URL}/panel/api/inbounds/{INBOUND_ID}/delClient/{client_id}")
+                response = _panel.http.post(f"{XUI_URL}/panel/api/inbounds/{INBOUND_ID}/delClient/{client_id}")
             else:
                 return False, "Authentication failed"
 
@@ -368,3 +557,87 @@ def delete_client(client_id):
     except Exception as e:
         logger.error(f"Error deleting client: {e}")
         return False, str(e)
+
+def remove_clients(client_ids):
+    """Remove several clients with one delClient request each
+
+    Clients are deleted one by one, so the inbound is never rewritten and
+    clients added to it meanwhile are untouched. At most REMOVE_CLIENTS_WORKERS
+    requests run at once, each worker thread on its own panel session.
+
+    Args:
+        client_ids (list): Client UUIDs to remove
+
+    Returns:
+        tuple: (removed, failed) where removed is a list of the removed client
+               UUIDs and failed is a list of (client_id, error_message)
+    """
+    if not client_ids:
+        return [], []
+
+    with ThreadPoolExecutor(max_workers=min(REMOVE_CLIENTS_WORKERS, len(client_ids))) as pool:
+        results = list(pool.map(delete_client, client_ids))
+
+    removed = []
+    failed = []
+    for client_id, (success, error) in zip(client_ids, results):
+        if success:
+            removed.append(client_id)
+        else:
+            failed.append((client_id, error))
+
+    logger.info(f"Removed {len(removed)} clients from inbound {INBOUND_ID}, {len(failed)} failed")
+    return removed, failed
+
+def get_online_clients(max_age=ONLINE_CACHE_SECONDS):
+    """Get the emails of clients currently connected to the panel
+
+    The listing comes from a single onlines request and is cached for
+    `max_age` seconds, so status views can check many clients cheaply.
+
+    Returns:
+        frozenset: Emails of online clients, or None if error
+    """
+    global _online_cache
+
+    # The lock only guards the cache; the request runs outside it so a slow
+    # panel never blocks readers of a fresh listing
+    with _online_lock:
+        fetched_at, emails = _online_cache
+    if emails is not None and time.monotonic() - fetched_at < max_age:
+        return emails
+
+    if not ensure_authenticated():
+        return None
+
+    try:
+        response = _panel.http.post(f"{XUI_URL}/panel/api/inbounds/onlines")
+
+        # If unauthorized, try logging in again and retry
+        if response.status_code == 401:
+            if login_to_xui(force=True):
+                response = _panel.http.post(f"{XUI_URL}/panel/api/inbounds/onlines")
+            else:
+                return None
+
+        if not response.ok:
+            logger.error(f"Failed to get online clients: {response.status_code}")
+            return None
+
+        data = response.json()
+        if not data.get("success"):
+            logger.error(f"API error: {data.get('msg', 'Unknown error')}")
+            return None
+
+        # The panel returns null instead of an empty list when no one is online
+        emails = frozenset(data.get("obj") or [])
+    except Exception as e:
+        logger.error(f"Error getting online clients: {e}")
+        return None
+
+    fetched_at = time.monotonic()
+    with _online_lock:
+        # Keep a listing fetched meanwhile by another thread if it is newer
+        if fetched_at > _online_cache[0]:
+            _online_cache = (fetched_at, emails)
+    return emails
@@ -0,0 +1,355 @@
+"""
+Local stand-in for the 3x-ui panel API
+Serves the endpoints used by xui_api.py from memory so the panel code paths
+can be benchmarked and tested without a live panel or network access.
+
+Usage:
+    with XUIPanelSimulator(latency=0.005) as panel:
+        panel.seed_clients(20000)
+        xui_api.XUI_URL = panel.url
+        ...
+
+Or standalone:
+    python xui_simulator.py --clients 20000 --port 2053
+"""
+import argparse
+import json
+import logging
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+from config import XUI_USERNAME, XUI_PASSWORD, INBOUND_ID
+
+logger = logging.getLogger(__name__)
+
+COOKIE_NAME = "3x-ui"
+
+class XUIPanelSimulator:
+    """In-process fake 3x-ui panel
+
+    Args:
+        latency (float or tuple): Seconds to sleep per request, or a (min, max) range
+        error_rate (float): Probability of answering a request with HTTP 500
+        session_ttl (float): Seconds after which a login cookie stops working (None = never)
+        inbound_id (int): ID of the single inbound the panel exposes
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, error_rate=0.0,
+                 session_ttl=None, inbound_id=INBOUND_ID,
+                 username=XUI_USERNAME, password=XUI_PASSWORD):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.session_ttl = session_ttl
+        self.inbound_id = inbound_id
+        self.username = username
+        self.password = password
+
+        self.clients = {}  # client_id -> client settings dict
+        self.emails = {}  # email -> client_id
+        self.traffic = {}  # email -> {'up': int, 'down': int}
+        self.sessions = {}  # cookie token -> issued at
+        self.online = set()  # emails of connected clients
+        self.request_counts = {}
+        self._forced_failures = []
+        self._lock = threading.Lock()
+
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """Start serving in a background thread"""
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        logger.info(f"XUI simulator listening on {self.url}")
+        return self
+
+    def stop(self):
+        """Stop the server"""
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    # Test helpers
+
+    def seed_clients(self, count, prefix="seed", total_gb=50, days=30, used_ratio=0.3):
+        """Add `count` clients with random usage
+
+        Returns:
+            list: Created (email, client_id) pairs
+        """
+        now_ms = int(time.time() * 1000)
+        total_bytes = total_gb * 1024 ** 3
+        seeded = []
+        with self._lock:
+            for i in range(count):
+                client_id = str(uuid.uuid4())
+                email = f"{prefix}_{i}@sim"
+                self.clients[client_id] = self._new_client(
+                    client_id, email, total_bytes, now_ms + days * 86400 * 1000
+                )
+                used = int(total_bytes * random.uniform(0, used_ratio * 2))
+                self.traffic[email] = {'up': used // 10, 'down': used - used // 10}
+                self.emails[email] = client_id
+                seeded.append((email, client_id))
+        return seeded
+
+    def expire_sessions(self):
+        """Invalidate every issued login cookie so the next call gets a 401"""
+        with self._lock:
+            self.sessions.clear()
+
+    def fail_next(self, count=1, status=500):
+        """Answer the next `count` API requests with the given HTTP status"""
+        with self._lock:
+            self._forced_failures.extend([status] * count)
+
+    def find_client(self, email):
+        """Return the stored client settings for an email, or None"""
+        with self._lock:
+            client_id = self.emails.get(email)
+            return dict(self.clients[client_id]) if client_id else None
+
+    # Panel state
+
+    @staticmethod
+    def _new_client(client_id, email, total_bytes, expiry_ms):
+        return {
+            "id": client_id,
+            "flow": "",
+            "email": email,
+            "limitIp": 0,
+            "totalGB": total_bytes,
+            "expiryTime": expiry_ms,
+            "enable": True,
+            "tgId": "",
+            "subId": client_id.replace("-", "")[:16],
+            "reset": 0
+        }
+
+    def _client_stat(self, client):
+        usage = self.traffic.get(client['email'], {'up': 0, 'down': 0})
+        return {
+            "id": 0,
+            "inboundId": self.inbound_id,
+            "enable": client.get("enable", True),
+            "email": client['email'],
+            "up": usage['up'],
+            "down": usage['down'],
+            "expiryTime": client.get("expiryTime", 0),
+            "total": client.get("totalGB", 0),
+            "reset": client.get("reset", 0)
+        }
+
+    def _inbound(self):
+        clients = list(self.clients.values())
+        return {
+            "id": self.inbound_id,
+            "up": sum(t['up'] for t in self.traffic.values()),
+            "down": sum(t['down'] for t in self.traffic.values()),
+            "total": 0,
+            "remark": "simulator",
+            "enable": True,
+            "expiryTime": 0,
+            "clientStats": [self._client_stat(client) for client in clients],
+            "listen": "",
+            "port": 2087,
+            "protocol": "vless",
+            "settings": json.dumps({"clients": clients, "decryption": "none", "fallbacks": []}),
+            "streamSettings": json.dumps({"network": "ws", "security": "tls"}),
+            "tag": f"inbound-{self.inbound_id}",
+            "sniffing": json.dumps({"enabled": True, "destOverride": ["http", "tls"]})
+        }
+
+    def _session_valid(self, token):
+        issued = self.sessions.get(token)
+        if issued is None:
+            return False
+        if self.session_ttl is not None and time.time() - issued > self.session_ttl:
+            del self.sessions[token]
+            return False
+        return True
+
+    # Request routing
+
+    def _handle(self, method, path, cookies, body):
+        """Return (status, payload dict, extra headers)"""
+        with self._lock:
+            self.request_counts[path] = self.request_counts.get(path, 0) + 1
+
+            if path == "/login" and method == "POST":
+                return self._login(body)
+
+            if self._forced_failures:
+                return self._forced_failures.pop(0), {"success": False, "msg": "injected failure"}, {}
+            if self.error_rate and random.random() < self.error_rate:
+                return 500, {"success": False, "msg": "injected failure"}, {}
+
+            if not self._session_valid(cookies.get(COOKIE_NAME)):
+                return 401, {"success": False, "msg": "unauthorized"}, {}
+
+            for pattern, route_method, handler in self._routes:
+                match = pattern.fullmatch(path)
+                if match and method == route_method:
+                    return handler(self, body, *[unquote(group) for group in match.groups()])
+
+        return 404, {"success": False, "msg": "not found"}, {}
+
+    def _login(self, body):
+        if body.get("username") != self.username or body.get("password") != self.password:
+            return 200, {"success": False, "msg": "Wrong username or password", "obj": None}, {}
+        token = uuid.uuid4().hex
+        self.sessions[token] = time.time()
+        headers = {"Set-Cookie": f"{COOKIE_NAME}={token}; Path=/; HttpOnly"}
+        return 200, {"success": True, "msg": "Login Successfully", "obj": None}, headers
+
+    def _list_inbounds(self, body):
+        return 200, {"success": True, "msg": "", "obj": [self._inbound()]}, {}
+
+    def _client_traffics(self, body, email):
+        client_id = self.emails.get(email)
+        if client_id:
+            return 200, {"success": True, "msg": "", "obj": self._client_stat(self.clients[client_id])}, {}
+        return 200, {"success": True, "msg": "", "obj": None}, {}
+
+    def _parse_settings(self, body):
+        if str(body.get("id")) != str(self.inbound_id):
+            return None
+        return json.loads(body.get("settings", "{}")).get("clients", [])
+
+    def _add_client(self, body):
+        clients = self._parse_settings(body)
+        if clients is None:
+            return 200, {"success": False, "msg": "Inbound not found"}, {}
+
+        emails = set(self.emails)
+        for client in clients:
+            if client.get("email") in emails:
+                return 200, {"success": False, "msg": f"Duplicate email: {client.get('email')}"}, {}
+            emails.add(client.get("email"))
+
+        for client in clients:
+            self.clients[client['id']] = dict(client)
+            self.emails[client['email']] = client['id']
+            self.traffic.setdefault(client['email'], {'up': 0, 'down': 0})
+        return 200, {"success": True, "msg": "Client(s) added Successfully", "obj": None}, {}
+
+    def _update_client(self, body, client_id):
+        clients = self._parse_settings(body)
+        if not clients or client_id not in self.clients:
+            return 200, {"success": False, "msg": "Client not found"}, {}
+        self.emails.pop(self.clients[client_id]['email'], None)
+        self.clients[client_id] = dict(clients[0])
+        self.emails[clients[0]['email']] = client_id
+        return 200, {"success": True, "msg": "Client updated Successfully", "obj": None}, {}
+
+    def _del_client(self, body, inbound_id, client_id):
+        if str(inbound_id) != str(self.inbound_id) or client_id not in self.clients:
+            return 200, {"success": False, "msg": "Client not found"}, {}
+        client = self.clients.pop(client_id)
+        self.traffic.pop(client['email'], None)
+        self.emails.pop(client['email'], None)
+        return 200, {"success": True, "msg": "Client deleted Successfully", "obj": None}, {}
+
+    def _onlines(self, body):
+        online = [email for email in self.online if email in self.emails]
+        return 200, {"success": True, "msg": "", "obj": online or None}, {}
+
+    _routes = [
+        (re.compile(r"/panel/api/inbounds/list"), "GET", _list_inbounds),
+        (re.compile(r"/panel/api/inbounds/onlines"), "POST", _onlines),
+        (re.compile(r"/panel/api/inbounds/getClientTraffics/(.+)"), "GET", _client_traffics),
+        (re.compile(r"/panel/api/inbounds/addClient"), "POST", _add_client),
+        (re.compile(r"/panel/api/inbounds/updateClient/([^/]+)"), "POST", _update_client),
+        (re.compile(r"/panel/api/inbounds/(\d+)/delClient/([^/]+)"), "POST", _del_client),
+    ]
+
+    def _make_handler(self):
+        simulator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Keep-alive responses otherwise stall on delayed ACKs (~40ms per request)
+            disable_nagle_algorithm = True
+
+            def _dispatch(self, method):
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length else b""
+                try:
+                    body = json.loads(raw) if raw else {}
+                except ValueError:
+                    body = {}
+
+                cookies = {}
+                for part in (self.headers.get("Cookie") or "").split(";"):
+                    if "=" in part:
+                        key, value = part.strip().split("=", 1)
+                        cookies[key] = value
+
+                latency = simulator.latency
+                if isinstance(latency, tuple):
+                    latency = random.uniform(*latency)
+                if latency:
+                    time.sleep(latency)
+
+                status, payload, headers = simulator._handle(method, self.path.split("?")[0], cookies, body)
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._dispatch("GET")
+
+            def do_POST(self):
+                self._dispatch("POST")
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local 3x-ui panel simulator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2053)
+    parser.add_argument("--clients", type=int, default=0, help="number of clients to seed")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds of latency per request")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--session-ttl", type=float, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    panel = XUIPanelSimulator(args.host, args.port, latency=args.latency,
+                              error_rate=args.error_rate, session_ttl=args.session_ttl)
+    if args.clients:
+        panel.seed_clients(args.clients)
+    logger.info(f"Serving {len(panel.clients)} clients on {panel.url}")
+    try:
+        panel._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()